@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from modules import catalog_store
+from modules import gemini_client
+from modules import gemini_scheduler
+from modules import session_store
+from modules.concierge_service import ConciergeService, SessionBusyError, SessionNotFoundError
+
+# --------------------------------------------------------------------------
+# コンシェルジュの画面なし（ヘッドレス）の HTTP API。Streamlit を使わずに、
+# 分析官AI → protein_selector → コピーライターの1ターンを、Server-Sent Events で返します。
+#
+#   POST   /sessions                  {"persona": {...}} -> {"session_id": ...}
+#   GET    /sessions/{id}             ペルソナ・会話履歴・比較表の情報
+#   PUT    /sessions/{id}/persona     ペルソナの一部を更新
+#   DELETE /sessions/{id}
+#   POST   /sessions/{id}/turns       {"prompt": "..."} -> text/event-stream
+#                                      （turn / text / product / suggestions / done / error の各イベント）
+#   GET    /health                    カタログの版・同時ストリーム数・スケジューラーの状態
+#
+# 1つのイベントループで多数のストリームを同時に扱います。各ターンの処理（同期の部品）は
+# スレッドプールで実行し、イベントを asyncio.Queue に渡します。
+#
+#   python api_server.py --port 8000
+#   python api_server.py --fake --catalog-size 10000   # 偽のGeminiモデル・合成カタログで起動（負荷試験用）
+# --------------------------------------------------------------------------
+
+# 同時に処理するターンの上限（スレッドプールの大きさ）。超えた分は、空きが出るまで待ちます。
+MAX_CONCURRENT_TURNS = int(os.environ.get("SYNAPSE_API_MAX_TURNS", "64"))
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def sse_event(event: str, data) -> bytes:
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
+
+
+def _error(status: int, message: str) -> JSONResponse:
+    return JSONResponse({"error": message}, status_code=status)
+
+
+async def _json_body(request: Request):
+    body = await request.body()
+    if not body:
+        return {}
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise ValueError("request body must be JSON")
+    if not isinstance(data, dict):
+        raise ValueError("request body must be a JSON object")
+    return data
+
+
+def create_app(service: ConciergeService, max_concurrent_turns: int = MAX_CONCURRENT_TURNS) -> Starlette:
+    executor = ThreadPoolExecutor(max_workers=max_concurrent_turns, thread_name_prefix="concierge-turn")
+    streams = {"active": 0, "disconnected": 0}
+
+    async def create_session(request: Request):
+        try:
+            data = await _json_body(request)
+            session = await run_in_threadpool(service.create_session, data.get("persona"))
+        except ValueError as e:
+            return _error(400, str(e))
+        return JSONResponse({"session_id": session.session_id, "persona": session.persona}, status_code=201)
+
+    # SessionStore の履歴を読み書きする（ロックと SQLite を使う）処理は、イベントループを止めないよう
+    # スレッドプールで実行します（async でない関数は、Starlette がスレッドプールで呼び出します）
+    def get_session(request: Request):
+        try:
+            session = service.get_session(request.path_params["session_id"])
+        except SessionNotFoundError:
+            return _error(404, "session not found")
+        return JSONResponse(session.as_dict())
+
+    def delete_session(request: Request):
+        try:
+            service.delete_session(request.path_params["session_id"])
+        except SessionNotFoundError:
+            return _error(404, "session not found")
+        return JSONResponse({"deleted": True})
+
+    async def update_persona(request: Request):
+        try:
+            data = await _json_body(request)
+            session = await run_in_threadpool(service.update_persona, request.path_params["session_id"], data)
+        except SessionNotFoundError:
+            return _error(404, "session not found")
+        except ValueError as e:
+            return _error(400, str(e))
+        return JSONResponse({"session_id": session.session_id, "persona": session.persona})
+
+    async def create_turn(request: Request):
+        try:
+            data = await _json_body(request)
+            session = service.begin_turn(request.path_params["session_id"], data.get("prompt"))
+        except SessionNotFoundError:
+            return _error(404, "session not found")
+        except SessionBusyError:
+            return _error(409, "another turn is in progress for this session")
+        except ValueError as e:
+            return _error(400, str(e))
+
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        def put(item) -> None:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # サーバーの停止でイベントループが閉じている場合
+                pass
+
+        def pump() -> None:
+            # 利用者が切断しても、応答を履歴に保存するため最後まで処理します
+            try:
+                for event in service.run_turn(session, data["prompt"]):
+                    put(event)
+            finally:
+                put(done)
+
+        executor.submit(pump)
+
+        async def events():
+            streams["active"] += 1
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is done:
+                        break
+                    yield sse_event(*item)
+            except asyncio.CancelledError:
+                streams["disconnected"] += 1
+                raise
+            finally:
+                streams["active"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    async def health(request: Request):
+        catalog = service.catalog.current()
+        return JSONResponse({
+            "catalog": {"version": service.catalog.version, "rows": len(catalog)},
+            "streams": dict(streams),
+            "service": service.snapshot(),
+            "scheduler": {key: round(value, 1) for key, value in gemini_scheduler.get_scheduler().snapshot().items()},
+        })
+
+    routes = [
+        Route("/health", health, methods=["GET"]),
+        Route("/sessions", create_session, methods=["POST"]),
+        Route("/sessions/{session_id}", get_session, methods=["GET"]),
+        Route("/sessions/{session_id}", delete_session, methods=["DELETE"]),
+        Route("/sessions/{session_id}/persona", update_persona, methods=["PUT"]),
+        Route("/sessions/{session_id}/turns", create_turn, methods=["POST"]),
+    ]
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    app = Starlette(routes=routes, lifespan=lifespan)
+    app.state.service = service
+    return app
+
+
+def build_fake_service(catalog_size: int, tmp_dir: str) -> ConciergeService:
+    """偽のGeminiモデルと合成カタログで動くサービスを作る（ネットワークなしの検証・負荷試験用）。"""
+    from modules.fake_backends import FakeGeminiModel, FakeSheetsSource, make_synthetic_records
+
+    gemini_client.set_model_override(FakeGeminiModel(
+        analyzer_latency=float(os.environ.get("SYNAPSE_FAKE_ANALYZER_LATENCY", "0.8")),
+        first_token_latency=float(os.environ.get("SYNAPSE_FAKE_FIRST_TOKEN_LATENCY", "0.4")),
+        token_interval=float(os.environ.get("SYNAPSE_FAKE_TOKEN_INTERVAL", "0.02")),
+        vary_suggestions=True,
+    ))
+    store = catalog_store.CatalogStore(FakeSheetsSource(make_synthetic_records(catalog_size)), snapshot_path=os.path.join(tmp_dir, 'catalog.arrow'))
+    store.load()
+    return ConciergeService(store, session_store.SessionStore(db_path=os.path.join(tmp_dir, 'sessions.sqlite3')))
+
+
+def build_service() -> ConciergeService:
+    """app.py と同じく、ローカルのスナップショットから起動し、シートとの同期はバックグラウンドで行います。"""
+    from modules.google_sheets_client import GoogleSheetsSource
+
+    store = catalog_store.CatalogStore(GoogleSheetsSource())
+    store.load()
+    store.start_background_sync()
+    return ConciergeService(store)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="コンシェルジュのヘッドレス HTTP API（SSE）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fake", action="store_true", help="偽のGeminiモデルと合成カタログで起動します")
+    parser.add_argument("--catalog-size", type=int, default=10_000, help="--fake の合成カタログの行数")
+    parser.add_argument("--max-turns", type=int, default=MAX_CONCURRENT_TURNS, help="同時に処理するターンの上限")
+    parser.add_argument("--scheduler-rpm", type=float, default=gemini_scheduler.REQUESTS_PER_MINUTE, help="Gemini への1分あたりのリクエスト数の上限")
+    parser.add_argument("--max-in-flight", type=int, default=gemini_scheduler.MAX_CONCURRENT, help="Gemini へ同時に送るリクエストの上限")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    # ターンを処理するスレッドには Streamlit の実行コンテキストがないため、その警告を抑えます
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+    gemini_scheduler.set_scheduler(gemini_scheduler.GeminiScheduler(requests_per_minute=args.scheduler_rpm, max_concurrent=args.max_in_flight))
+    with tempfile.TemporaryDirectory(prefix="concierge-api-") as tmp:
+        service = build_fake_service(args.catalog_size, tmp) if args.fake else build_service()
+        print(f"Catalog {service.catalog.version} ({len(service.catalog.current())} rows), serving on http://{args.host}:{args.port}", file=sys.stderr)
+        uvicorn.run(create_app(service, args.max_turns), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import streamlit as st
-from modules.google_sheets_client import get_all_records
-from modules import ui_components, chat_handler
+from modules.google_sheets_client import GoogleSheetsSource
+from modules import ui_components, chat_handler, catalog_store, session_store, tracing, prefetch
 import pandas as pd
 import re
 import json
@@ -14,12 +14,17 @@ st.set_page_config(
 )
 
 # --- 関数定義 ---
-@st.cache_data(ttl=600)
+@st.cache_resource
+def get_catalog_store():
+    # プロセス全体で1つだけ作成し、ローカルのスナップショットから即座に起動します。
+    # シートとの同期はバックグラウンドで行われ、新しいスナップショットはアトミックに差し替えられます。
+    store = catalog_store.CatalogStore(GoogleSheetsSource())
+    store.load()
+    store.start_background_sync()
+    return store
+
 def load_data():
-    df = get_all_records()
-    if not df.empty and 'ProteinPerServing(g)' in df.columns and 'ServingSize(g)' in df.columns:
-        df['ProteinPurity(%)'] = (df['ProteinPerServing(g)'] / df['ServingSize(g)']) * 100
-    return df
+    return get_catalog_store().current()
 
 def initialize_session_state():
     if "diagnosis_complete" not in st.session_state:
@@ -33,7 +38,11 @@ def initialize_session_state():
             'priorities': {'価格の安さ': True, '味のおいしさ': False, '成分の品質': False, '有名ブランド': False}
         }
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        # 会話履歴の本体はプロセス共有の SessionStore（SQLite）にあり、セッション状態にはその窓口だけを置きます
+        st.session_state.messages = session_store.SessionMessages()
+    if "prefetcher" not in st.session_state:
+        # 提案ボタンの先読み（結果はこのセッションの次のターンだけで使います）
+        st.session_state.prefetcher = prefetch.SuggestionPrefetcher()
 
 # --- メイン処理 ---
 initialize_session_state()
@@ -43,6 +52,11 @@ if protein_df.empty:
     st.error("データベースからプロテイン情報を読み込めませんでした。")
     st.stop()
 
+# 管理者用の計測ページ（?admin=<SYNAPSE_ADMIN_TOKEN> を付けて開いた場合のみ）
+if tracing.admin_enabled(st.query_params.get("admin")):
+    ui_components.render_trace_dashboard()
+    st.stop()
+
 st.title("🔬 THE PROTEIN LOGIC - AIプロテインアドバイザー")
 
 if not st.session_state.diagnosis_complete:
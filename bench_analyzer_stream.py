@@ -0,0 +1,94 @@
+import sys
+
+import pandas as pd
+
+from modules import gemini_client
+from modules import intent_cache
+from modules import turn_pipeline
+from modules.fake_backends import FakeGeminiModel, make_synthetic_catalog
+
+# --------------------------------------------------------------------------
+# 分析官AIのストリーム解析（intent_stream）のベンチマーク。
+# 遅延を注入した偽のGeminiモデルで、分析官AIが呼ばれるターンを実行し、
+#   - 応答の全体を待ってから商品選定を始める場合（SYNAPSE_EARLY_SELECTION=0 と同じ）と、
+#     key_metric と relevant_tags が届いた時点で始める場合の、
+#     「intent が揃ってからコピーライターに送るまで」の時間と TTFT
+#   - 分析官AIの応答の一部が不正なJSONの場合の、やり直しの回数と分類器への切り替えの回数
+# を表示します。
+#   python bench_analyzer_stream.py [試行回数]
+# --------------------------------------------------------------------------
+
+CATALOG_SIZES = [10_000, 100_000]
+# ルール分類器では判定できず、分析官AIが呼ばれる要望
+PROMPT = "なんか良い感じのやつ"
+PERSONA = {
+    'experience': '継続的に飲んでいる', 'current_brand': None, 'baseline_product_id': None,
+    'purpose': '筋肉を大きくしたい',
+    'priorities': {'価格の安さ': True, '味のおいしさ': False, '成分の品質': True, '有名ブランド': False},
+}
+
+
+def run_turn(protein_df):
+    intent_cache.get_shared_cache().clear()
+    prepared = turn_pipeline.prepare_turn(protein_df, [{"role": "user", "content": PROMPT}], PERSONA)
+    for _ in prepared.stream:
+        pass
+    return prepared.timings.as_dict()
+
+
+def bench_early_selection(repeat):
+    rows = []
+    for size in CATALOG_SIZES:
+        protein_df = make_synthetic_catalog(size)
+        run_turn(protein_df)  # 索引を作っておきます
+        for early in (False, True):
+            turn_pipeline.EARLY_SELECTION_ENABLED = early
+            gaps, ttfts, selections = [], [], []
+            for _ in range(repeat):
+                timings = run_turn(protein_df)
+                gaps.append(timings["marks"]["writer_request"] - timings["marks"]["intent_ready"])
+                ttfts.append(timings["marks"]["writer_first_token"])
+                selections.append(timings["stages"]["selection"]["ms"] + timings["stages"]["writer_inputs"]["ms"])
+            rows.append({
+                "rows": size,
+                "selection starts": "on key_metric" if early else "after full intent",
+                "selection + inputs (ms)": round(sum(selections) / repeat, 1),
+                "intent ready -> writer request (ms)": round(sum(gaps) / repeat, 1),
+                "TTFT (ms)": round(sum(ttfts) / repeat, 1),
+            })
+    turn_pipeline.EARLY_SELECTION_ENABLED = True
+    return pd.DataFrame(rows)
+
+
+def bench_invalid_output(turns):
+    rows = []
+    protein_df = make_synthetic_catalog(CATALOG_SIZES[0])
+    for invalid_rate in (0.0, 0.1, 0.3):
+        model = FakeGeminiModel(analyzer_latency=0.2, first_token_latency=0.05, token_interval=0.0, invalid_rate=invalid_rate, seed=1)
+        gemini_client.set_model_override(model)
+        sources = {}
+        for _ in range(turns):
+            source = run_turn(protein_df)["attributes"]["analyzer"]["intent_source"]
+            sources[source] = sources.get(source, 0) + 1
+        rows.append({
+            "invalid rate": invalid_rate, "turns": turns, "analyzer requests": model.calls["analyzer"],
+            "invalid responses": model.invalid, "served by analyzer": sources.get("analyzer", 0),
+            "classifier fallback": sources.get("classifier_fallback", 0),
+        })
+    return pd.DataFrame(rows)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    model = FakeGeminiModel(analyzer_latency=0.8, first_token_latency=0.4, token_interval=0.01)
+    gemini_client.set_model_override(model)
+    print(f"[1] analyzer latency {model.analyzer_latency * 1000:.0f} ms (first chunk at {model.analyzer_first_token_latency * 1000:.0f} ms), "
+          f"writer first token {model.first_token_latency * 1000:.0f} ms")
+    print(bench_early_selection(repeat).to_string(index=False))
+    print("\n[2] invalid analyzer output: one immediate retry, then the local classifier")
+    print(bench_invalid_output(repeat * 10).to_string(index=False))
+    gemini_client.set_model_override(None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+# --------------------------------------------------------------------------
+# ヘッドレス HTTP API（api_server.py）のベンチマーク。
+# 偽のGeminiモデル・合成カタログで api_server.py --fake を別プロセスとして起動し、
+#   [1] 軽いエンドポイント（GET /health・GET /sessions/{id}）の 1秒あたりのリクエスト数
+#   [2] 同時に N 本の SSE ストリームを開いたときの、1秒あたりのターン数と、
+#       最初の text イベントまでの時間（TTFT）・1ターン全体の時間の p50 / p95
+# を表示します。全てのストリームが done で終わらなければ、終了コード 1 です。
+# Gemini の割り当て（スケジューラーの RPM・同時実行数）で頭打ちにならないよう、既定では大きめの値で起動します。
+# 本番の割り当てでの上限を見る場合は --scheduler-rpm 240 --max-in-flight 16 を指定してください。
+#   python bench_api_server.py [--concurrency 1 10 50] [--turns 3]
+# --------------------------------------------------------------------------
+
+PROMPTS = ["とにかく、今より安いプロテイン", "なんか良い感じのやつ", "味がもっと美味しいプロテイン", "国産で安心できるものがいい"]
+
+
+def request(base, method, path, body=None):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(base + path, data=data, method=method, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=60) as response:
+        return json.loads(response.read())
+
+
+def stream_turn(base, session_id, prompt):
+    """1ターンの SSE を最後まで読み、(TTFT 秒, 全体の秒, 最後のイベント名, イベント数) を返す。"""
+    start = time.perf_counter()
+    ttft = None
+    event = None
+    count = 0
+    req = urllib.request.Request(
+        f"{base}/sessions/{session_id}/turns", data=json.dumps({"prompt": prompt}).encode("utf-8"), method="POST",
+        headers={"Content-Type": "application/json", "Accept": "text/event-stream"},
+    )
+    with urllib.request.urlopen(req, timeout=120) as response:
+        for raw in response:
+            line = raw.decode("utf-8").rstrip("\n")
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+                count += 1
+                if event == "text" and ttft is None:
+                    ttft = time.perf_counter() - start
+    return ttft, time.perf_counter() - start, event, count
+
+
+def wait_ready(base, process, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("api_server.py exited during startup")
+        try:
+            return request(base, "GET", "/health")
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("api_server.py did not become ready")
+
+
+def bench_light(base, seconds, clients=8):
+    session_id = request(base, "POST", "/sessions", {})["session_id"]
+    rows = []
+    for name, path in (("GET /health", "/health"), (f"GET /sessions/{{id}}", f"/sessions/{session_id}")):
+        counts = [0] * clients
+        deadline = time.perf_counter() + seconds
+
+        def client(i):
+            while time.perf_counter() < deadline:
+                request(base, "GET", path)
+                counts[i] += 1
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        rows.append({"endpoint": name, "clients": clients, "req/s": round(sum(counts) / (time.perf_counter() - start), 1)})
+    return pd.DataFrame(rows)
+
+
+def bench_streams(base, concurrency, turns):
+    session_ids = [request(base, "POST", "/sessions", {})["session_id"] for _ in range(concurrency)]
+    results, errors = [], []
+    lock = threading.Lock()
+
+    def client(i):
+        for turn in range(turns):
+            try:
+                result = stream_turn(base, session_ids[i], PROMPTS[(i + turn) % len(PROMPTS)])
+            except OSError as e:
+                result = (None, None, f"transport: {e}", 0)
+            with lock:
+                (results if result[2] == "done" else errors).append(result)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    ttfts = np.array([r[0] for r in results if r[0] is not None]) * 1000
+    totals = np.array([r[1] for r in results]) * 1000
+    return {
+        "streams": concurrency, "turns": len(results) + len(errors), "failed": len(errors),
+        "turns/s": round(len(results) / elapsed, 1),
+        "events/s": round(sum(r[3] for r in results) / elapsed, 0),
+        "TTFT p50 (ms)": round(float(np.percentile(ttfts, 50)), 0) if len(ttfts) else None,
+        "TTFT p95 (ms)": round(float(np.percentile(ttfts, 95)), 0) if len(ttfts) else None,
+        "turn p95 (ms)": round(float(np.percentile(totals, 95)), 0) if len(totals) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="api_server.py のベンチマーク")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--turns", type=int, default=3, help="ストリームごとのターン数")
+    parser.add_argument("--light-seconds", type=float, default=3.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--scheduler-rpm", type=float, default=60_000)
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    args = parser.parse_args()
+
+    base = f"http://127.0.0.1:{args.port}"
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, "api_server.py", "--fake", "--port", str(args.port), "--max-turns", str(max(args.concurrency)),
+         "--scheduler-rpm", str(args.scheduler_rpm), "--max-in-flight", str(args.max_in_flight)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        health = wait_ready(base, process)
+        print(f"api_server.py --fake ready: catalog {health['catalog']['version']} ({health['catalog']['rows']} rows)")
+        print("\n[1] lightweight endpoints")
+        print(bench_light(base, args.light_seconds).to_string(index=False))
+        print(f"\n[2] concurrent SSE turns (fake Gemini, {args.turns} turns per stream, scheduler {args.scheduler_rpm:.0f} rpm / {args.max_in_flight} in flight)")
+        rows = [bench_streams(base, n, args.turns) for n in args.concurrency]
+        print(pd.DataFrame(rows).to_string(index=False))
+        health = request(base, "GET", "/health")
+        print(f"\nserver: {health['service']}")
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+    if any(row["failed"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from modules import catalog_store
+from modules import tag_index
+from modules.fake_backends import make_synthetic_records
+
+# --------------------------------------------------------------------------
+# catalog_store.prepare_catalog（スキーマ適用）のベンチマーク。
+# 合成カタログ 10k / 100k / 500k 件で、以前の読み込み（数値は float64、文字列の列は object のまま）と比べて
+#   - 読み込み（レコード -> DataFrame）にかかる時間
+#   - メモリ使用量（memory_usage(deep=True)）と、スナップショットのファイルサイズ
+#   - sort_values（1kgあたり価格）、ブランドでの絞り込み、タグの部分一致（str.contains）、ブランド別の集計
+#   - TagIndex の構築
+# を表示します。
+#   python bench_catalog_schema.py [試行回数]
+# --------------------------------------------------------------------------
+
+SIZES = [10_000, 100_000, 500_000]
+LEGACY_NUMERIC_COLUMNS = [
+    'ProteinPerServing(g)', 'ServingSize(g)', 'Price(JPY)', 'WeightInKg', 'PricePerKg(JPY)',
+    'FatPerServing(g)', 'CarbPerServing(g)', 'Solubility', 'ProteinPurity(%)',
+]
+
+
+def legacy_prepare_catalog(records):
+    """スキーマ適用前の prepare_catalog（比較用）。"""
+    df = pd.DataFrame(records)
+    for col in df.columns:
+        if col in LEGACY_NUMERIC_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+        else:
+            df[col] = df[col].fillna('').astype(str)
+    df['ProteinPurity(%)'] = (df['ProteinPerServing(g)'] / df['ServingSize(g)']) * 100
+    return df
+
+
+def _time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def _snapshot_bytes(df):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'catalog.arrow')
+        catalog_store.write_snapshot(df, path, {'snapshot_version': 'bench', 'source_revision': ''})
+        return os.path.getsize(path)
+
+
+def measure(label, prepare, records, repeat):
+    start = time.perf_counter()
+    df = prepare(records)
+    load_ms = (time.perf_counter() - start) * 1000
+    brand = df['Brand'].iloc[0]
+    start = time.perf_counter()
+    tag_index.TagIndex(df)
+    tag_index_ms = (time.perf_counter() - start) * 1000
+    return {
+        "rows": len(records),
+        "loader": label,
+        "load (ms)": round(load_ms, 0),
+        "memory (MB)": round(df.memory_usage(deep=True).sum() / 1e6, 1),
+        "snapshot (MB)": round(_snapshot_bytes(df) / 1e6, 1),
+        "sort_values (ms)": round(_time_per_call(lambda: df.sort_values('PricePerKg(JPY)'), repeat), 2),
+        "brand filter (ms)": round(_time_per_call(lambda: df[df['Brand'] == brand], repeat), 2),
+        "tag contains (ms)": round(_time_per_call(lambda: df[df['PersonaTags'].str.contains('#WPI', regex=False)], repeat), 2),
+        "groupby brand (ms)": round(_time_per_call(lambda: df.groupby('Brand', observed=True)['ProteinPurity(%)'].mean(), repeat), 2),
+        "TagIndex build (ms)": round(tag_index_ms, 0),
+    }
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rows = []
+    for size in SIZES:
+        records = make_synthetic_records(size)
+        rows.append(measure("legacy", legacy_prepare_catalog, records, repeat))
+        rows.append(measure("schema", catalog_store.prepare_catalog, records, repeat))
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
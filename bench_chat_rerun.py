@@ -0,0 +1,83 @@
+import re
+import sys
+import time
+
+import pandas as pd
+
+from modules import catalog_index
+from modules import render_cache
+from modules import session_store
+from modules.fake_backends import FAKE_WRITER_RESPONSE, make_synthetic_catalog
+
+# --------------------------------------------------------------------------
+# チャット画面の再実行（ui_components.render_chat_interface）のうち、
+# 履歴やカタログの大きさに比例していた処理のベンチマーク。
+#   - 最後の応答からの商品IDの解析（re.findall）
+#   - ProductID での商品検索（毎回の set_index / 永続的な CatalogIndex）
+#   - 比較表の整形（毎回の Styler.format / 商品IDから組み立てた整形済みの表のキャッシュ）
+# を、以前の実装と現在の実装で比較し、1回の再実行あたりの内訳を表示します。
+#   python bench_chat_rerun.py [試行回数]
+# --------------------------------------------------------------------------
+
+CATALOG_SIZES = [10_000, 100_000]
+
+
+def legacy_rerun(protein_df, last_message, table_info, timings):
+    start = time.perf_counter()
+    product_ids_found = re.findall(r'<!-- ID: ([A-Z]{2}\d{3}) -->', last_message["content"])
+    parsed = time.perf_counter()
+    protein_df_indexed = protein_df.set_index('ProductID')
+    cards = [protein_df_indexed.loc[pid] for pid in set(product_ids_found) if pid in protein_df_indexed.index]
+    looked_up = time.perf_counter()
+    table_df = protein_df.iloc[[0, 10, 20]]
+    display_columns = ['ProductName', 'ProteinPurity(%)', 'Price(JPY)', 'WeightInKg', 'PricePerKg(JPY)']
+    final_table = table_df[display_columns].rename(columns=render_cache.TABLE_LABELS)
+    styled = final_table.set_index('商品名').style.format(render_cache.TABLE_FORMATS)
+    styled.to_html()  # st.table が Styler を描画する際の計算に相当
+    tabled = time.perf_counter()
+    timings["parse ids"] += parsed - start
+    timings["product lookup"] += looked_up - parsed
+    timings["comparison table"] += tabled - looked_up
+    return cards
+
+
+def cached_rerun(protein_df, last_message, table_info, timings):
+    start = time.perf_counter()
+    product_ids_found = render_cache.message_product_ids(last_message)
+    parsed = time.perf_counter()
+    index = catalog_index.get_catalog_index(protein_df)
+    cards = [index.product_row(pid) for pid in product_ids_found]
+    looked_up = time.perf_counter()
+    table = render_cache.comparison_table(table_info, protein_df)
+    table.to_html()
+    tabled = time.perf_counter()
+    timings["parse ids"] += parsed - start
+    timings["product lookup"] += looked_up - parsed
+    timings["comparison table"] += tabled - looked_up
+    return cards
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rows = []
+    for size in CATALOG_SIZES:
+        df = make_synthetic_catalog(size)
+        catalog_index.get_catalog_index(df)
+        content = FAKE_WRITER_RESPONSE.replace('AA001', df['ProductID'].iloc[10]).replace('AA002', df['ProductID'].iloc[20])
+        table_info = session_store.make_table_info(df.iloc[[10, 20]], df.iloc[0], "PricePerKg(JPY)", render_cache.new_message_id())
+        for label, rerun in [("legacy", legacy_rerun), ("cached", cached_rerun)]:
+            message = render_cache.make_assistant_message(content, []) if rerun is cached_rerun else {"role": "assistant", "content": content}
+            timings = {"parse ids": 0.0, "product lookup": 0.0, "comparison table": 0.0}
+            for _ in range(repeat):
+                rerun(df, message, table_info, timings)
+            row = {"rows": size, "path": label}
+            row.update({f"{name} (ms)": round(total / repeat * 1000, 3) for name, total in timings.items()})
+            row["total (ms/rerun)"] = round(sum(timings.values()) / repeat * 1000, 3)
+            rows.append(row)
+
+    print(pd.DataFrame(rows).to_string(index=False))
+    print(f"\ncomparison table cache: {render_cache.stats}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import sys
+import time
+
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+from modules.fake_backends import make_synthetic_catalog
+
+# --------------------------------------------------------------------------
+# 診断フォーム（ui_components.render_diagnosis_form）の、操作1回あたりの再実行時間のベンチマーク。
+#   - legacy:   以前のフォーム。操作のたびにスクリプト全体が再実行され、フォーム全体を描画し、
+#               ブランドの一覧（sorted(unique)）と、ブランドでの絞り込みを作り直します。
+#   - fragment: 現在のフォーム。操作した設問の st.fragment だけが再実行されます。
+# AppTest は st.fragment の部分的な再実行を再現しないため、fragment は「その設問の関数だけを描画するスクリプト」
+# の実行時間で計測します（Streamlit が fragment の再実行時に実行するのも、その関数だけです）。
+#   python bench_form_rerun.py [試行回数]
+# --------------------------------------------------------------------------
+
+CATALOG_SIZES = [10_000, 100_000]
+_catalogs = {}
+
+
+def catalog(size):
+    if size not in _catalogs:
+        _catalogs[size] = make_synthetic_catalog(size)
+    return _catalogs[size]
+
+
+def init_persona(st):
+    if "persona" not in st.session_state:
+        st.session_state.persona = {
+            'experience': '継続的に飲んでいる', 'current_brand': None, 'baseline_product_id': None,
+            'purpose': '筋肉を大きくしたい',
+            'priorities': {'価格の安さ': True, '味のおいしさ': False, '成分の品質': False, '有名ブランド': False},
+        }
+
+
+def legacy_render_diagnosis_form(st, protein_df):
+    """以前の render_diagnosis_form（比較用。Q1〜Q4を毎回すべて描画します）。"""
+    with st.container(border=True):
+        st.subheader("Q1. プロテインの利用経験は？")
+        exp_options = ["継続的に飲んでいる", "初めて or ほとんど飲んだことがない"]
+        cols = st.columns(len(exp_options))
+        for i, option in enumerate(exp_options):
+            with cols[i]:
+                st.button(option, key=f"q1_{i}", use_container_width=True)
+        st.subheader("Q2. 現在、主に飲んでいるブランドと製品は？")
+        all_brands = ["選択してください"] + sorted(protein_df["Brand"].unique())
+        selected_brand = st.selectbox("まずブランドを選択してください", options=all_brands, key="brand_selector")
+        if selected_brand != "選択してください":
+            st.session_state.persona['current_brand'] = selected_brand
+            brand_df = protein_df[protein_df["Brand"] == selected_brand]
+            product_options = [("その他 / この中にない", "OTHER")] + list(zip(brand_df['ProductName'], brand_df['ProductID']))
+            current_product_id = st.session_state.persona.get('baseline_product_id')
+            current_product_index = 0
+            if current_product_id:
+                try:
+                    current_product_index = [item[1] for item in product_options].index(current_product_id)
+                except ValueError:
+                    current_product_index = 0
+            selected = st.selectbox("製品", options=product_options, index=current_product_index, format_func=lambda x: x[0], key="product_selector")
+            st.session_state.persona['baseline_product_id'] = None if selected[1] == "OTHER" else selected[1]
+        st.subheader("Q3. プロテインを飲む主な目的は何ですか？")
+        purpose_options = ["筋肉を大きくしたい", "ダイエット・減量", "健康・栄養補助"]
+        st.session_state.persona['purpose'] = st.selectbox("目的", purpose_options, label_visibility="collapsed", key="q3_purpose")
+        st.subheader("Q4. 新しいプロテインを探す上で、重視する点は何ですか？ (いくつでも)")
+        cols = st.columns(2)
+        for i, key in enumerate(['価格の安さ', '味のおいしさ', '成分の品質', '有名ブランド']):
+            with cols[i % 2]:
+                with st.container(border=True):
+                    st.session_state.persona['priorities'][key] = st.toggle(key, value=st.session_state.persona['priorities'].get(key, False), key=f"q4_{key}")
+    st.button("✅ 上の内容で、AIに相談を始める", type="primary", use_container_width=True)
+
+
+def legacy_script(size):
+    import streamlit as st
+    import bench_form_rerun as bench
+    bench.init_persona(st)
+    bench.legacy_render_diagnosis_form(st, bench.catalog(size))
+
+
+def full_form_script(size):
+    import streamlit as st
+    import bench_form_rerun as bench
+    from modules import ui_components
+    bench.init_persona(st)
+    ui_components.render_diagnosis_form(bench.catalog(size))
+
+
+def experience_fragment_script(size):
+    import streamlit as st
+    import bench_form_rerun as bench
+    from modules import ui_components
+    bench.init_persona(st)
+    ui_components._render_experience_section(bench.catalog(size))
+
+
+def priorities_fragment_script(size):
+    import streamlit as st
+    import bench_form_rerun as bench
+    from modules import ui_components
+    bench.init_persona(st)
+    ui_components._render_priorities_section()
+
+
+def _time_interactions(script, size, interact, repeat):
+    at = AppTest.from_function(script, args=(size,), default_timeout=60)
+    at.run()
+    total = 0.0
+    for i in range(repeat):
+        interact(at, i)
+        start = time.perf_counter()
+        at.run()
+        total += time.perf_counter() - start
+        if at.exception:
+            raise RuntimeError(at.exception)
+    return total / repeat * 1000
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rows = []
+    for size in CATALOG_SIZES:
+        df = catalog(size)
+        brands = sorted(df['Brand'].unique())
+
+        def toggle(at, i):
+            at.toggle(key="q4_味のおいしさ").set_value(i % 2 == 0)
+
+        def select_brand(at, i):
+            at.selectbox(key="brand_selector").set_value(brands[i % len(brands)])
+
+        interactions = [
+            ("Q4 toggle", toggle, priorities_fragment_script),
+            ("Q2 brand select", select_brand, experience_fragment_script),
+        ]
+        for label, interact, fragment_script in interactions:
+            rows.append({
+                "rows": size,
+                "interaction": label,
+                "legacy full rerun (ms)": round(_time_interactions(legacy_script, size, interact, repeat), 1),
+                "current full rerun (ms)": round(_time_interactions(full_form_script, size, interact, repeat), 1),
+                "fragment rerun (ms)": round(_time_interactions(fragment_script, size, interact, repeat), 1),
+            })
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from modules import gemini_scheduler
+from modules.fake_backends import FakeGeminiModel
+
+# --------------------------------------------------------------------------
+# gemini_scheduler のベンチマーク。割り当て超過（429）を返す偽のエンドポイント（FakeGeminiModel）に対して、
+#   1. 割り当てを超える同時アクセス: 直接呼び出す場合（以前の gemini_client）とスケジューラー経由の成功率・所要時間
+#   2. 遅い応答の裾: 分析官AIのヘッジあり・なしの p50 / p95 / p99
+#   3. 優先度: 裏方のリクエストで混み合っている時の、コピーライターの待ち時間
+# を比較します。
+#   python bench_gemini_scheduler.py [同時ターン数]
+# --------------------------------------------------------------------------
+
+QUOTA_PER_SECOND = 10
+
+
+def _run_concurrently(n, fn):
+    results = [None] * n
+
+    def worker(i):
+        start = time.perf_counter()
+        try:
+            fn(i)
+            results[i] = (True, (time.perf_counter() - start) * 1000)
+        except Exception:
+            results[i] = (False, (time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _summarize(label, results, extra=None):
+    ok = [ms for success, ms in results if success]
+    row = {
+        "mode": label,
+        "success rate": f"{len(ok) / len(results):.0%}",
+        "p50 (ms)": round(float(np.percentile(ok, 50)), 0) if ok else None,
+        "p95 (ms)": round(float(np.percentile(ok, 95)), 0) if ok else None,
+        "p99 (ms)": round(float(np.percentile(ok, 99)), 0) if ok else None,
+    }
+    row.update(extra or {})
+    return row
+
+
+def bench_throttling(turns):
+    """1ターン = 分析官AI + コピーライターのストリーム。割り当ては1秒あたり QUOTA_PER_SECOND 件です。"""
+    rows = []
+    model = FakeGeminiModel(analyzer_latency=0.2, first_token_latency=0.1, token_interval=0.002, quota_per_second=QUOTA_PER_SECOND)
+
+    def direct_turn(_):
+        model.generate_content("analyze")
+        for _ in model.generate_content("write", stream=True):
+            pass
+    rows.append(_summarize("direct", _run_concurrently(turns, direct_turn), {"server 429s": sum(model.throttled.values())}))
+
+    model = FakeGeminiModel(analyzer_latency=0.2, first_token_latency=0.1, token_interval=0.002, quota_per_second=QUOTA_PER_SECOND)
+    # 割り当ての9割に合わせます（時計のずれなどで、サーバー側の割り当てをわずかに超えることがあるため）
+    scheduler = gemini_scheduler.GeminiScheduler(requests_per_minute=QUOTA_PER_SECOND * 60 * 0.9, burst=QUOTA_PER_SECOND * 0.9, seed=0)
+
+    def scheduled_turn(_):
+        scheduler.call(lambda: model.generate_content("analyze"), priority=gemini_scheduler.PRIORITY_ANALYZER)
+        for _ in scheduler.stream(lambda: model.generate_content("write", stream=True)):
+            pass
+    results = _run_concurrently(turns, scheduled_turn)
+    stats = scheduler.snapshot()
+    rows.append(_summarize("scheduler", results, {
+        "server 429s": sum(model.throttled.values()), "retries": stats["retries"],
+        "avg queue wait (ms)": round(stats["avg_queue_wait_ms"], 0),
+    }))
+    return pd.DataFrame(rows)
+
+
+def bench_hedging(calls):
+    """分析官AIの応答の1割が5倍遅い場合に、ヘッジで裾の遅延がどこまで縮むか。"""
+    rows = []
+    for hedge_after in (None, 0.35):
+        model = FakeGeminiModel(analyzer_latency=0.2, slow_rate=0.1, slow_factor=5.0, seed=1)
+        scheduler = gemini_scheduler.GeminiScheduler(requests_per_minute=60_000, burst=100, max_concurrent=32, seed=0)
+        results = []
+        for _ in range(calls // 4):
+            results += _run_concurrently(4, lambda _: scheduler.call(lambda: model.generate_content("analyze"), hedge_after=hedge_after))
+        stats = scheduler.snapshot()
+        label = "no hedge" if hedge_after is None else f"hedge after {hedge_after * 1000:.0f} ms"
+        rows.append(_summarize(label, results, {
+            "requests sent": model.calls["analyzer"], "hedges": stats["hedges"], "hedge wins": stats["hedge_wins"],
+        }))
+    return pd.DataFrame(rows)
+
+
+def bench_priority(background_calls):
+    """同時実行数4の枠を裏方のリクエストが埋めている時に、後から来たコピーライターが待つ時間。"""
+    rows = []
+    for writer_priority in (gemini_scheduler.PRIORITY_BACKGROUND, gemini_scheduler.PRIORITY_WRITER):
+        model = FakeGeminiModel(analyzer_latency=0.1, first_token_latency=0.05, token_interval=0.002)
+        scheduler = gemini_scheduler.GeminiScheduler(requests_per_minute=60_000, burst=100, max_concurrent=4)
+        background = [
+            threading.Thread(target=scheduler.call, args=(lambda: model.generate_content("prefetch"),), kwargs={"priority": gemini_scheduler.PRIORITY_BACKGROUND})
+            for _ in range(background_calls)
+        ]
+        for thread in background:
+            thread.start()
+        time.sleep(0.02)
+
+        def writer(_):
+            for _ in scheduler.stream(lambda: model.generate_content("write", stream=True), priority=writer_priority):
+                break
+        results = _run_concurrently(4, writer)
+        for thread in background:
+            thread.join()
+        label = "writer as background" if writer_priority == gemini_scheduler.PRIORITY_BACKGROUND else "writer prioritized"
+        rows.append(_summarize(label, results))
+    return pd.DataFrame(rows).rename(columns={"p50 (ms)": "writer TTFT p50 (ms)", "p95 (ms)": "writer TTFT p95 (ms)", "p99 (ms)": "writer TTFT p99 (ms)"})
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    print(f"[1] {turns} concurrent turns against a {QUOTA_PER_SECOND} req/s quota")
+    print(bench_throttling(turns).to_string(index=False))
+    print("\n[2] analyzer tail latency (10% of responses 5x slower), 200 calls")
+    print(bench_hedging(200).to_string(index=False))
+    print("\n[3] writer streams arriving behind 40 background requests (max 4 in flight)")
+    print(bench_priority(40).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
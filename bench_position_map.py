@@ -0,0 +1,81 @@
+import json
+import sys
+import time
+
+import altair as alt
+import pandas as pd
+
+from modules import chart_data
+from modules.fake_backends import make_synthetic_catalog
+
+# --------------------------------------------------------------------------
+# ポジションマップ（ui_components.render_protein_position_map）のベンチマーク。
+# 以前の実装（再実行のたびに copy + Highlight列 + 全行を埋め込んだ Altair の仕様）と、
+# chart_data の実装（スナップショットごとの背景レイヤー + 小さな重ね合わせ）を、
+# 1回の再実行あたりの時間と、ブラウザに送る仕様(JSON)の大きさで比較します。
+#   python bench_position_map.py [試行回数]
+# --------------------------------------------------------------------------
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+def legacy_spec(all_proteins_df, comparison_df):
+    """変更前の実装（描画直前まで）。比較用にそのまま残しています。"""
+    plot_df = all_proteins_df.copy()
+    plot_df['Highlight'] = 'その他の商品'
+    if not comparison_df.empty:
+        baseline_id = comparison_df.iloc[0]['ProductID']
+        recommend_ids = comparison_df.iloc[1:]['ProductID'].tolist()
+        plot_df.loc[plot_df['ProductID'] == baseline_id, 'Highlight'] = '現在の商品'
+        plot_df.loc[plot_df['ProductID'].isin(recommend_ids), 'Highlight'] = 'AIの提案'
+    chart = alt.Chart(plot_df).mark_circle(size=100).encode(
+        x=alt.X('PricePerKg(JPY):Q', title='価格 (円/kg) ←安い', scale=alt.Scale(zero=False)),
+        y=alt.Y('ProteinPurity(%):Q', title='タンパク質含有率 (%) ↑高い', scale=alt.Scale(zero=False)),
+        color=alt.Color('Highlight:N', title='凡例', scale=alt.Scale(domain=chart_data.HIGHLIGHT_DOMAIN, range=chart_data.HIGHLIGHT_RANGE)),
+        tooltip=['Brand', 'ProductName', 'PricePerKg(JPY)', 'ProteinPurity(%)']
+    ).interactive()
+    return json.dumps(chart.to_dict(), ensure_ascii=False)
+
+
+def layered_spec(all_proteins_df, comparison_df):
+    map_data = chart_data.get_position_map_data(all_proteins_df)
+    overlay = map_data.overlay_values(all_proteins_df, comparison_df.iloc[0]['ProductID'], comparison_df.iloc[1:]['ProductID'].tolist())
+    return json.dumps(map_data.spec(overlay), ensure_ascii=False)
+
+
+def _time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    alt.data_transformers.disable_max_rows()
+    rows = []
+    for size in SIZES:
+        df = make_synthetic_catalog(size)
+        comparison_df = df.iloc[[size // 2, 1, 2]]
+
+        start = time.perf_counter()
+        map_data = chart_data.get_position_map_data(df)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        legacy_ms, legacy_json = _time_per_call(lambda: legacy_spec(df, comparison_df), repeat)
+        layered_ms, layered_json = _time_per_call(lambda: layered_spec(df, comparison_df), repeat)
+        rows.append({
+            "rows": size,
+            "points sent": map_data.base_points,
+            "legacy (ms/rerun)": round(legacy_ms, 1),
+            "layered (ms/rerun)": round(layered_ms, 2),
+            "base layer build (ms, once)": round(build_ms, 1),
+            "legacy payload (KB)": round(len(legacy_json.encode('utf-8')) / 1024, 1),
+            "layered payload (KB)": round(len(layered_json.encode('utf-8')) / 1024, 1),
+        })
+
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import sys
+import time
+
+import pandas as pd
+
+from modules import product_serializer
+from modules import protein_selector
+from modules.chat_history import estimate_tokens
+from modules.fake_backends import make_synthetic_catalog
+
+# --------------------------------------------------------------------------
+# コピーライターに渡す提案商品データ（[selected_products_data]）のベンチマーク。
+# 以前の selected_products.to_markdown(index=False) と、product_serializer.serialize_products を
+# 推定トークン数と1回あたりの変換時間で比較します。
+#   python bench_product_serializer.py [試行回数]
+# --------------------------------------------------------------------------
+
+CATALOG_SIZE = 10_000
+KEY_METRICS = ["PricePerKg(JPY)", "ProteinPerServing(g)", "FatPerServing(g)", "Taste", "Other"]
+PERSONA = {'baseline_product_id': None, 'current_brand': None}
+
+
+def _time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    df = make_synthetic_catalog(CATALOG_SIZE)
+    rows = []
+    for key_metric in KEY_METRICS:
+        intent = {"key_metric": key_metric, "relevant_tags": ["#美味しい"] if key_metric == "Taste" else []}
+        selected = protein_selector.select_products(df, intent, PERSONA)[0]
+
+        markdown = selected.to_markdown(index=False)
+        compact = product_serializer.serialize_products(df, selected, key_metric)
+        rows.append({
+            "key_metric": key_metric,
+            "markdown tokens": estimate_tokens(markdown),
+            "compact tokens": estimate_tokens(compact),
+            "reduction": f"{1 - estimate_tokens(compact) / estimate_tokens(markdown):.0%}",
+            "markdown (ms/call)": round(_time_per_call(lambda: selected.to_markdown(index=False), repeat), 3),
+            "compact (ms/call)": round(_time_per_call(lambda: product_serializer.serialize_products(df, selected, key_metric), repeat), 3),
+        })
+
+    print(pd.DataFrame(rows).to_string(index=False))
+    print("\n--- 例: PricePerKg(JPY) ---")
+    selected = protein_selector.select_products(df, {"key_metric": "PricePerKg(JPY)"}, PERSONA)[0]
+    print(product_serializer.serialize_products(df, selected, "PricePerKg(JPY)"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import hashlib
+import sys
+import time
+
+import pandas as pd
+
+from modules import formatters
+from modules import gemini_client
+from modules.fake_backends import FakeGeminiModel
+
+# --------------------------------------------------------------------------
+# コピーライターのプロンプト組み立てのベンチマークと、システム指示（固定の部分）の確認。
+#   [1] 以前の組み立て（9KBのプロンプト全体に str.replace を8回）と、解析済みのテンプレート（prompt_templates）で
+#       ターンごとの内容を1回で組み立てる場合の、1回あたりの時間と、送信するバイト数
+#   [2] 偽のGeminiモデルで、入力の違う複数のターンを実行し、分析官AI・コピーライターに送ったシステム指示の
+#       バイト列が全てのターンで同じか（プロバイダー側のキャッシュが効く形か）を確かめます。違えば終了コード 1 です。
+#   python bench_prompt_templates.py [試行回数]
+# --------------------------------------------------------------------------
+
+HISTORY_TURNS = [0, 5, 20]
+
+
+def make_writer_inputs(turns, variant=0):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"{i}回目の質問です。もう少し安いものはありますか？（{variant}）"})
+        messages.append({"role": "assistant", "content": f"### おすすめ {variant}-{i} <!-- ID: AA{i:03d} -->\n" + "提案の本文です。" * 60})
+    return dict(
+        full_user_prompt=f"とにかく安いのがいい（{variant}）",
+        user_desire_summary=f"価格が安いこと（{variant}）",
+        key_metric_name="1kgあたりの価格",
+        selection_reason="価格の安さ",
+        baseline_product_data="N/A" if variant % 2 else "ブランド: ザバス / 1kgあたりの価格: 4,200円",
+        selected_products_data="\n".join(f"| AA{variant}{i:02d} | マイプロテイン | {3000 + variant * 10 + i}円 |" for i in range(2)),
+        chat_history=formatters.format_chat_history(messages + [{"role": "user", "content": "最新の質問"}]),
+        nutrition_tip="プロテインは、運動後30分以内に飲むのがおすすめです。",
+    )
+
+
+def legacy_render(template, inputs):
+    """以前の get_ai_response_writer と同じ、str.replace を繋げた組み立て（比較用）。"""
+    return template.replace(
+        "[full_user_prompt]", inputs["full_user_prompt"]
+    ).replace(
+        "[user_desire_summary]", inputs["user_desire_summary"]
+    ).replace(
+        "[key_metric_name]", inputs["key_metric_name"]
+    ).replace(
+        "[selection_reason]", inputs["selection_reason"]
+    ).replace(
+        "[baseline_product_data]", inputs["baseline_product_data"]
+    ).replace(
+        "[selected_products_data]", inputs["selected_products_data"]
+    ).replace(
+        "[chat_history]", inputs["chat_history"]
+    ).replace(
+        "[nutrition_tip]", inputs["nutrition_tip"]
+    )
+
+
+def _time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench_render(repeat):
+    system_prompt = gemini_client.load_prompt(gemini_client.WRITER_SYSTEM_PROMPT)
+    template = gemini_client.load_template(gemini_client.WRITER_TURN_TEMPLATE)
+    # 以前と同じく、システム指示とターンごとの内容が1つの文字列に入ったテンプレート
+    legacy_template = f"{system_prompt}\n\n{template.text}"
+    rows = []
+    for turns in HISTORY_TURNS:
+        inputs = make_writer_inputs(turns)
+        legacy = legacy_render(legacy_template, inputs)
+        content = template.render(inputs)
+        rows.append({
+            "history turns": turns,
+            "legacy replace x8 (ms)": round(_time_per_call(lambda: legacy_render(legacy_template, inputs), repeat), 3),
+            "compiled render (ms)": round(_time_per_call(lambda: template.render(inputs), repeat), 3),
+            "legacy prompt (KB)": round(len(legacy.encode('utf-8')) / 1024, 1),
+            "stable prefix (KB)": round(len(system_prompt.encode('utf-8')) / 1024, 1),
+            "per-turn content (KB)": round(len(content.encode('utf-8')) / 1024, 1),
+        })
+    return pd.DataFrame(rows)
+
+
+def check_prefix(turns):
+    """入力の違う turns 回のターンを偽のモデルで実行し、送ったシステム指示のハッシュを返す。"""
+    model = FakeGeminiModel(analyzer_latency=0.0, first_token_latency=0.0, token_interval=0.0)
+    gemini_client.set_model_override(model)
+    try:
+        for variant in range(turns):
+            inputs = make_writer_inputs(variant % 6, variant)
+            gemini_client.get_intent_from_ai(inputs["full_user_prompt"])
+            for _ in gemini_client.get_ai_response_writer(**inputs):
+                pass
+    finally:
+        gemini_client.set_model_override(None)
+    digests = {"analyzer": set(), "writer": set()}
+    contents = {"analyzer": set(), "writer": set()}
+    for prompt, instruction in zip(model.prompts, model.system_instructions):
+        kind = "analyzer" if prompt.startswith("# ユーザーの要望") else "writer"
+        digests[kind].add(hashlib.sha256((instruction or "").encode('utf-8')).hexdigest() if instruction else None)
+        contents[kind].add(prompt)
+    return digests, contents
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("[1] writer prompt assembly")
+    print(bench_render(repeat).to_string(index=False))
+
+    turns = 12
+    digests, contents = check_prefix(turns)
+    print(f"\n[2] system instruction bytes across {turns} turns with different inputs")
+    ok = True
+    for kind in ("analyzer", "writer"):
+        stable = len(digests[kind]) == 1 and None not in digests[kind]
+        ok = ok and stable
+        digest = next(iter(digests[kind])) if len(digests[kind]) == 1 else None
+        print(f"  {kind}: {len(contents[kind])} distinct per-turn contents, {len(digests[kind])} distinct system instruction(s)"
+              f" -> {'identical prefix sha256 ' + digest[:16] if stable else 'PREFIX CHANGED'}")
+    stats = gemini_client.get_setup_stats()
+    print(f"  prefix reuses: {stats['prefix_reuses']}, changes: {stats['prefix_changes']} (unexpected: {stats['unexpected_prefix_changes']})")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
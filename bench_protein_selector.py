@@ -0,0 +1,77 @@
+import sys
+import time
+
+import pandas as pd
+
+from modules import protein_selector
+from modules.fake_backends import make_synthetic_catalog
+
+# --------------------------------------------------------------------------
+# protein_selector.select_products のベンチマーク。
+# 以前の実装（毎回 copy + sort_values）と、CatalogIndex を使う現在の実装を、
+# 合成カタログ 1k / 10k / 100k 件で比較します。
+#   python bench_protein_selector.py [試行回数]
+# --------------------------------------------------------------------------
+
+SIZES = [1_000, 10_000, 100_000]
+INTENTS = [
+    {"key_metric": "PricePerKg(JPY)"},
+    {"key_metric": "ProteinPerServing(g)"},
+    {"key_metric": "FatPerServing(g)"},
+    {"key_metric": "Other"},
+]
+
+
+def legacy_select_products(protein_df, intent, persona):
+    """変更前の実装（数値指標のソート部分のみ）。比較用にそのまま残しています。"""
+    df = protein_df.copy()
+    baseline_product = None
+    product_id = persona.get('baseline_product_id')
+    if product_id:
+        baseline_product_df = df[df["ProductID"] == product_id]
+        if not baseline_product_df.empty:
+            baseline_product = baseline_product_df.iloc[0]
+    key_metric = intent.get("key_metric", "Other")
+    if key_metric == "PricePerKg(JPY)":
+        recommend_df = df.sort_values(by="PricePerKg(JPY)", ascending=True)
+    else:
+        recommend_df = df.sort_values(by="ProteinPurity(%)", ascending=False)
+    if baseline_product is not None:
+        recommend_df = recommend_df[recommend_df['ProductID'] != baseline_product['ProductID']]
+    return recommend_df.head(2)
+
+
+def _time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rows = []
+    for size in SIZES:
+        df = make_synthetic_catalog(size)
+        persona = {'baseline_product_id': df['ProductID'].iloc[size // 2], 'current_brand': None}
+
+        # インデックスの構築はスナップショットごとに1回だけなので、別に計測します
+        start = time.perf_counter()
+        protein_selector.select_products(df, INTENTS[0], persona)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        legacy_ms = sum(_time_per_call(lambda: legacy_select_products(df, intent, persona), repeat) for intent in INTENTS) / len(INTENTS)
+        indexed_ms = sum(_time_per_call(lambda: protein_selector.select_products(df, intent, persona), repeat) for intent in INTENTS) / len(INTENTS)
+        rows.append({
+            "rows": size,
+            "legacy (ms/call)": round(legacy_ms, 3),
+            "indexed (ms/call)": round(indexed_ms, 3),
+            "speedup": round(legacy_ms / indexed_ms, 1),
+            "index build (ms, once)": round(build_ms, 1),
+        })
+
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
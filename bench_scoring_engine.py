@@ -0,0 +1,71 @@
+import sys
+import time
+
+import pandas as pd
+
+from modules import catalog_index
+from modules import protein_selector
+from modules import scoring_engine
+from modules import tag_index
+from modules.fake_backends import make_synthetic_catalog
+
+# --------------------------------------------------------------------------
+# modules/scoring_engine.py のベンチマーク。
+# 合成カタログ 1k / 10k / 100k 件で、
+#   - 正規化行列の構築（スナップショットごとに1回）
+#   - 重み付きスコアの計算 + 上位2件の抽出（リクエストごと）
+#   - select_products 全体（リクエストごと）
+#   - 価格 × タンパク質含有率のパレート最適解の抽出
+# にかかる時間を表示します。
+#   python bench_scoring_engine.py [試行回数]
+# --------------------------------------------------------------------------
+
+SIZES = [1_000, 10_000, 100_000]
+PERSONA = {
+    'baseline_product_id': None, 'current_brand': None,
+    'priorities': {'価格の安さ': True, '味のおいしさ': True, '成分の品質': False, '有名ブランド': True},
+}
+INTENT = {"key_metric": "ProteinPerServing(g)", "relevant_tags": ["#国内製造", "#無添加"]}
+
+
+def _time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rows = []
+    for size in SIZES:
+        df = make_synthetic_catalog(size)
+        persona = dict(PERSONA, baseline_product_id=df['ProductID'].iloc[size // 2])
+
+        start = time.perf_counter()
+        engine = scoring_engine.get_scoring_engine(df)
+        build_ms = (time.perf_counter() - start) * 1000
+        tags = tag_index.get_tag_index(df)
+        catalog_index.get_catalog_index(df)
+        price = df['PricePerKg(JPY)'].to_numpy(dtype='float64')
+        purity = df['ProteinPurity(%)'].to_numpy(dtype='float64')
+
+        def score_and_rank():
+            weights = scoring_engine.build_weights('ProteinPurity(%)', persona)
+            scores = engine.scores(weights, scoring_engine.build_tag_boost(tags, persona, INTENT["relevant_tags"]))
+            return engine.top_k(scores, 2, exclude_positions=[size // 2])
+
+        rows.append({
+            "rows": size,
+            "engine build (ms, once)": round(build_ms, 1),
+            "score + top2 (ms/call)": round(_time_per_call(score_and_rank, repeat), 3),
+            "select_products (ms/call)": round(_time_per_call(lambda: protein_selector.select_products(df, INTENT, persona), repeat), 3),
+            "pareto front (ms)": round(_time_per_call(lambda: scoring_engine.pareto_front(price, purity), repeat), 2),
+            "pareto size": len(engine.pareto_front()),
+        })
+
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import sys
+import time
+
+import pandas as pd
+
+from modules import formatters
+from modules import gemini_client
+from modules import intent_cache
+from modules import nutrition_data
+from modules import protein_selector
+from modules import turn_pipeline
+from modules.fake_backends import FakeGeminiModel, make_synthetic_catalog
+
+# --------------------------------------------------------------------------
+# 1ターンの処理（handle_ai_response の中身）のベンチマーク。
+# 遅延を注入した偽のGeminiモデルを使い、以前の逐次処理と turn_pipeline.prepare_turn を
+# 「最初のトークンが届くまでの時間（TTFT）」と「応答が終わるまでの時間」で比較します。
+#   python bench_turn_pipeline.py [試行回数]
+# cold: スナップショット更新直後（索引の構築が必要）のターン / warm: 索引が作成済みのターン
+# --------------------------------------------------------------------------
+
+CATALOG_SIZE = 100_000
+HISTORY_TURNS = 20
+# ルール分類器では判定できず、分析官AIが呼ばれる要望
+PROMPT = "なんか良い感じのやつ"
+PERSONA = {
+    'experience': '継続的に飲んでいる', 'current_brand': None, 'baseline_product_id': None,
+    'purpose': '筋肉を大きくしたい',
+    'priorities': {'価格の安さ': True, '味のおいしさ': False, '成分の品質': False, '有名ブランド': False},
+}
+
+
+def _make_messages(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"{i}回目の質問です。もう少し安いものはありますか？"})
+        messages.append({"role": "assistant", "content": gemini_client.load_prompt('system_prompt_writer.txt')[:1500]})
+    messages.append({"role": "user", "content": PROMPT})
+    return messages
+
+
+def sequential_turn(protein_df, messages, persona):
+    """変更前の handle_ai_response と同じ順序で処理し、コピーライターのストリームを返す。"""
+    prompt = messages[-1]["content"]
+    if len(messages) == 1:
+        persona_text = formatters.format_persona(persona)
+        full_user_prompt = f"{persona_text}\n\n**ユーザーの『乗り換えの決め手』:**\n{prompt}"
+    else:
+        persona_text = ""
+        full_user_prompt = prompt
+    intent = turn_pipeline.resolve_intent(prompt, persona_text, full_user_prompt)
+    selected_products, baseline_product, selection_reason, key_metric_name_jp, key_metric_col_name = protein_selector.select_products(
+        protein_df, intent, persona
+    )
+    baseline_text = formatters.format_baseline_for_ai(baseline_product, key_metric_name_jp, key_metric_col_name)
+    chat_history_text = formatters.format_chat_history(messages)
+    nutrition_tip_text = nutrition_data.get_formatted_nutrition_tip(intent)
+    return gemini_client.get_ai_response_writer(
+        full_user_prompt=full_user_prompt,
+        user_desire_summary=intent.get("user_desire_summary", "総合的なおすすめ"),
+        key_metric_name=key_metric_name_jp,
+        selection_reason=selection_reason,
+        baseline_product_data=baseline_text,
+        selected_products_data=selected_products.to_markdown(index=False),
+        chat_history=chat_history_text,
+        nutrition_tip=nutrition_tip_text,
+    )
+
+
+def pipelined_turn(protein_df, messages, persona):
+    return turn_pipeline.prepare_turn(protein_df, messages, persona).stream
+
+
+def _measure(turn_fn, protein_df, messages, cold, repeat):
+    ttft, total = [], []
+    for i in range(repeat):
+        intent_cache.get_shared_cache().clear()
+        if cold:
+            # 新しいスナップショットが届いた直後を再現します（索引は作り直しになります）
+            protein_df.attrs['snapshot_version'] = f"bench-{turn_fn.__name__}-{i}-{time.time_ns()}"
+        start = time.perf_counter()
+        first = None
+        for _ in turn_fn(protein_df, messages, PERSONA):
+            if first is None:
+                first = time.perf_counter()
+        end = time.perf_counter()
+        ttft.append((first - start) * 1000)
+        total.append((end - start) * 1000)
+    return sum(ttft) / repeat, sum(total) / repeat
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    model = FakeGeminiModel(analyzer_latency=0.8, first_token_latency=0.4, token_interval=0.01)
+    gemini_client.set_model_override(model)
+    protein_df = make_synthetic_catalog(CATALOG_SIZE)
+
+    rows = []
+    for label, messages in [("first turn", _make_messages(0)), (f"turn {HISTORY_TURNS + 1}", _make_messages(HISTORY_TURNS))]:
+        for cold in (True, False):
+            if not cold:
+                # warm の計測の前に、索引を作っておきます
+                protein_selector.select_products(protein_df, {"key_metric": "Other"}, PERSONA)
+            seq_ttft, seq_total = _measure(sequential_turn, protein_df, messages, cold, repeat)
+            pipe_ttft, pipe_total = _measure(pipelined_turn, protein_df, messages, cold, repeat)
+            rows.append({
+                "turn": label,
+                "catalog": "cold" if cold else "warm",
+                "sequential TTFT (ms)": round(seq_ttft, 1),
+                "pipelined TTFT (ms)": round(pipe_ttft, 1),
+                "TTFT saved (ms)": round(seq_ttft - pipe_ttft, 1),
+                "sequential total (ms)": round(seq_total, 1),
+                "pipelined total (ms)": round(pipe_total, 1),
+            })
+
+    gemini_client.set_model_override(None)
+    print(f"catalog rows: {CATALOG_SIZE:,}, analyzer latency: {model.analyzer_latency * 1000:.0f} ms, "
+          f"writer first token: {model.first_token_latency * 1000:.0f} ms")
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import json
+import sys
+import time
+
+from modules import intent_classifier
+
+# --------------------------------------------------------------------------
+# ルール分類器（modules/intent_classifier.py）のオフライン評価。
+# 分析官AIの記録（SYNAPSE_INTENT_LOG で出力した JSONL）を読み込み、
+#   - 分析官AIを省略できた割合（カバー率）
+#   - 省略した要望での key_metric 一致率 / relevant_tags の一致度
+#   - 省略できた分析官AIの待ち時間
+# を表示します。
+#   SYNAPSE_INTENT_LOG=intent_log.jsonl streamlit run app.py   # 記録
+#   python evaluate_intent_classifier.py intent_log.jsonl      # 評価
+# ファイルを指定しない場合は、分析官プロンプトの例と例示ボタンの文言で評価します。
+# --------------------------------------------------------------------------
+
+# 記録に latency_ms がない場合に使う、分析官AIの1回あたりの待ち時間の仮定値（ミリ秒）
+DEFAULT_ANALYZER_MS = 1200.0
+
+BUILTIN_SAMPLES = [
+    {"prompt": "とにかく安いのがいい", "intent": {"key_metric": "PricePerKg(JPY)", "relevant_tags": []}},
+    {"prompt": "さっぱりしたフルーツ系の味がいいな", "intent": {"key_metric": "Taste", "relevant_tags": ["#フルーティー", "#さっぱり"]}},
+    {"prompt": "炭水化物が少なめで、できれば国産のやつがいいんだけど", "intent": {"key_metric": "CarbPerServing(g)", "relevant_tags": ["#国内製造"]}},
+    {"prompt": "なんか良い感じのやつ", "intent": {"key_metric": "Other", "relevant_tags": []}},
+    {"prompt": "味がもっと美味しいプロテイン", "intent": {"key_metric": "Taste", "relevant_tags": []}},
+    {"prompt": "今よりタンパク質が多いプロテイン", "intent": {"key_metric": "ProteinPerServing(g)", "relevant_tags": []}},
+    {"prompt": "とにかく、今より安いプロテイン", "intent": {"key_metric": "PricePerKg(JPY)", "relevant_tags": []}},
+]
+
+
+def load_records(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _tag_jaccard(a, b):
+    a, b = set(a or []), set(b or [])
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def evaluate(records):
+    covered = agreed = 0
+    tag_scores = []
+    saved_ms = 0.0
+    classify_ms = 0.0
+    disagreements = []
+
+    for record in records:
+        start = time.perf_counter()
+        intent, confidence = intent_classifier.classify_intent(record["prompt"])
+        classify_ms += (time.perf_counter() - start) * 1000
+        if not intent_classifier.is_confident(intent, confidence):
+            continue
+
+        covered += 1
+        expected = record["intent"]
+        saved_ms += record.get("latency_ms") or DEFAULT_ANALYZER_MS
+        tag_scores.append(_tag_jaccard(intent["relevant_tags"], expected.get("relevant_tags")))
+        if intent["key_metric"] == expected.get("key_metric"):
+            agreed += 1
+        else:
+            disagreements.append((record["prompt"], intent["key_metric"], expected.get("key_metric")))
+
+    total = len(records)
+    return {
+        "records": total,
+        "fast_path_coverage": covered / total if total else 0.0,
+        "key_metric_agreement": agreed / covered if covered else 0.0,
+        "mean_tag_jaccard": sum(tag_scores) / len(tag_scores) if tag_scores else 0.0,
+        "analyzer_ms_saved_total": saved_ms,
+        "analyzer_ms_saved_per_turn": saved_ms / total if total else 0.0,
+        "classifier_ms_per_turn": classify_ms / total if total else 0.0,
+        "disagreements": disagreements,
+    }
+
+
+def main():
+    records = load_records(sys.argv[1]) if len(sys.argv) > 1 else BUILTIN_SAMPLES
+    result = evaluate(records)
+    disagreements = result.pop("disagreements")
+    for key, value in result.items():
+        print(f"{key:>28}: {value:.3f}" if isinstance(value, float) else f"{key:>28}: {value}")
+    if disagreements:
+        print("\n--- key_metric が分析官AIと異なった要望 ---")
+        for prompt, got, expected in disagreements:
+            print(f"  {prompt!r}: classifier={got}, analyzer={expected}")
+
+
+if __name__ == '__main__':
+    main()
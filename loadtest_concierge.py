@@ -0,0 +1,393 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from modules import catalog_store
+from modules import gemini_client
+from modules import gemini_scheduler
+from modules import prefetch
+from modules import render_cache
+from modules import session_store
+from modules import stream_parser
+from modules import tracing
+from modules import turn_pipeline
+from modules import writer_cache
+from modules.fake_backends import FakeGeminiModel, FakeSheetsSource, make_synthetic_records
+
+# --------------------------------------------------------------------------
+# コンシェルジュの負荷試験・耐久試験（ソーク試験）。
+# handle_ai_response と同じ部品（turn_pipeline.prepare_turn → stream_parser → SessionStore）を、
+# N 個の同時セッションから繰り返し呼び出し、以下を計測します。
+#   - 最初のトークンが画面に出るまでの時間（TTFT）と、1ターン全体の時間の p50 / p95 / p99
+#   - 1秒あたりに処理できたターン数（スループット）
+#   - セッションあたりのメモリ（SessionStore に置いた履歴の概算と、プロセスの RSS の増加分）
+# Gemini は遅延・トークン速度・エラー率を指定できる FakeGeminiModel、
+# シートは FakeSheetsSource（一定間隔で行を書き換え、スナップショットの差し替えも発生させます）で置き換えます。
+#
+#   python loadtest_concierge.py --sessions 50 --turns 4
+#   python loadtest_concierge.py --sessions 20 --duration 600 --sheet-update-interval 30   # 耐久試験
+#   python loadtest_concierge.py --max-ttft-p95-ms 1500 --max-error-rate 0.01               # 性能の回帰チェック
+#   python loadtest_concierge.py --click-rate 0.8 --vary-suggestions --prefetch             # 提案ボタンの先読みの効果
+#
+# --max-* / --min-* の基準を1つでも外れると、終了コード 1 で終わります（CI のゲートとして使えます）。
+# --------------------------------------------------------------------------
+
+# 例示ボタン・提案ボタンの文言（分類器・キャッシュで解決される）と、分析官AIが必要になる自由入力を混ぜます
+PROMPTS = [
+    "味がもっと美味しいプロテイン", "今よりタンパク質が多いプロテイン", "とにかく、今より安いプロテイン",
+    "なんか良い感じのやつ", "減量中でも続けやすいものはありますか？", "国産で安心できるものがいい",
+    "もう少し溶けやすいものが知りたい", "甘すぎないフレーバーのおすすめは？",
+]
+PERSONAS = [
+    {
+        'experience': '継続的に飲んでいる', 'current_brand': None, 'baseline_product_id': None,
+        'purpose': '筋肉を大きくしたい',
+        'priorities': {'価格の安さ': True, '味のおいしさ': False, '成分の品質': False, '有名ブランド': False},
+    },
+    {
+        'experience': 'これから始める', 'current_brand': None, 'baseline_product_id': None,
+        'purpose': '健康維持',
+        'priorities': {'価格の安さ': False, '味のおいしさ': True, '成分の品質': False, '有名ブランド': True},
+    },
+    {
+        'experience': '継続的に飲んでいる', 'current_brand': None, 'baseline_product_id': None,
+        'purpose': 'ダイエット',
+        'priorities': {'価格の安さ': False, '味のおいしさ': False, '成分の品質': True, '有名ブランド': False},
+    },
+]
+# gemini_client がエラー時にコピーライターの代わりに返す文言の書き出し
+WRITER_ERROR_PREFIX = "申し訳ありません、AI"
+
+
+def _rss_bytes() -> int:
+    """プロセスの現在の常駐メモリ（RSS）。/proc がない環境では最大 RSS で代用します。"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 1), "p95": round(float(p95), 1), "p99": round(float(p99), 1), "max": round(float(max(values)), 1)}
+
+
+class LoadTestResults:
+    """各ターンの計測値をスレッド間で集める入れ物。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ttft_ms = []
+        self.total_ms = []
+        self.turns = 0
+        self.degraded_turns = 0
+        self.failed_turns = 0
+        self.failures = []
+
+    def record(self, ttft_ms, total_ms, degraded):
+        with self._lock:
+            self.turns += 1
+            if ttft_ms is not None:
+                self.ttft_ms.append(ttft_ms)
+            self.total_ms.append(total_ms)
+            if degraded:
+                self.degraded_turns += 1
+
+    def record_failure(self, error):
+        with self._lock:
+            self.turns += 1
+            self.failed_turns += 1
+            if len(self.failures) < 5:
+                self.failures.append(repr(error))
+
+
+def run_turn(store: catalog_store.CatalogStore, messages, persona, prompt, results: LoadTestResults, recorder: tracing.TraceRecorder, prefetcher=None) -> None:
+    """handle_ai_response と同じ順序で1ターンを処理し、計測値を results に記録する。"""
+    messages.append({"role": "user", "content": prompt})
+    start = time.perf_counter()
+    try:
+        protein_df = store.current()
+        prefetched = prefetcher.take(prompt, protein_df, persona) if prefetcher is not None else None
+        turn = turn_pipeline.prepare_turn(protein_df, messages, persona, prefetched=prefetched)
+        parser = stream_parser.WriterStreamParser()
+
+        def on_event(kind, value):
+            if kind == "suggestions" and prefetcher is not None:
+                prefetcher.start(value, protein_df, persona)
+
+        first = None
+        for _ in stream_parser.display_stream(turn.stream, parser, on_event):
+            if first is None:
+                first = time.perf_counter()
+        turn.timings.mark("stream_parsed", parse_cpu_ms=round(parser.parse_ms, 2), suggestions=len(parser.suggestions), products=len(parser.product_ids))
+        recorder.record(turn.timings)
+        messages.append(render_cache.make_assistant_message(parser.body, parser.suggestions, product_ids=parser.product_ids))
+        session_store.make_table_info(turn.selected_products, turn.baseline_product, turn.key_metric_col_name, render_cache.new_message_id())
+    except Exception as e:
+        results.record_failure(e)
+        return
+    end = time.perf_counter()
+    degraded = parser.body.startswith(WRITER_ERROR_PREFIX) or not parser.product_ids
+    results.record((first - start) * 1000 if first else None, (end - start) * 1000, degraded)
+
+
+def run_session(index, args, store, sessions, results, recorder, deadline) -> None:
+    """1人のユーザーを再現する。ランプアップの分だけ遅れて始め、考える時間を挟みながら質問を続けます。"""
+    rng = random.Random(args.seed + index)
+    time.sleep(args.ramp_up * index / max(args.sessions, 1))
+    messages = session_store.SessionMessages(store=sessions)
+    persona = PERSONAS[index % len(PERSONAS)]
+    prefetcher = prefetch.SuggestionPrefetcher()
+    turn = 0
+    while (turn < args.turns) if deadline is None else (time.monotonic() < deadline):
+        # --click-rate の確率で、直前の応答の提案ボタンを押します（それ以外は自由入力・例示ボタン）
+        suggestions = messages[-1].get("suggestions") if len(messages) else None
+        prompt = rng.choice(suggestions) if suggestions and rng.random() < args.click_rate else rng.choice(PROMPTS)
+        run_turn(store, messages, persona, prompt, results, recorder, prefetcher)
+        turn += 1
+        if args.think_time:
+            time.sleep(rng.uniform(0.5, 1.5) * args.think_time)
+
+
+def sheet_updater(source: FakeSheetsSource, store: catalog_store.CatalogStore, records, interval, stop_event, counter) -> None:
+    """一定間隔でシートの行を書き換え、同期してスナップショットを差し替える（耐久試験用）。"""
+    rng = random.Random(0)
+    while not stop_event.wait(interval):
+        record = rng.choice(records)
+        source.update_row(record['ProductID'], **{'Price(JPY)': round(rng.uniform(1500, 30000), -1)})
+        if store.sync_once():
+            counter["snapshot_swaps"] += 1
+
+
+def check_thresholds(report, args):
+    """--max-* / --min-* の基準と比べ、外れたものを文言のリストで返す。"""
+    checks = [
+        ("TTFT p95 (ms)", report["ttft_ms"]["p95"], args.max_ttft_p95_ms, "max"),
+        ("TTFT p99 (ms)", report["ttft_ms"]["p99"], args.max_ttft_p99_ms, "max"),
+        ("total p95 (ms)", report["total_ms"]["p95"], args.max_total_p95_ms, "max"),
+        ("error rate", report["error_rate"], args.max_error_rate, "max"),
+        ("memory per session (bytes)", report["memory"]["session_store_bytes_per_session"], args.max_session_bytes, "max"),
+        ("throughput (turns/s)", report["throughput_turns_per_s"], args.min_throughput, "min"),
+    ]
+    violations = []
+    for label, value, limit, kind in checks:
+        if limit is None:
+            continue
+        if value is None or (value > limit if kind == "max" else value < limit):
+            violations.append(f"{label}: {value} ({kind} {limit})")
+    return violations
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load / soak test for the protein concierge turn pipeline.")
+    parser.add_argument("--sessions", type=int, default=20, help="同時セッション数")
+    parser.add_argument("--turns", type=int, default=3, help="セッションあたりのターン数（--duration 指定時は無視）")
+    parser.add_argument("--duration", type=float, default=None, help="耐久試験の秒数（指定すると、この時間だけ質問を続けます）")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="全セッションが開始するまでの秒数")
+    parser.add_argument("--think-time", type=float, default=0.5, help="ターン間にユーザーが考える時間の平均（秒）")
+    parser.add_argument("--catalog-size", type=int, default=10_000, help="合成カタログの件数")
+    parser.add_argument("--sheet-update-interval", type=float, default=None, help="シートの行を書き換える間隔（秒）")
+    parser.add_argument("--analyzer-latency", type=float, default=0.8, help="分析官AIの応答までの秒数")
+    parser.add_argument("--first-token-latency", type=float, default=0.4, help="コピーライターの最初のトークンまでの秒数")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="コピーライターのチャンクの到着速度（チャンク/秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Gemini 呼び出しが失敗する確率")
+    parser.add_argument("--error-code", type=int, default=429, help="注入するエラーのコード（429 / 504 など）")
+    parser.add_argument("--quota-rps", type=float, default=None, help="偽の Gemini の割り当て（1秒あたりの件数。超えると 429）")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="応答が5倍遅くなる確率")
+    parser.add_argument("--scheduler-rpm", type=float, default=gemini_scheduler.REQUESTS_PER_MINUTE, help="スケジューラーの1分あたりの上限")
+    parser.add_argument("--max-in-flight", type=int, default=gemini_scheduler.MAX_CONCURRENT, help="スケジューラーの同時実行数の上限")
+    parser.add_argument("--writer-cache", action="store_true", help="最初のターンのコピーライターの応答キャッシュを有効にする")
+    parser.add_argument("--click-rate", type=float, default=0.0, help="2ターン目以降に、提案ボタンを押す確率")
+    parser.add_argument("--prefetch", action="store_true", help="提案ボタンの先読みを有効にする")
+    parser.add_argument("--vary-suggestions", action="store_true", help="偽のコピーライターの提案を、応答ごとに違う文言にする")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", default=None, help="結果を JSON で書き出すパス")
+    parser.add_argument("--trace", dest="trace_path", default=None, help="各ターンのトレースを JSONL で書き出すパス")
+    parser.add_argument("--verbose", action="store_true", help="モジュールが stderr に出すログを表示する")
+    parser.add_argument("--max-ttft-p95-ms", type=float, default=None)
+    parser.add_argument("--max-ttft-p99-ms", type=float, default=None)
+    parser.add_argument("--max-total-p95-ms", type=float, default=None)
+    parser.add_argument("--max-error-rate", type=float, default=None)
+    parser.add_argument("--max-session-bytes", type=float, default=None)
+    parser.add_argument("--min-throughput", type=float, default=None)
+    return parser.parse_args(argv)
+
+
+def run_load_test(args):
+    """負荷試験を1回実行し、結果の辞書を返す。"""
+    model = FakeGeminiModel(
+        analyzer_latency=args.analyzer_latency,
+        first_token_latency=args.first_token_latency,
+        token_interval=1.0 / args.tokens_per_sec if args.tokens_per_sec > 0 else 0.0,
+        error_rate=args.error_rate,
+        error_code=args.error_code,
+        seed=args.seed,
+        quota_per_second=args.quota_rps,
+        slow_rate=args.slow_rate,
+        vary_suggestions=args.vary_suggestions,
+    )
+    scheduler = gemini_scheduler.GeminiScheduler(requests_per_minute=args.scheduler_rpm, max_concurrent=args.max_in_flight, seed=args.seed)
+    records = make_synthetic_records(args.catalog_size, seed=args.seed)
+    source = FakeSheetsSource(records)
+
+    with tempfile.TemporaryDirectory(prefix="concierge-loadtest-") as tmp:
+        store = catalog_store.CatalogStore(source, snapshot_path=os.path.join(tmp, 'catalog.arrow'))
+        sessions = session_store.SessionStore(db_path=os.path.join(tmp, 'sessions.sqlite3'))
+        results = LoadTestResults()
+        # ステージごとの内訳（どこを次に最適化すべきか）を出すため、全ターンのトレースを集めます
+        recorder = tracing.TraceRecorder(path=args.trace_path, window=1_000_000)
+        counter = {"snapshot_swaps": 0}
+        stop_event = threading.Event()
+        gemini_client.set_model_override(model)
+        gemini_scheduler.set_scheduler(scheduler)
+        cache_enabled = writer_cache.WRITER_CACHE_ENABLED
+        writer_cache.WRITER_CACHE_ENABLED = args.writer_cache
+        writer_cache.get_shared_cache().clear()
+        prefetch_enabled = prefetch.PREFETCH_ENABLED
+        prefetch.PREFETCH_ENABLED = args.prefetch
+        prefetch_before = prefetch.stats()
+        log_sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stderr(io.StringIO())
+        if not args.verbose:
+            # 負荷試験のスレッドには Streamlit の実行コンテキストがないため、その警告も抑えます
+            logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+        try:
+            with log_sink:
+                store.load()
+                rss_before = _rss_bytes()
+                updater = None
+                if args.sheet_update_interval:
+                    updater = threading.Thread(
+                        target=sheet_updater, args=(source, store, records, args.sheet_update_interval, stop_event, counter), daemon=True
+                    )
+                    updater.start()
+
+                start = time.perf_counter()
+                deadline = time.monotonic() + args.duration if args.duration else None
+                threads = [
+                    threading.Thread(target=run_session, args=(i, args, store, sessions, results, recorder, deadline), name=f"loadtest-session-{i}")
+                    for i in range(args.sessions)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+                stop_event.set()
+                if updater is not None:
+                    updater.join()
+                rss_after = _rss_bytes()
+                memory = sessions.memory_report()
+        finally:
+            gemini_client.set_model_override(None)
+            gemini_scheduler.set_scheduler(None)
+            writer_cache.WRITER_CACHE_ENABLED = cache_enabled
+            prefetch.PREFETCH_ENABLED = prefetch_enabled
+
+    model_calls = sum(model.calls.values())
+    prefetch_after = prefetch.stats()
+    prefetch_counts = {key: round(prefetch_after[key] - prefetch_before[key], 1) for key in prefetch_before if key not in ("hit_rate", "waste_rate")}
+    resolved = prefetch_counts["hits"] + prefetch_counts["misses"]
+    return {
+        "sessions": args.sessions,
+        "turns": results.turns,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_turns_per_s": round(results.turns / elapsed, 2) if elapsed else None,
+        "ttft_ms": _percentiles(results.ttft_ms),
+        "total_ms": _percentiles(results.total_ms),
+        "failed_turns": results.failed_turns,
+        "degraded_turns": results.degraded_turns,
+        "error_rate": round((results.failed_turns + results.degraded_turns) / results.turns, 4) if results.turns else None,
+        "failures": results.failures,
+        "gemini": {
+            "analyzer_calls": model.calls["analyzer"], "writer_calls": model.calls["writer"],
+            "injected_errors": dict(model.errors), "server_throttled": dict(model.throttled),
+            "scheduler": {key: round(value, 1) for key, value in scheduler.snapshot().items()},
+            "analyzer_call_ratio": round(model.calls["analyzer"] / results.turns, 3) if results.turns else None,
+            "total_calls": model_calls,
+        },
+        "stages": recorder.stage_percentiles().to_dict(orient="records"),
+        "intent": recorder.attribute_summary(),
+        "writer_cache": dict(writer_cache.get_shared_cache().stats, enabled=args.writer_cache),
+        "prefetch": dict(
+            prefetch_counts, enabled=args.prefetch, click_rate=args.click_rate,
+            hit_rate=round(prefetch_counts["hits"] / resolved, 3) if resolved else None,
+            waste_rate=round(prefetch_counts["wasted"] / prefetch_counts["started"], 3) if prefetch_counts["started"] else None,
+        ),
+        "catalog": {"rows": args.catalog_size, "snapshot_swaps": counter["snapshot_swaps"]},
+        "memory": {
+            "session_store_bytes_per_session": round(memory["hot_bytes_per_session"]),
+            "session_store_bytes_max": memory["hot_bytes_max"],
+            "rss_growth_bytes": rss_after - rss_before,
+            "rss_growth_bytes_per_session": round((rss_after - rss_before) / max(args.sessions, 1)),
+        },
+    }
+
+
+def print_report(report):
+    print(f"sessions: {report['sessions']}, turns: {report['turns']}, elapsed: {report['elapsed_s']} s, "
+          f"throughput: {report['throughput_turns_per_s']} turns/s")
+    for label, key in (("TTFT (ms)", "ttft_ms"), ("turn total (ms)", "total_ms")):
+        p = report[key]
+        print(f"{label:>16}: p50 {p['p50']}  p95 {p['p95']}  p99 {p['p99']}  max {p['max']}")
+    gemini = report["gemini"]
+    print(f"errors: failed {report['failed_turns']}, degraded {report['degraded_turns']} (rate {report['error_rate']}), "
+          f"injected {gemini['injected_errors']}")
+    print(f"gemini calls: analyzer {gemini['analyzer_calls']} ({gemini['analyzer_call_ratio']} per turn), writer {gemini['writer_calls']}, "
+          f"server 429s {gemini['server_throttled']}")
+    scheduler = gemini["scheduler"]
+    print(f"scheduler: retries {scheduler['retries']}, failures {scheduler['failures']}, hedges {scheduler['hedges']} (won {scheduler['hedge_wins']}), "
+          f"queue wait avg {scheduler['avg_queue_wait_ms']} ms / max {scheduler['max_queue_wait_ms']} ms")
+    if report["writer_cache"]["enabled"]:
+        cache = report["writer_cache"]
+        print(f"writer cache: hits {cache['hits']}, misses {cache['misses']}, stored {cache['stores']}, "
+              f"rejected {cache['rejected']}, invalidations {cache['invalidations']}")
+    if report["prefetch"]["enabled"]:
+        pf = report["prefetch"]
+        print(f"prefetch: started {pf['started']:.0f}, hit rate {pf['hit_rate']} ({pf['hits']:.0f} hits, {pf['waited']:.0f} waited, {pf['misses']:.0f} misses), "
+              f"wasted {pf['wasted']:.0f} (rate {pf['waste_rate']}, analyzer calls {pf['wasted_analyzer_calls']:.0f}), cancelled {pf['cancelled']:.0f}, "
+              f"saved {pf['saved_ms'] / 1000:.1f} s")
+    print(f"catalog: {report['catalog']['rows']:,} rows, snapshot swaps during run: {report['catalog']['snapshot_swaps']}")
+    memory = report["memory"]
+    print(f"memory: session store {memory['session_store_bytes_per_session']:,} B/session (max {memory['session_store_bytes_max']:,} B), "
+          f"RSS growth {memory['rss_growth_bytes'] / 1e6:.1f} MB ({memory['rss_growth_bytes_per_session']:,} B/session)")
+    print("stage breakdown:")
+    for row in report["stages"]:
+        print(f"  {row['span']:>14}: n={row['count']:<5} p50 {row['p50 (ms)']:>8}  p95 {row['p95 (ms)']:>8}  p99 {row['p99 (ms)']:>8}")
+    print(f"intent sources: {report['intent']['intent_sources']}, avg tokens: {report['intent']['avg_tokens']}")
+    for failure in report["failures"]:
+        print(f"  failure: {failure}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run_load_test(args)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    violations = check_thresholds(report, args)
+    if violations:
+        print("FAILED thresholds:")
+        for violation in violations:
+            print(f"  - {violation}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
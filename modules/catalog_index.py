@@ -0,0 +1,126 @@
+# modules/catalog_index.py
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from modules import catalog_store
+
+# key_metric で並べ替えに使う数値列と、その並び順（True: 昇順 = 小さいほど良い）
+METRIC_SORT_ASCENDING = {
+    'ProteinPurity(%)': False,
+    'ProteinPerServing(g)': False,
+    'PricePerKg(JPY)': True,
+    'FatPerServing(g)': True,
+    'CarbPerServing(g)': True,
+    'Solubility': False,
+}
+
+
+class CatalogIndex:
+    """
+    カタログのスナップショットごとに1度だけ作る、並べ替え済みの位置インデックス。
+
+    各指標について「良い順に並べた行位置の配列」を事前に計算しておくことで、
+    チャットのたびに DataFrame のコピーや sort_values を行わずに、上位k件を取り出せます。
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.product_ids = df['ProductID'].to_numpy() if 'ProductID' in df.columns else np.array([], dtype=object)
+
+        # ProductID -> 行位置（重複がある場合は最初の行を採用。以前の .iloc[0] と同じ挙動です）
+        self._position_by_id = {}
+        for position, product_id in enumerate(self.product_ids):
+            self._position_by_id.setdefault(product_id, position)
+
+        # ブランド -> そのブランドの最初の行位置
+        self._first_position_by_brand = {}
+        if 'Brand' in df.columns:
+            for position, brand in enumerate(df['Brand'].to_numpy()):
+                self._first_position_by_brand.setdefault(brand, position)
+
+        # 指標ごとの並べ替え済み位置配列（欠損値は常に末尾）
+        self._orders = {}
+        for col, ascending in METRIC_SORT_ASCENDING.items():
+            if col not in df.columns:
+                continue
+            values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype='float64')
+            keys = values if ascending else -values
+            self._orders[col] = np.argsort(keys, kind='stable')
+
+    def __len__(self) -> int:
+        return len(self.product_ids)
+
+    def has_metric(self, col: Optional[str]) -> bool:
+        return col in self._orders
+
+    def position_of(self, product_id) -> Optional[int]:
+        return self._position_by_id.get(product_id)
+
+    def product_row(self, product_id) -> Optional[pd.Series]:
+        """ProductIDに一致する行（Series）を返す。見つからなければ None。"""
+        position = self.position_of(product_id)
+        return None if position is None else self.df.iloc[position]
+
+    def first_row_of_brand(self, brand) -> Optional[pd.Series]:
+        position = self._first_position_by_brand.get(brand)
+        return None if position is None else self.df.iloc[position]
+
+    def top_k(self, col: str, k: int, exclude_ids: Iterable = (), mask: Optional[np.ndarray] = None) -> List[int]:
+        """
+        指標 col の良い順に、上位 k 件の行位置を返す。
+        exclude_ids（ベースライン商品など）は除外し、mask が与えられた場合は True の行だけを対象にします。
+        除外するのは高々数件なので、走査は上位から k + 除外件数 程度で終わります。
+        """
+        excluded = {self._position_by_id[pid] for pid in exclude_ids if pid in self._position_by_id}
+        result = []
+        for position in self._orders[col]:
+            if position in excluded:
+                continue
+            if mask is not None and not mask[position]:
+                continue
+            result.append(int(position))
+            if len(result) >= k:
+                break
+        return result
+
+    def take(self, positions: List[int]) -> pd.DataFrame:
+        """行位置のリストから、提案用の小さな DataFrame を作る。"""
+        return self.df.iloc[positions]
+
+
+def get_catalog_index(protein_df: pd.DataFrame) -> CatalogIndex:
+    """カタログのスナップショットに対応する CatalogIndex を返す（スナップショットごとに1度だけ作成）。"""
+    return catalog_store.get_per_snapshot('catalog_index', protein_df, CatalogIndex)
+
+
+class BrandOptions:
+    """
+    診断フォームの Q2 の選択肢（ブランドの一覧と、ブランドごとの商品の一覧）。
+    カタログのスナップショットごとに1度だけ作り、フォームの再実行のたびに unique や絞り込みを行わずに済ませます。
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self._products_by_brand: Dict[str, List[Tuple[str, str]]] = {}
+        self._position_in_brand: Dict[str, int] = {}
+        if all(col in df.columns for col in ('Brand', 'ProductName', 'ProductID')):
+            for brand, name, product_id in zip(df['Brand'].to_numpy(), df['ProductName'].to_numpy(), df['ProductID'].to_numpy()):
+                products = self._products_by_brand.setdefault(brand, [])
+                self._position_in_brand.setdefault(product_id, len(products))
+                products.append((name, product_id))
+        self.brands = sorted(self._products_by_brand)
+
+    def products(self, brand) -> List[Tuple[str, str]]:
+        """ブランドの (商品名, ProductID) のリスト（シート上の順）。"""
+        return self._products_by_brand.get(brand, [])
+
+    def position_in_brand(self, product_id) -> Optional[int]:
+        """products(brand) の中での、商品の位置。"""
+        return self._position_in_brand.get(product_id)
+
+
+def get_brand_options(protein_df: pd.DataFrame) -> BrandOptions:
+    """カタログのスナップショットに対応する BrandOptions を返す（スナップショットごとに1度だけ作成）。"""
+    return catalog_store.get_per_snapshot('brand_options', protein_df, BrandOptions)
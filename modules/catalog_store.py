@@ -0,0 +1,389 @@
+# modules/catalog_store.py
+
+import hashlib
+import os
+import sys
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# ローカルに保存するスナップショットの場所（Arrow IPC形式。メモリマップで読み込めるよう非圧縮で保存します）
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'catalog_snapshot.arrow')
+
+# バックグラウンド同期の間隔（秒）。以前の load_data の ttl=600 と同じ値です。
+DEFAULT_SYNC_INTERVAL = 600
+
+# カタログのスキーマの版。スナップショットのメタデータに記録し、古い版のスナップショットは読み込み時に変換し直します。
+SCHEMA_VERSION = '2'
+
+# 数値として扱う列。シート上で文字列や空欄になっていても、ここで float32 に揃えます。
+NUMERIC_COLUMNS = [
+    'ProteinPerServing(g)', 'ServingSize(g)', 'Price(JPY)', 'WeightInKg', 'PricePerKg(JPY)',
+    'FatPerServing(g)', 'CarbPerServing(g)', 'Solubility', 'ProteinPurity(%)', 'PricePerProteinGram(JPY)',
+]
+METRIC_DTYPE = 'float32'
+# 値の種類が少ない文字列の列。カテゴリ型にして、同じ文字列を1つにまとめます（PersonaTags はタグの組み合わせ単位）。
+CATEGORICAL_COLUMNS = ['Brand', 'Flavor', 'PersonaTags']
+# 空欄の行は取り込まない列
+REQUIRED_COLUMNS = ['ProductID', 'Brand', 'ProductName']
+# 0 より大きくなければならない列（空欄は可）
+POSITIVE_COLUMNS = ['ServingSize(g)', 'WeightInKg']
+# 数値のセルに含まれていても読み飛ばす文字（桁区切りのカンマ・通貨記号・空白）
+NUMBER_NOISE = r'[,\s¥￥円]'
+
+KEY_COLUMN = 'ProductID'
+
+# 取り込まなかった行がこの割合を超えた場合（全ての行を取り込めなかった場合を含む）は、シートの形式の変更などを疑い、
+# 新しいスナップショットを公開せずに、手元のスナップショットのまま動き続けます
+MAX_QUARANTINE_FRACTION = 0.5
+
+
+def _parse_numeric(series: pd.Series):
+    """列を数値に変換し、(float64 の列, 空欄ではないのに数値として読めなかったセルのマスク) を返す。"""
+    # pandas 3 では文字列だけの列が object ではなく str 型になるため、数値型以外は全て文字列として扱います
+    if not pd.api.types.is_numeric_dtype(series):
+        text = series.astype(str).str.replace(NUMBER_NOISE, '', regex=True)
+        blank = series.isna() | text.eq('')
+        values = pd.to_numeric(text.where(~blank), errors='coerce')
+    else:
+        blank = series.isna()
+        values = pd.to_numeric(series, errors='coerce')
+    values = values.astype('float64')
+    return values, (values.isna() & ~blank).to_numpy()
+
+
+def apply_schema(df: pd.DataFrame, quarantine: Optional[List[Dict[str, Any]]] = None) -> pd.DataFrame:
+    """
+    カタログDataFrameをスキーマに揃える関数。
+
+    - 数値の列は float32、Brand / Flavor / PersonaTags はカテゴリ型、それ以外の列は文字列にします。
+    - ProteinPurity(%) と PricePerProteinGram(JPY)（タンパク質1gあたりの価格）は、ここで計算します。
+      PricePerKg(JPY) が空欄の場合は、Price(JPY) と WeightInKg から補います。
+    - 不正な行（ProductIDの欠落・重複、数値として読めないセル、負の値、タンパク質量が1食の量を超えるなど）は取り込みません。
+      quarantine にリストを渡すと、取り込まなかった行の {"row": シートの行番号, "ProductID", "reasons"} を追加します。
+    """
+    if df.empty:
+        return df
+    df = df.reset_index(drop=True)
+    reasons: Dict[int, List[str]] = {}
+
+    def reject(mask, reason):
+        for position in np.flatnonzero(mask):
+            reasons.setdefault(int(position), []).append(reason)
+
+    numeric = {}
+    for col in df.columns:
+        if col in NUMERIC_COLUMNS:
+            numeric[col], invalid = _parse_numeric(df[col])
+            reject(invalid, f"invalid number in {col}")
+            reject((numeric[col] < 0).to_numpy(), f"negative {col}")
+        else:
+            df[col] = df[col].astype(object).fillna('').astype(str).str.strip()
+
+    for col in REQUIRED_COLUMNS:
+        if col in df.columns:
+            reject(df[col].eq('').to_numpy(), f"missing {col}")
+    if KEY_COLUMN in df.columns:
+        reject((df[KEY_COLUMN].ne('') & df[KEY_COLUMN].duplicated()).to_numpy(), f"duplicate {KEY_COLUMN}")
+    for col in POSITIVE_COLUMNS:
+        if col in numeric:
+            reject((numeric[col] == 0).to_numpy(), f"{col} must be positive")
+
+    # 派生指標（float64 で計算してから float32 にします）
+    protein, serving = numeric.get('ProteinPerServing(g)'), numeric.get('ServingSize(g)')
+    if protein is not None and serving is not None:
+        reject((protein > serving).to_numpy(), "ProteinPerServing(g) exceeds ServingSize(g)")
+        numeric['ProteinPurity(%)'] = protein / serving.where(serving > 0) * 100
+    if 'Price(JPY)' in numeric and 'WeightInKg' in numeric:
+        derived = numeric['Price(JPY)'] / numeric['WeightInKg'].where(numeric['WeightInKg'] > 0)
+        numeric['PricePerKg(JPY)'] = numeric['PricePerKg(JPY)'].fillna(derived.round(0)) if 'PricePerKg(JPY)' in numeric else derived.round(0)
+    if 'PricePerKg(JPY)' in numeric and 'ProteinPurity(%)' in numeric:
+        # 1kg あたりの価格 ÷ 1kg に含まれるタンパク質のグラム数
+        numeric['PricePerProteinGram(JPY)'] = numeric['PricePerKg(JPY)'] / (numeric['ProteinPurity(%)'] * 10).where(numeric['ProteinPurity(%)'] > 0)
+
+    for col, values in numeric.items():
+        df[col] = values.astype(METRIC_DTYPE)
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
+    if reasons:
+        rejected = sorted(reasons)
+        if quarantine is not None:
+            product_ids = df[KEY_COLUMN].to_numpy() if KEY_COLUMN in df.columns else [''] * len(df)
+            # シートの1行目は見出しなので、レコードの位置 + 2 がシート上の行番号です
+            quarantine.extend({"row": position + 2, "ProductID": product_ids[position], "reasons": reasons[position]} for position in rejected)
+        df = df.drop(index=rejected).reset_index(drop=True)
+        for col in CATEGORICAL_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].cat.remove_unused_categories()
+    return df
+
+
+def prepare_catalog(records: List[Dict[str, Any]], quarantine: Optional[List[Dict[str, Any]]] = None) -> pd.DataFrame:
+    """
+    シートから取得したレコードを、スキーマに揃ったカタログDataFrameに変換する関数（詳細は apply_schema）。
+    （以前 app.load_data で行っていた ProteinPurity(%) の計算もここで行います）
+    """
+    return apply_schema(pd.DataFrame(records), quarantine)
+
+
+def check_quarantine(total: int, df: pd.DataFrame, quarantine: List[Dict[str, Any]], max_fraction: float = MAX_QUARANTINE_FRACTION) -> None:
+    """取り込めた行がない、または取り込まなかった行が max_fraction を超える場合に RuntimeError を送出する。"""
+    if total and (df.empty or len(quarantine) / total > max_fraction):
+        raise RuntimeError(f"refusing to publish catalog snapshot: {len(quarantine)} of {total} rows were quarantined")
+
+
+def compute_row_hashes(df: pd.DataFrame) -> pd.Series:
+    """ProductIDごとの行ハッシュ（uint64）を返す関数。行の差分検出に使います。"""
+    if df.empty or KEY_COLUMN not in df.columns:
+        return pd.Series(dtype='uint64')
+    hashes = pd.util.hash_pandas_object(df, index=False)
+    hashes.index = df[KEY_COLUMN].values
+    return hashes
+
+
+def diff_rows(old_hashes: pd.Series, new_hashes: pd.Series) -> Dict[str, List[str]]:
+    """
+    新旧の行ハッシュを比較し、追加・変更・削除されたProductIDを返す関数。
+    """
+    old_ids = set(old_hashes.index)
+    new_ids = set(new_hashes.index)
+    common = [pid for pid in new_hashes.index if pid in old_ids]
+    changed = [pid for pid in common if old_hashes[pid] != new_hashes[pid]]
+    return {
+        "added": [pid for pid in new_hashes.index if pid not in old_ids],
+        "changed": changed,
+        "removed": [pid for pid in old_hashes.index if pid not in new_ids],
+    }
+
+
+def compute_snapshot_version(row_hashes: pd.Series) -> str:
+    """行ハッシュの並びから、スナップショットの内容バージョン（短いハッシュ文字列）を作る関数。"""
+    digest = hashlib.sha1()
+    digest.update(pd.Index(row_hashes.index).astype(str).str.cat(sep='\x1f').encode('utf-8'))
+    digest.update(row_hashes.to_numpy(dtype='uint64').tobytes())
+    return digest.hexdigest()[:16]
+
+
+def snapshot_version(df: pd.DataFrame) -> str:
+    """DataFrameに付与されたスナップショットのバージョンを返す関数。未付与の場合は内容から計算します。"""
+    version = df.attrs.get('snapshot_version')
+    if version:
+        return version
+    return compute_snapshot_version(compute_row_hashes(df))
+
+
+def write_snapshot(df: pd.DataFrame, path: str, metadata: Dict[str, str]) -> None:
+    """
+    スナップショットを一時ファイルに書き出してから os.replace で置き換える関数。
+    読み込み中のプロセスが、書きかけのファイルを見ることはありません。
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    schema_metadata = dict(table.schema.metadata or {})
+    metadata = dict({'schema_version': SCHEMA_VERSION}, **metadata)
+    schema_metadata.update({k.encode('utf-8'): v.encode('utf-8') for k, v in metadata.items()})
+    table = table.replace_schema_metadata(schema_metadata)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str) -> Optional[pd.DataFrame]:
+    """
+    スナップショットをメモリマップで読み込む関数。ファイルがなければ None を返します。
+    """
+    if not os.path.exists(path):
+        return None
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    metadata = {k.decode('utf-8'): v.decode('utf-8') for k, v in (table.schema.metadata or {}).items()}
+    df = table.to_pandas()
+    df.attrs['snapshot_version'] = metadata.get('snapshot_version', '')
+    df.attrs['source_revision'] = metadata.get('source_revision', '')
+    df.attrs['schema_version'] = metadata.get('schema_version', '')
+    return df
+
+
+class CatalogStore:
+    """
+    商品カタログのローカルスナップショットを管理するクラス。
+
+    - 起動時はローカルのスナップショットを読み込むだけなので、Sheetsの往復を待ちません。
+    - バックグラウンドのスレッドがシートの更新（リビジョン）を確認し、変更があった場合のみ
+      行を取得・差分検出して、新しいスナップショットへアトミックに差し替えます。
+    - source には get_revision() と get_records() を持つオブジェクトを渡します
+      （本番は google_sheets_client.GoogleSheetsSource、検証時は fake_backends.FakeSheetsSource）。
+    """
+
+    def __init__(self, source, snapshot_path: str = SNAPSHOT_PATH, sync_interval: float = DEFAULT_SYNC_INTERVAL):
+        self._source = source
+        self._snapshot_path = snapshot_path
+        self._sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._df = pd.DataFrame()
+        self._row_hashes = pd.Series(dtype='uint64')
+        self._revision = None
+        # 直近の同期で取り込まなかった行（apply_schema の quarantine）
+        self.quarantine: List[Dict[str, Any]] = []
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def current(self) -> pd.DataFrame:
+        """現在のスナップショットを返す。差し替えは参照の入れ替えだけなので、ロックは短時間で済みます。"""
+        with self._lock:
+            return self._df
+
+    @property
+    def version(self) -> str:
+        with self._lock:
+            return self._df.attrs.get('snapshot_version', '')
+
+    def load(self) -> pd.DataFrame:
+        """
+        コールドスタート処理。ローカルのスナップショットがあればそれを使い、
+        なければ（初回起動時のみ）同期的にシートから取得します。
+        """
+        try:
+            df = read_snapshot(self._snapshot_path)
+        except Exception as e:
+            print(f"--- [WARNING] Failed to read local catalog snapshot: {e} ---", file=sys.stderr)
+            df = None
+
+        if df is not None and not df.empty and df.attrs.get('schema_version') != SCHEMA_VERSION:
+            # 古いスキーマのスナップショットは、シートを待たずにその場で変換して書き直します
+            try:
+                df = self._upgrade_snapshot(df)
+            except Exception as e:
+                print(f"--- [WARNING] Failed to upgrade local catalog snapshot: {e} ---", file=sys.stderr)
+                df = None
+
+        if df is not None and not df.empty:
+            self._swap(df, compute_row_hashes(df), df.attrs.get('source_revision') or None)
+            print(f"--- [SUCCESS] Loaded local catalog snapshot ({len(df)} rows, version {self.version}). ---", file=sys.stderr)
+            return self.current()
+
+        try:
+            self.sync_once()
+        except Exception as e:
+            print(f"--- [CRITICAL ERROR] Initial catalog sync failed: {e} ---", file=sys.stderr)
+        return self.current()
+
+    def sync_once(self) -> Optional[Dict[str, List[str]]]:
+        """
+        シートと1回同期する。リビジョンが変わっていなければ行の取得自体を省略します。
+        変更があった場合は差分（added/changed/removed）を返し、なければ None を返します。
+        """
+        revision = self._source.get_revision()
+        with self._lock:
+            unchanged = revision is not None and revision == self._revision and not self._df.empty
+            old_hashes = self._row_hashes
+        if unchanged:
+            return None
+
+        quarantine: List[Dict[str, Any]] = []
+        records = self._source.get_records()
+        new_df = prepare_catalog(records, quarantine)
+        self._report_quarantine(quarantine)
+        check_quarantine(len(records), new_df, quarantine)
+        new_hashes = compute_row_hashes(new_df)
+        diff = diff_rows(old_hashes, new_hashes)
+        order_changed = list(old_hashes.index) != list(new_hashes.index)
+
+        if not any(diff.values()) and not order_changed and not self.current().empty:
+            # 書式変更などでリビジョンだけが進んだ場合は、スナップショットを作り直しません
+            with self._lock:
+                self._revision = revision
+            return None
+
+        version = compute_snapshot_version(new_hashes)
+        new_df.attrs['snapshot_version'] = version
+        new_df.attrs['source_revision'] = revision or ''
+        write_snapshot(new_df, self._snapshot_path, {'snapshot_version': version, 'source_revision': revision or ''})
+
+        # 書き出したファイルをメモリマップで読み直し、それを新しいスナップショットとして差し替えます
+        snapshot_df = read_snapshot(self._snapshot_path)
+        self._swap(snapshot_df, new_hashes, revision)
+        print(
+            f"--- [SUCCESS] Catalog snapshot updated to {version} "
+            f"(+{len(diff['added'])} ~{len(diff['changed'])} -{len(diff['removed'])}). ---",
+            file=sys.stderr
+        )
+        return diff
+
+    def _upgrade_snapshot(self, df: pd.DataFrame) -> pd.DataFrame:
+        revision = df.attrs.get('source_revision', '')
+        quarantine: List[Dict[str, Any]] = []
+        total = len(df)
+        df = apply_schema(df, quarantine)
+        self._report_quarantine(quarantine)
+        check_quarantine(total, df, quarantine)
+        version = compute_snapshot_version(compute_row_hashes(df))
+        write_snapshot(df, self._snapshot_path, {'snapshot_version': version, 'source_revision': revision})
+        return read_snapshot(self._snapshot_path)
+
+    def _report_quarantine(self, quarantine: List[Dict[str, Any]]) -> None:
+        self.quarantine = quarantine
+        if quarantine:
+            sample = ", ".join(f"row {item['row']} ({'; '.join(item['reasons'])})" for item in quarantine[:5])
+            print(f"--- [WARNING] Skipped {len(quarantine)} invalid catalog rows: {sample}{' ...' if len(quarantine) > 5 else ''} ---", file=sys.stderr)
+
+    def start_background_sync(self) -> None:
+        """バックグラウンド同期スレッドを開始する（既に動いていれば何もしません）。"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._sync_loop, name="catalog-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _sync_loop(self) -> None:
+        while not self._stop_event.wait(self._sync_interval):
+            try:
+                self.sync_once()
+            except Exception as e:
+                # シートが落ちていても、手元のスナップショットで動き続けます
+                print(f"--- [WARNING] Background catalog sync failed, keeping current snapshot: {e} ---", file=sys.stderr)
+
+    def _swap(self, df: pd.DataFrame, row_hashes: pd.Series, revision: Optional[str]) -> None:
+        with self._lock:
+            self._df = df
+            self._row_hashes = row_hashes
+            self._revision = revision
+
+
+# --- スナップショット単位のキャッシュ ---
+# インデックスなど「カタログが変わらない限り作り直す必要がないもの」を、
+# スナップショットのバージョンごとに1つだけ保持します。
+_per_snapshot_cache: Dict[Any, Any] = {}
+_per_snapshot_lock = threading.Lock()
+
+
+def get_per_snapshot(name: str, df: pd.DataFrame, builder):
+    """
+    name と df のスナップショットバージョンをキーに、builder(df) の結果をキャッシュして返す関数。
+    同じ name の古いバージョンの結果は、新しい結果を保存する時点で破棄されます。
+    （df にはカタログ全体を渡してください。絞り込んだ部分集合を渡すと、attrsが引き継がれて誤ったキーになります）
+    """
+    key = (name, snapshot_version(df), len(df))
+    with _per_snapshot_lock:
+        if key in _per_snapshot_cache:
+            return _per_snapshot_cache[key]
+
+    value = builder(df)
+
+    with _per_snapshot_lock:
+        for stale_key in [k for k in _per_snapshot_cache if k[0] == name and k != key]:
+            del _per_snapshot_cache[stale_key]
+        _per_snapshot_cache[key] = value
+    return value
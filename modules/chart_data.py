@@ -0,0 +1,146 @@
+# modules/chart_data.py
+
+import copy
+import json
+import math
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from modules import catalog_index
+from modules import catalog_store
+from modules import scoring_engine
+
+X_COL = 'PricePerKg(JPY)'
+Y_COL = 'ProteinPurity(%)'
+
+# ポジションマップの背景レイヤーに描く点の上限。これを超えるカタログは、格子で間引いてから送ります。
+MAX_BASE_POINTS = 3000
+# 間引きに使う格子の分割数（横 × 縦）。格子1マスにつき1点を代表として残します。
+GRID_BINS = (80, 50)
+
+HIGHLIGHT_DOMAIN = ['現在の商品', 'AIの提案', 'その他の商品']
+HIGHLIGHT_RANGE = ['#1f77b4', '#2ca02c', 'lightgray']  # 青, 緑, グレー
+
+# ブラウザに送るデータの列名は、ペイロードを小さくするため1文字にします
+# 横軸は右に行くほど安くなるよう逆向きにします（コピーライターのプロンプトの「右に行くほど安い」という説明と合わせています）
+_X_AXIS = {"field": "x", "type": "quantitative", "title": "価格 (円/kg) 安い→", "scale": {"zero": False}, "sort": "descending"}
+_Y_AXIS = {"field": "y", "type": "quantitative", "title": "タンパク質含有率 (%) ↑高い", "scale": {"zero": False}}
+_TOOLTIP = [
+    {"field": "b", "type": "nominal", "title": "Brand"},
+    {"field": "n", "type": "nominal", "title": "ProductName"},
+    {"field": "x", "type": "quantitative", "title": X_COL, "format": ",.0f"},
+    {"field": "y", "type": "quantitative", "title": Y_COL, "format": ".1f"},
+]
+_COLOR_SCALE = {"domain": HIGHLIGHT_DOMAIN, "range": HIGHLIGHT_RANGE}
+
+
+def downsample_positions(x: np.ndarray, y: np.ndarray, max_points: int = MAX_BASE_POINTS, bins=GRID_BINS, keep: Iterable[int] = ()) -> np.ndarray:
+    """
+    散布図の点を、見た目の分布を保ったまま max_points 程度に間引く関数（詳細度による間引き）。
+    x, y の範囲を格子に分け、点のある格子ごとに最初の1点だけを残します。
+    keep で渡した行位置（パレート最適な商品など）は、必ず残します。
+    """
+    size = len(x)
+    if size <= max_points:
+        return np.arange(size)
+    x_span = (x.max() - x.min()) or 1.0
+    y_span = (y.max() - y.min()) or 1.0
+    x_bins = np.minimum(((x - x.min()) / x_span * bins[0]).astype(np.int64), bins[0] - 1)
+    y_bins = np.minimum(((y - y.min()) / y_span * bins[1]).astype(np.int64), bins[1] - 1)
+    _, first = np.unique(x_bins * bins[1] + y_bins, return_index=True)
+    selected = np.union1d(first, np.asarray(list(keep), dtype=np.int64))
+    if len(selected) > max_points:
+        # 格子が細かすぎた場合は、等間隔に間引いて上限に収めます（keep の点は残します）
+        keep_set = set(int(p) for p in keep)
+        rest = np.array([p for p in selected if p not in keep_set], dtype=np.int64)
+        step = math.ceil(len(rest) / max(max_points - len(keep_set), 1))
+        selected = np.union1d(rest[::step], np.asarray(sorted(keep_set), dtype=np.int64))
+    return selected
+
+
+def _records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """ブラウザに送る点の配列（1点 = {x, y, b, n}）を作る。数値は JSON にそのまま書ける型に揃えます。"""
+    return [
+        {"x": round(float(x), 1), "y": round(float(y), 2), "b": str(b), "n": str(n)}
+        for x, y, b, n in zip(df[X_COL].to_numpy(), df[Y_COL].to_numpy(), df['Brand'].to_numpy(), df['ProductName'].to_numpy())
+    ]
+
+
+class PositionMapData:
+    """
+    ポジションマップの背景レイヤー（全商品の散布図）を、カタログのスナップショットごとに1度だけ作るクラス。
+    セッションごとに変わるのは、ベースラインと提案商品だけを描く小さな重ね合わせのレイヤーだけです。
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.available = all(col in df.columns for col in (X_COL, Y_COL, 'Brand', 'ProductName'))
+        self.total_points = 0
+        self.base_points = 0
+        self.base_spec: Dict[str, Any] = {}
+        self.base_payload_bytes = 0
+        if not self.available:
+            return
+
+        x = pd.to_numeric(df[X_COL], errors='coerce').to_numpy(dtype='float64')
+        y = pd.to_numeric(df[Y_COL], errors='coerce').to_numpy(dtype='float64')
+        valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+        self.total_points = len(valid)
+
+        # パレート最適な商品（マップの「端」にあたる点）は、間引いても必ず残します
+        front = scoring_engine.get_scoring_engine(df).pareto_front()
+        position_in_valid = {int(p): i for i, p in enumerate(valid)}
+        keep = [position_in_valid[p] for p in front if p in position_in_valid]
+        sampled = valid[downsample_positions(x[valid], y[valid], keep=keep)]
+        self.base_points = len(sampled)
+
+        values = _records(df.iloc[sampled])
+        self.base_payload_bytes = len(json.dumps(values, ensure_ascii=False).encode('utf-8'))
+        self.base_spec = {
+            "title": '市場全体におけるあなたのプロテインの位置',
+            "layer": [{
+                "data": {"values": values},
+                "mark": {"type": "circle", "size": 100},
+                "encoding": {
+                    "x": _X_AXIS, "y": _Y_AXIS, "tooltip": _TOOLTIP,
+                    "color": {"datum": 'その他の商品', "type": "nominal", "title": "凡例", "scale": _COLOR_SCALE},
+                },
+                # ドラッグで移動、ホイールで拡大・縮小（以前の .interactive() と同じ）
+                "params": [{"name": "grid", "select": "interval", "bind": "scales"}],
+            }],
+        }
+
+    def overlay_values(self, protein_df: pd.DataFrame, baseline_id: Optional[str], recommend_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        """ベースラインと提案商品の点だけを作る（ProductID の検索は CatalogIndex を使います）。"""
+        index = catalog_index.get_catalog_index(protein_df)
+        points = []
+        for product_id, label in [(baseline_id, '現在の商品')] + [(pid, 'AIの提案') for pid in recommend_ids]:
+            row = index.product_row(product_id) if product_id else None
+            if row is None:
+                continue
+            x, y = row.get(X_COL), row.get(Y_COL)
+            # スキーマで float32 に揃えた列の値は np.float32 なので、np.number も数値として扱います
+            if not (isinstance(x, (int, float, np.number)) and isinstance(y, (int, float, np.number)) and math.isfinite(x) and math.isfinite(y)):
+                continue
+            points.append({"x": round(float(x), 1), "y": round(float(y), 2), "b": str(row.get('Brand', '')), "n": str(row.get('ProductName', '')), "h": label})
+        return points
+
+    def spec(self, overlay: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """背景レイヤー（キャッシュ済み）に、セッションごとの重ね合わせレイヤーを加えた Vega-Lite の仕様を返す。"""
+        spec = copy.copy(self.base_spec)
+        if overlay:
+            spec["layer"] = self.base_spec["layer"] + [{
+                "data": {"values": overlay},
+                "mark": {"type": "circle", "size": 160, "stroke": "white", "strokeWidth": 1},
+                "encoding": {
+                    "x": _X_AXIS, "y": _Y_AXIS, "tooltip": _TOOLTIP,
+                    "color": {"field": "h", "type": "nominal", "title": "凡例", "scale": _COLOR_SCALE},
+                },
+            }]
+        return spec
+
+
+def get_position_map_data(protein_df: pd.DataFrame) -> PositionMapData:
+    """カタログのスナップショットに対応する PositionMapData を返す（スナップショットごとに1度だけ作成）。"""
+    return catalog_store.get_per_snapshot('position_map', protein_df, PositionMapData)
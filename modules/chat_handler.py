@@ -1,99 +1,98 @@
 import streamlit as st
 import pandas as pd
+import itertools
 import json
 import re
 import sys
 
 # ▼▼▼【ここからが新しい構造です】▼▼▼
 # 新しく作成した専門家たちをインポートします
-from modules import gemini_client
-from modules import formatters
-from modules import nutrition_data
-from modules import protein_selector
+from modules import turn_pipeline
+from modules import render_cache
+from modules import session_store
+from modules import stream_parser
+from modules import tracing
+from modules import catalog_index
+from modules import ui_components
 # ▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲
 
+# セッションストアのメモリ使用量をログに出す間隔（プロセス全体のターン数）
+MEMORY_REPORT_EVERY_TURNS = 50
+_turn_counter = itertools.count(1)
+
 def handle_ai_response(protein_df: pd.DataFrame):
     """
     ユーザーからのプロンプトを受け取り、各専門家と連携してAIの応答を生成・管理する司令塔。
     """
     try:
-        # --- 1. ユーザー入力とペルソナの準備 ---
+        # --- 1〜5. 意図の分析・商品選定・情報整形・コピーライターへの依頼 ---
+        # (turn_pipeline専門家が、互いに依存しない処理を分析官AIの応答待ちと並行に進めます)
+        # 提案ボタンからの要望で、先読み（prefetch）が済んでいれば、意図の判定と商品選定を省略します
+        # (自由入力の場合は、このセッションの先読みはここで全て破棄されます)
+        prefetcher = st.session_state.get("prefetcher")
         prompt = st.session_state.messages[-1]["content"]
-        
-        # 最初の質問か、2回目以降かでAIに渡すプロンプトを整形
-        if len(st.session_state.messages) == 1:
-            persona_text = formatters.format_persona(st.session_state.persona)
-            full_user_prompt = f"{persona_text}\n\n**ユーザーの『乗り換えの決め手』:**\n{prompt}"
-        else:
-            full_user_prompt = prompt
-        
-        # --- 2. AI分析官による意図の分析 ---
-        # (gemini_clientは外部の専門家なので、そのまま呼び出します)
-        intent_json = gemini_client.get_intent_from_ai(full_user_prompt)
-        intent = json.loads(intent_json)
-        user_desire = intent.get("user_desire_summary", "総合的なおすすめ")
-
-        # --- 3. データ分析官による商品選定 ---
-        # (最も複雑なロジックを、protein_selector専門家に完全に委任します)
-        selected_products, baseline_product, selection_reason, key_metric_name_jp, key_metric_col_name = protein_selector.select_products(
-            protein_df, intent, st.session_state.persona
-        )
-
-        # --- 4. AIコピーライターに渡すための情報整形 ---
-        # (テキスト整形は、formatters専門家に完全に委任します)
-        baseline_text = formatters.format_baseline_for_ai(baseline_product, key_metric_name_jp, key_metric_col_name)
-        chat_history_text = formatters.format_chat_history(st.session_state.messages)
-        
-        # (豆知識の選定は、nutrition_data専門家に完全に委任します)
-        nutrition_tip_text = nutrition_data.get_formatted_nutrition_tip(intent)
-
-        # --- 5. AIコピーライターによる応答文の生成 ---
-        ai_response_stream = gemini_client.get_ai_response_writer(
-            full_user_prompt=full_user_prompt,
-            user_desire_summary=user_desire,
-            key_metric_name=key_metric_name_jp,
-            selection_reason=selection_reason,
-            baseline_product_data=baseline_text,
-            selected_products_data=selected_products.to_markdown(index=False),
-            chat_history=chat_history_text,
-            nutrition_tip=nutrition_tip_text
-        )
+        prefetched = prefetcher.take(prompt, protein_df, st.session_state.persona) if prefetcher is not None else None
+        turn = turn_pipeline.prepare_turn(protein_df, st.session_state.messages, st.session_state.persona, prefetched=prefetched)
+        intent = turn.intent
+        selected_products = turn.selected_products
+        baseline_product = turn.baseline_product
 
         # --- 6. 応答のストリーミングと解析 ---
+        # 本文は届いた順に表示し、[SUGGESTIONS]ブロックと <!-- ID: --> の目印は画面に出さずにイベントとして受け取ります
+        # (ストリームの解析は stream_parser 専門家に委任します。応答の全文をもう一度走査することはありません)
+        parser = stream_parser.WriterStreamParser()
+        index = catalog_index.get_catalog_index(protein_df)
         with st.chat_message("assistant"):
-            full_response = st.write_stream(ai_response_stream)
+            body_area = st.container()
+            cards_area = st.container()
 
-        # 応答から[SUGGESTIONS]ブロックを抽出する
-        # (この解析ロジックは司令塔の責務として残します)
-        main_content = full_response
-        suggestions = []
-        
-        suggestion_match = re.search(r'\[SUGGESTIONS\](.*)\[/SUGGESTIONS\]', full_response, re.DOTALL | re.IGNORECASE)
-        if suggestion_match:
-            main_content = full_response.replace(suggestion_match.group(0), '').strip()
-            suggestion_text = suggestion_match.group(1).strip()
-            suggestions = [line.strip() for line in suggestion_text.split('\n') if line.strip()]
-            # 数字やハイフン、アスタリスクなどを除去
-            suggestions = [re.sub(r'^\s*[\d\.\-\*]+\s*', '', s) for s in suggestions]
+        def on_event(kind, value):
+            # 商品の目印が閉じた時点で、その商品のカードを本文の下に表示します
+            if kind == "product":
+                product_data = index.product_row(value)
+                if product_data is not None:
+                    with cards_area:
+                        ui_components.render_product_card(product_data)
+            # 提案が揃った時点で、ユーザーが次に押しそうな提案ボタンの先読みを始めます
+            elif kind == "suggestions" and prefetcher is not None:
+                prefetcher.start(value, protein_df, st.session_state.persona)
+
+        with body_area:
+            st.write_stream(stream_parser.display_stream(turn.stream, parser, on_event))
+        turn.timings.mark(
+            "stream_parsed", parse_cpu_ms=round(parser.parse_ms, 2),
+            suggestions=len(parser.suggestions), products=len(parser.product_ids),
+        )
+        main_content = parser.body
+        suggestions = parser.suggestions
+        print(f"  - Turn timings: {turn.timings.summary()}", file=sys.stderr)
+        # 各ステージの span（トークン数・キャッシュの当否を含む）を記録します（管理者用ページと、指定があればファイルへ）
+        tracing.record_turn(turn.timings, turn_number=len(st.session_state.messages) // 2 + 1)
 
         # --- 7. セッション状態の更新 ---
-        st.session_state.messages.append({"role": "assistant", "content": main_content, "suggestions": suggestions})
+        # (メッセージIDと商品IDは、描画のたびに計算し直さないよう、ここで1度だけ付与します)
+        st.session_state.messages.append(render_cache.make_assistant_message(main_content, suggestions, product_ids=parser.product_ids))
         
         # 比較表やポジションマップで使うデータを保存
+        # (DataFrameは保存せず、商品IDと指標名だけを持ちます。表は描画時に共有のカタログから組み立てます)
         if not selected_products.empty:
-            table_data = selected_products
-            if baseline_product is not None and not baseline_product.empty:
-                table_data = pd.concat([baseline_product.to_frame().T, selected_products]).reset_index(drop=True)
-            
-            st.session_state.table_info = {
-                "data": table_data, 
-                "metric": intent.get("key_metric", "Other")
-            }
+            st.session_state.table_info = session_store.make_table_info(
+                selected_products, baseline_product, intent.get("key_metric", "Other"), render_cache.new_message_id()
+            )
+
+        # セッションストアのメモリ使用量は、数ターンに1度だけログに出します
+        if next(_turn_counter) % MEMORY_REPORT_EVERY_TURNS == 0:
+            report = session_store.get_shared_store().memory_report()
+            print(
+                f"  - Session store: {report['hot_sessions']} sessions in memory, "
+                f"~{report['hot_bytes_per_session'] / 1024:.1f} KB/session (max {report['hot_bytes_max'] / 1024:.1f} KB).",
+                file=sys.stderr
+            )
 
     except Exception as e:
         error_msg = f"処理中に予期せぬエラーが発生しました: {e}"
         st.error(error_msg)
-        st.session_state.messages.append({"role": "assistant", "content": error_msg})
+        st.session_state.messages.append(render_cache.make_assistant_message(error_msg, []))
         # エラー発生時はログに詳細を出力
         print(f"--- [CRITICAL ERROR in handle_ai_response] ---", file=sys.stderr)
         import traceback
@@ -0,0 +1,132 @@
+# modules/chat_history.py
+
+import re
+from functools import lru_cache
+from typing import Any, Dict, List
+
+from modules import stream_parser
+
+# コピーライターに渡す会話履歴の上限（推定トークン数）
+HISTORY_TOKEN_BUDGET = 1500
+# 要約せずにそのまま渡す、直近の往復数（ユーザーの発言 + AIの応答 = 1往復）
+RECENT_TURNS = 2
+# 要約1行あたりの最大文字数
+SUMMARY_LINE_CHARS = 60
+
+ROLE_LABELS = {"user": "あなた", "assistant": "AIコンシェルジュ"}
+
+# コピーライターが出力する商品の見出し行（### [キャッチコピー] [ブランド名] <!-- ID: [ProductID] -->）
+PRODUCT_HEADING_PATTERN = re.compile(r'^#{1,6}\s*(.*?)\s*' + stream_parser.PRODUCT_MARKER_PATTERN.pattern + r'\s*$')
+# 商品の見出しの後に続く、提案文の段落数（system_prompt_writer.txt の「2段落構成」に対応）
+PRODUCT_BODY_PARAGRAPHS = 2
+
+_SENTENCE_END = re.compile(r'(?<=[。！？!?])')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の大まかな推定値を返す関数（日本語などの非ASCII文字は1文字1トークン、ASCIIは4文字1トークン）。
+    予算の判定に使うだけなので、正確なトークナイザーは使いません。
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+@lru_cache(maxsize=4096)
+def strip_product_blocks(content: str) -> str:
+    """
+    表示済みの商品ブロック（見出し + 提案文の段落）を「提案済み」の1行に置き換える関数。
+    商品の詳細は商品選定の結果として構造化された形で渡されるので、履歴に同じ文章を重ねて入れる必要はありません。
+    """
+    if '<!--' not in content:
+        return content
+    lines = content.split('\n')
+    result = []
+    skip_paragraphs = 0
+    in_paragraph = False
+    for line in lines:
+        heading = PRODUCT_HEADING_PATTERN.match(line.strip())
+        if heading:
+            result.append(f"- 提案済み: {heading.group(1)} (ID: {heading.group(2)})")
+            skip_paragraphs, in_paragraph = PRODUCT_BODY_PARAGRAPHS, False
+            continue
+        if skip_paragraphs:
+            if line.strip():
+                in_paragraph = True
+                continue
+            if in_paragraph:
+                skip_paragraphs -= 1
+                in_paragraph = False
+            continue
+        result.append(line)
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(result)).strip()
+
+
+@lru_cache(maxsize=4096)
+def summarize_message(role: str, content: str) -> str:
+    """
+    古い発言を1行に要約する関数（抽出型。最初の1文と、提案した商品IDだけを残します）。
+    """
+    product_ids = list(dict.fromkeys(stream_parser.PRODUCT_MARKER_PATTERN.findall(content)))
+    text = stream_parser.PRODUCT_MARKER_PATTERN.sub('', strip_product_blocks(content) if product_ids else content)
+    text = ' '.join(line.strip() for line in text.split('\n') if line.strip() and not line.lstrip().startswith('- 提案済み'))
+    first_sentence = next((s for s in _SENTENCE_END.split(text) if s.strip()), '').strip()
+    if len(first_sentence) > SUMMARY_LINE_CHARS:
+        first_sentence = first_sentence[:SUMMARY_LINE_CHARS] + '…'
+    line = f"{ROLE_LABELS.get(role, role)}: {first_sentence}"
+    if product_ids:
+        line += f"（提案: {', '.join(product_ids)}）"
+    return line
+
+
+def _format_verbatim(message: Dict[str, Any]) -> str:
+    content = message["content"]
+    if message["role"] == "assistant":
+        content = strip_product_blocks(content)
+    return f"{ROLE_LABELS.get(message['role'], message['role'])}: {content}"
+
+
+def build_history_text(messages: List[Dict[str, Any]], token_budget: int = HISTORY_TOKEN_BUDGET, recent_turns: int = RECENT_TURNS) -> str:
+    """
+    会話履歴を、トークン予算内に収まるテキストにまとめる関数。
+
+    - 直近 recent_turns 往復は、そのまま（表示済みの商品ブロックだけ1行に置き換えて）残します。
+      ただし、それだけで予算を超える場合は、最新の発言を除いて古い側から要約に回します。
+    - それより古い発言は、1発言1行の要約にまとめます。
+    - それでも予算を超える場合は、古い要約から順に省略します。
+    """
+    if not messages:
+        return ""
+
+    recent_count = recent_turns * 2 + 1 if messages[-1]["role"] == "user" else recent_turns * 2
+    recent_count = min(recent_count, len(messages))
+    recent = [_format_verbatim(m) for m in messages[-recent_count:]]
+    costs = [estimate_tokens(block) for block in recent]
+    # 直近の発言だけで予算を超える場合は、最新の発言を残して、古い側から要約に回します
+    while len(recent) > 1 and sum(costs) > token_budget:
+        recent.pop(0)
+        costs.pop(0)
+    older = messages[:len(messages) - len(recent)]
+
+    remaining = token_budget - sum(costs)
+    summary_lines = []
+    for message in reversed(older):
+        line = summarize_message(message["role"], message["content"])
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            break
+        summary_lines.append(line)
+        remaining -= cost
+    summary_lines.reverse()
+
+    blocks = []
+    omitted = len(older) - len(summary_lines)
+    if summary_lines or omitted:
+        header = "【これまでの会話の要約】"
+        if omitted:
+            header += f"（さらに前の{omitted}件の発言は省略）"
+        blocks.append('\n'.join([header] + summary_lines))
+    blocks.extend(recent)
+    return '\n\n'.join(blocks)
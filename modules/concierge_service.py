@@ -0,0 +1,271 @@
+# modules/concierge_service.py
+
+import copy
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from modules import catalog_index
+from modules import prefetch
+from modules import render_cache
+from modules import session_store
+from modules import stream_parser
+from modules import tracing
+from modules import turn_pipeline
+
+# 診断フォームを通さずに始めたセッションのペルソナ（app.py の初期値と同じです）
+DEFAULT_PERSONA = {
+    'experience': '継続的に飲んでいる',
+    'current_brand': None,
+    'baseline_product_id': None,
+    'purpose': '筋肉を大きくしたい',
+    'priorities': {'価格の安さ': True, '味のおいしさ': False, '成分の品質': False, '有名ブランド': False},
+}
+PERSONA_TEXT_FIELDS = ('experience', 'current_brand', 'baseline_product_id', 'purpose')
+
+# この秒数アクセスのないセッション（ペルソナ・先読み）は、メモリから外します。会話履歴は SessionStore に残ります。
+SESSION_IDLE_SECONDS = 1800
+# メモリに置いておくセッション数の上限
+MAX_SESSIONS = 5000
+# 1回の要望の最大文字数
+MAX_PROMPT_CHARS = 2000
+
+# コピーライターの応答が途中で失敗した場合に、本文の代わりに保存する文言（chat_handler と同じです）
+ERROR_MESSAGE = "処理中に予期せぬエラーが発生しました: {error}"
+
+Event = Tuple[str, Dict[str, Any]]
+
+
+class SessionNotFoundError(KeyError):
+    """指定されたセッションがない（期限切れでメモリから外れた場合を含む）。"""
+
+
+class SessionBusyError(RuntimeError):
+    """そのセッションで、別のターンを処理中。"""
+
+
+def normalize_persona(data: Optional[Dict[str, Any]], base: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    リクエストで受け取ったペルソナを検証し、base（省略時は DEFAULT_PERSONA）に重ねたものを返す。
+    知らない項目は無視し、型が違う項目は ValueError を送出します。
+    """
+    persona = copy.deepcopy(base if base is not None else DEFAULT_PERSONA)
+    if data is None:
+        return persona
+    if not isinstance(data, dict):
+        raise ValueError("persona must be an object")
+    for field in PERSONA_TEXT_FIELDS:
+        if field in data:
+            value = data[field]
+            if value is not None and not isinstance(value, str):
+                raise ValueError(f"persona.{field} must be a string or null")
+            persona[field] = value
+    if 'priorities' in data:
+        priorities = data['priorities']
+        if not isinstance(priorities, dict) or not all(isinstance(v, bool) for v in priorities.values()):
+            raise ValueError("persona.priorities must map names to booleans")
+        persona['priorities'].update(priorities)
+    return persona
+
+
+class ConciergeSession:
+    """サーバー側で持つ、1人のユーザーの状態（st.session_state の persona・messages・prefetcher・table_info に当たります）。"""
+
+    def __init__(self, session_id: str, persona: Dict[str, Any], store: session_store.SessionStore):
+        self.session_id = session_id
+        self.persona = persona
+        self.messages = session_store.SessionMessages(session_id, store=store)
+        self.prefetcher = prefetch.SuggestionPrefetcher()
+        self.table_info: Optional[Dict[str, Any]] = None
+        self.last_access = time.monotonic()
+        self.busy = False
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "persona": self.persona,
+            "messages": list(self.messages),
+            "table_info": self.table_info,
+        }
+
+
+class ConciergeService:
+    """
+    st.session_state を使わずに、1ターンの処理（turn_pipeline → stream_parser → SessionStore）を実行するクラス。
+    HTTP などの画面以外の入口（api_server.py）から使います。ターンは、構造化されたイベントの列として返します。
+
+        ("turn", {...})        意図と商品選定の結果（ストリームの開始前）
+        ("text", {"text"})     画面に表示してよい本文
+        ("product", {...})     <!-- ID: --> の目印が閉じた時点の商品情報
+        ("suggestions", {...}) [SUGGESTIONS] ブロックが閉じた時点の提案
+        ("done", {...})        保存したメッセージのIDと、各ステージの所要時間
+        ("error", {...})       処理の失敗（エラーの文言を応答として保存します）
+    """
+
+    def __init__(self, catalog, store: Optional[session_store.SessionStore] = None,
+                 idle_seconds: float = SESSION_IDLE_SECONDS, max_sessions: int = MAX_SESSIONS):
+        self.catalog = catalog
+        self.store = store or session_store.get_shared_store()
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, ConciergeSession]" = OrderedDict()
+        self.stats = {"sessions_created": 0, "sessions_expired": 0, "turns": 0, "failed_turns": 0, "busy_rejections": 0, "active_turns": 0}
+
+    # --- セッション ---
+
+    def create_session(self, persona: Optional[Dict[str, Any]] = None) -> ConciergeSession:
+        session = ConciergeSession(uuid.uuid4().hex, normalize_persona(persona), self.store)
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self.stats["sessions_created"] += 1
+            self._evict_idle(time.monotonic())
+        return session
+
+    def get_session(self, session_id: str) -> ConciergeSession:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                raise SessionNotFoundError(session_id)
+            session.last_access = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def update_persona(self, session_id: str, data: Dict[str, Any]) -> ConciergeSession:
+        session = self.get_session(session_id)
+        persona = normalize_persona(data, base=session.persona)
+        with self._lock:
+            session.persona = persona
+        return session
+
+    def delete_session(self, session_id: str) -> None:
+        session = self.get_session(session_id)
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        session.prefetcher.cancel()
+        session.messages.clear()
+
+    def _evict_idle(self, now: float) -> None:
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if oldest.busy or (len(self._sessions) <= self.max_sessions and now - oldest.last_access <= self.idle_seconds):
+                break
+            del self._sessions[oldest_id]
+            oldest.prefetcher.cancel()
+            self.stats["sessions_expired"] += 1
+
+    # --- ターン ---
+
+    def begin_turn(self, session_id: str, prompt: str) -> ConciergeSession:
+        """
+        ターンを始めてよいかを確かめ、セッションを処理中にする（続けて run_turn を呼んでください）。
+        要望が不正なら ValueError、セッションがなければ SessionNotFoundError、処理中なら SessionBusyError を送出します。
+        """
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError("prompt must be a non-empty string")
+        if len(prompt) > MAX_PROMPT_CHARS:
+            raise ValueError(f"prompt must be at most {MAX_PROMPT_CHARS} characters")
+        session = self.get_session(session_id)
+        with self._lock:
+            if session.busy:
+                self.stats["busy_rejections"] += 1
+                raise SessionBusyError(session_id)
+            session.busy = True
+            self.stats["active_turns"] += 1
+        return session
+
+    def run_turn(self, session: ConciergeSession, prompt: str) -> Iterator[Event]:
+        """
+        handle_ai_response と同じ順序で1ターンを処理し、イベントを順に返すジェネレーター（begin_turn の後に呼びます）。
+        応答を履歴に保存するのは最後まで読んだ場合だけなので、呼び出し側は、利用者が切断しても最後まで読んでください。
+        """
+        try:
+            yield from self._turn_events(session, prompt)
+        finally:
+            with self._lock:
+                session.busy = False
+                session.last_access = time.monotonic()
+                self.stats["active_turns"] -= 1
+
+    def _turn_events(self, session: ConciergeSession, prompt: str) -> Iterator[Event]:
+        protein_df = self.catalog.current()
+        persona = session.persona
+        session.messages.append({"role": "user", "content": prompt})
+        try:
+            # 提案ボタンからの要望で、先読みが済んでいれば、意図の判定と商品選定を省略します
+            prefetched = session.prefetcher.take(prompt, protein_df, persona)
+            turn = turn_pipeline.prepare_turn(protein_df, list(session.messages), persona, prefetched=prefetched)
+        except Exception as e:
+            yield self._fail(session, e)
+            return
+
+        baseline_id = turn.baseline_product.get('ProductID') if turn.baseline_product is not None and not turn.baseline_product.empty else None
+        yield ("turn", {
+            "trace_id": turn.timings.trace_id,
+            "intent": turn.intent,
+            "key_metric": turn.key_metric_col_name,
+            "key_metric_name": turn.key_metric_name_jp,
+            "product_ids": turn.selected_products['ProductID'].tolist() if not turn.selected_products.empty else [],
+            "baseline_id": baseline_id,
+        })
+
+        parser = stream_parser.WriterStreamParser()
+        index = catalog_index.get_catalog_index(protein_df)
+        try:
+            for chunk in turn.stream:
+                yield from self._parsed_events(parser.feed(chunk), session, index, protein_df)
+            yield from self._parsed_events(parser.close(), session, index, protein_df)
+        except Exception as e:
+            yield self._fail(session, e)
+            return
+
+        turn.timings.mark("stream_parsed", parse_cpu_ms=round(parser.parse_ms, 2), suggestions=len(parser.suggestions), products=len(parser.product_ids))
+        tracing.record_turn(turn.timings, turn_number=len(session.messages) // 2 + 1)
+        message = render_cache.make_assistant_message(parser.body, parser.suggestions, product_ids=parser.product_ids)
+        session.messages.append(message)
+        if not turn.selected_products.empty:
+            session.table_info = session_store.make_table_info(
+                turn.selected_products, turn.baseline_product, turn.intent.get("key_metric", "Other"), render_cache.new_message_id()
+            )
+        with self._lock:
+            self.stats["turns"] += 1
+        yield ("done", {"message_id": message["id"], "trace_id": turn.timings.trace_id, "timings": turn.timings.as_dict()})
+
+    def _parsed_events(self, events, session: ConciergeSession, index, protein_df) -> Iterator[Event]:
+        for kind, value in events:
+            if kind == "text":
+                yield ("text", {"text": value})
+            elif kind == "product":
+                row = index.product_row(value)
+                yield ("product", {"id": value} if row is None else {
+                    "id": value,
+                    "brand": row.get('Brand'),
+                    "name": row.get('ProductName'),
+                    "image_url": row.get('ImageURL') or None,
+                    "url": row.get('AmazonURL') or None,
+                })
+            elif kind == "suggestions":
+                # 提案が揃った時点で、ユーザーが次に押しそうな提案ボタンの先読みを始めます
+                session.prefetcher.start(value, protein_df, session.persona)
+                yield ("suggestions", {"suggestions": value})
+
+    def _fail(self, session: ConciergeSession, error: Exception) -> Event:
+        """chat_handler と同じく、エラーの文言を応答として保存し、error イベントを返す。"""
+        print(f"--- [CRITICAL ERROR in ConciergeService.run_turn] ---", file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        message = render_cache.make_assistant_message(ERROR_MESSAGE.format(error=error), [])
+        session.messages.append(message)
+        with self._lock:
+            self.stats["turns"] += 1
+            self.stats["failed_turns"] += 1
+        return ("error", {"message": message["content"], "message_id": message["id"]})
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["sessions"] = len(self._sessions)
+        return stats
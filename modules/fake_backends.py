@@ -0,0 +1,319 @@
+# modules/fake_backends.py
+
+import copy
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+
+class FakeSheetsSource:
+    """
+    Googleスプレッドシートの代わりに使う、ローカルの偽データソース。
+    CatalogStore の同期・差分検出・コールドスタートを、ネットワークなしで確認するためのものです。
+    """
+
+    def __init__(self, records: Optional[List[Dict[str, Any]]] = None, fail: bool = False):
+        self._lock = threading.Lock()
+        self._records = copy.deepcopy(records or [])
+        self._revision = 1
+        self.fail = fail
+        self.revision_calls = 0
+        self.records_calls = 0
+
+    def get_revision(self) -> str:
+        with self._lock:
+            self.revision_calls += 1
+            if self.fail:
+                raise ConnectionError("FakeSheetsSource: simulated outage")
+            return f"rev-{self._revision}"
+
+    def get_records(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            self.records_calls += 1
+            if self.fail:
+                raise ConnectionError("FakeSheetsSource: simulated outage")
+            return copy.deepcopy(self._records)
+
+    def set_records(self, records: List[Dict[str, Any]]) -> None:
+        """シート全体を書き換える（リビジョンが進みます）。"""
+        with self._lock:
+            self._records = copy.deepcopy(records)
+            self._revision += 1
+
+    def update_row(self, product_id: str, **values: Any) -> None:
+        """ProductIDで指定した行の値を書き換える（リビジョンが進みます）。"""
+        with self._lock:
+            for record in self._records:
+                if record.get('ProductID') == product_id:
+                    record.update(values)
+            self._revision += 1
+
+    def touch(self) -> None:
+        """行の内容は変えずにリビジョンだけを進める（書式変更などを想定）。"""
+        with self._lock:
+            self._revision += 1
+
+
+# --- 合成カタログ（ベンチマーク・負荷試験用） ---
+SYNTHETIC_BRANDS = ["ザバス", "マイプロテイン", "ビーレジェンド", "ゴールドスタンダード", "グロング", "エクスプロージョン", "ハルクファクター", "DNS"]
+SYNTHETIC_FLAVORS = ["チョコレート", "バニラ", "ストロベリー", "抹茶", "ミルクティー", "ヨーグルト", "ナチュラル"]
+SYNTHETIC_TAGS = [
+    "#美味しい", "#フレーバー豊富", "#フルーティー", "#さっぱり", "#国内製造", "#無添加", "#初心者",
+    "#コスパ最強", "#高タンパク", "#WPI", "#ソイ", "#増量", "#減量", "#溶けやすい", "#人工甘味料不使用",
+]
+
+
+def make_synthetic_records(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """シートと同じ列構成を持つ、n件の合成レコードを作る関数。"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(n):
+        serving = rng.choice([25.0, 30.0, 32.0, 35.0, 40.0])
+        weight = rng.choice([0.35, 1.0, 2.5, 3.0, 5.0])
+        price = round(rng.uniform(1500, 6000) * weight, -1)
+        brand = rng.choice(SYNTHETIC_BRANDS)
+        flavor = rng.choice(SYNTHETIC_FLAVORS)
+        records.append({
+            "ProductID": f"{chr(65 + (i // 26000) % 26)}{chr(65 + (i // 1000) % 26)}{i % 1000:03d}",
+            "Brand": brand,
+            "ProductName": f"{brand} ホエイプロテイン {flavor} {weight}kg",
+            "Flavor": flavor,
+            "ServingSize(g)": serving,
+            "ProteinPerServing(g)": round(serving * rng.uniform(0.65, 0.92), 1),
+            "FatPerServing(g)": round(rng.uniform(0.2, 3.0), 1),
+            "CarbPerServing(g)": round(rng.uniform(0.5, 6.0), 1),
+            "Solubility": rng.randint(1, 5),
+            "Price(JPY)": price,
+            "WeightInKg": weight,
+            "PricePerKg(JPY)": round(price / weight, 0),
+            "PersonaTags": " ".join(rng.sample(SYNTHETIC_TAGS, rng.randint(1, 4))),
+            "ImageURL": f"https://example.com/images/{i}.jpg",
+            "AmazonURL": f"https://example.com/dp/{i}",
+        })
+    return records
+
+
+def make_synthetic_catalog(n: int, seed: int = 0):
+    """合成レコードから、本番と同じ前処理・スナップショットバージョン付きのカタログDataFrameを作る関数。"""
+    from modules import catalog_store
+
+    df = catalog_store.prepare_catalog(make_synthetic_records(n, seed))
+    df.attrs['snapshot_version'] = catalog_store.compute_snapshot_version(catalog_store.compute_row_hashes(df))
+    return df
+
+
+# --- 偽のGeminiモデル（パイプラインの計測・負荷試験用） ---
+# スキーマを指定した本物の分析官AIと同じく、項目はアルファベット順に並べています（intent_stream）
+FAKE_ANALYZER_RESPONSE = (
+    '{"handle_ambiguity": false, "key_metric": "PricePerKg(JPY)", "relevant_tags": [], '
+    '"user_desire_summary": "価格が安いこと（コストパフォーマンス）"}'
+)
+FAKE_WRITER_RESPONSE = (
+    "お気持ち、よく分かります。まずは、これから下に表示される『プロテイン・ポジションマップ』をご覧ください。\n\n"
+    "### コスパの王様 マイプロテイン <!-- ID: AA001 -->\n"
+    "この商品は、マップ上でも突出して右側に位置する一品です。\n\n"
+    "1kgあたりの価格が、今お使いの商品より大きく抑えられています。\n\n"
+    "### 品質も妥協しない ビーレジェンド <!-- ID: AA002 -->\n"
+    "価格と品質のバランスに優れた選択肢です。\n\n"
+    "タンパク質含有率は80%を超えています。\n\n"
+    "あなたは、この二つのうち、どちらの考え方がよりご自身の理想に近いと感じますか？\n"
+    "[SUGGESTIONS]\n"
+    "1. 「品質（マップの上方向）」を最優先する\n"
+    "2. 「コストパフォーマンス（マップの右方向）」を重視したい\n"
+    "[/SUGGESTIONS]"
+)
+
+
+# vary_suggestions=True の場合に、応答ごとに選んで使う提案の文言（本物のコピーライターと同じく、毎回違う提案になります）
+FAKE_SUGGESTION_POOL = [
+    "「品質（マップの上方向）」を最優先する", "「コストパフォーマンス（マップの右方向）」を重視したい",
+    "飲みやすさを優先して選び直したい", "{brand}以外のブランドも見てみたい", "1食あたりの脂質がもっと少ないものは？",
+    "トレーニング後に合うフレーバーを知りたい", "初めてでも失敗しにくいものを教えて", "量が多くてお得なサイズはありますか？",
+    "人工甘味料が入っていないものがいい", "水でも美味しく飲めるものがいい", "{brand}の中で一番高タンパクなものは？",
+    "夜に飲むのにおすすめのものは？",
+]
+FAKE_SUGGESTION_BRANDS = ["ザバス", "マイプロテイン", "ビーレジェンド", "DNS", "グロング"]
+
+
+class _FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiError(Exception):
+    """FakeGeminiModel が注入するエラー（code=429 は割り当て超過、504 はタイムアウトを想定）。"""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+# FakeGeminiModel が記録しておく、直近の呼び出しの件数
+RECORDED_PROMPTS = 200
+
+
+class FakeGeminiModel:
+    """
+    genai.GenerativeModel の代わりに使う、遅延とエラーを注入できる偽のモデル。
+    gemini_client.set_model_override() で差し込むと、ネットワークなしで分析官・コピーライターの呼び出しを再現します。
+
+    - analyzer_latency: 分析官の応答が終わるまでの秒数（generation_config を指定したストリーミング呼び出しでは、
+      analyzer_first_token_latency 秒で最初のチャンクが届き、残りのチャンクは analyzer_latency 秒までに均等に届きます）
+    - invalid_rate: 分析官の応答が、途中で切れた不正なJSONになる確率
+    - first_token_latency: ストリーミング呼び出し（コピーライター）の最初のチャンクまでの秒数
+    - token_interval: 以降のチャンクの間隔（秒）
+    - error_rate: 呼び出しが FakeGeminiError で失敗する確率（error_code で 429 / 504 などを指定）
+    - quota_per_second: 直近1秒の受付件数がこれを超えると、すぐに 429 を返す（サーバー側の割り当てを再現）
+    - slow_rate / slow_factor: この確率で、応答までの時間が slow_factor 倍になる（遅い応答の裾を再現）
+    - vary_suggestions: コピーライターの [SUGGESTIONS] を、応答ごとに FAKE_SUGGESTION_POOL から選び直す
+    - recorded_prompts: prompts / system_instructions に残す、直近の呼び出しの件数（長時間の負荷試験でメモリが増え続けないよう上限を設けます）
+    """
+
+    def __init__(
+        self,
+        analyzer_latency: float = 0.8,
+        first_token_latency: float = 0.4,
+        token_interval: float = 0.02,
+        chunk_chars: int = 12,
+        analyzer_response: str = FAKE_ANALYZER_RESPONSE,
+        writer_response: str = FAKE_WRITER_RESPONSE,
+        error_rate: float = 0.0,
+        error_code: int = 429,
+        seed: int = 0,
+        quota_per_second: Optional[float] = None,
+        slow_rate: float = 0.0,
+        slow_factor: float = 5.0,
+        vary_suggestions: bool = False,
+        analyzer_first_token_latency: Optional[float] = None,
+        invalid_rate: float = 0.0,
+        recorded_prompts: int = RECORDED_PROMPTS,
+    ):
+        self.analyzer_latency = analyzer_latency
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.chunk_chars = chunk_chars
+        self.analyzer_response = analyzer_response
+        self.writer_response = writer_response
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {"analyzer": 0, "writer": 0}
+        self.quota_per_second = quota_per_second
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.vary_suggestions = vary_suggestions
+        self.analyzer_first_token_latency = analyzer_latency / 2 if analyzer_first_token_latency is None else analyzer_first_token_latency
+        self.invalid_rate = invalid_rate
+        self.invalid = 0
+        self._accepted: List[float] = []
+        self.errors = {"analyzer": 0, "writer": 0}
+        self.throttled = {"analyzer": 0, "writer": 0}
+        # 直近 recorded_prompts 件の呼び出しのプロンプト
+        self.prompts: "deque[str]" = deque(maxlen=recorded_prompts)
+        # 呼び出しごとのシステム指示（prompts と同じ順です。システム指示なしの呼び出しは None）
+        self.system_instructions: "deque[Optional[str]]" = deque(maxlen=recorded_prompts)
+
+    def _admit(self, kind: str) -> None:
+        """サーバー側の割り当てを確認する（超えていれば、遅延なしで 429 を返します）。"""
+        if self.quota_per_second is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._accepted = [t for t in self._accepted if now - t < 1.0]
+            throttled = len(self._accepted) >= self.quota_per_second
+            if throttled:
+                self.throttled[kind] += 1
+            else:
+                self._accepted.append(now)
+        if throttled:
+            raise FakeGeminiError(429, "Resource has been exhausted (e.g. check quota).")
+
+    def _latency(self, seconds: float) -> float:
+        with self._lock:
+            slow = self.slow_rate > 0 and self._rng.random() < self.slow_rate
+        return seconds * self.slow_factor if slow else seconds
+
+    def _maybe_fail(self, kind: str) -> None:
+        with self._lock:
+            fail = self.error_rate > 0 and self._rng.random() < self.error_rate
+            if fail:
+                self.errors[kind] += 1
+        if fail:
+            raise FakeGeminiError(self.error_code, "Resource has been exhausted (e.g. check quota)." if self.error_code == 429 else "Deadline Exceeded")
+
+    def with_system_instruction(self, system_instruction: str) -> "_FakeModelWithInstruction":
+        """genai.GenerativeModel(..., system_instruction=...) の代わりに、システム指示を付けたモデルを返す。"""
+        return _FakeModelWithInstruction(self, system_instruction)
+
+    def generate_content(self, prompt: str, stream: bool = False, generation_config: Optional[Dict[str, Any]] = None):
+        return self._generate(prompt, stream, generation_config, None)
+
+    def _generate(self, prompt: str, stream: bool, generation_config: Optional[Dict[str, Any]], system_instruction: Optional[str]):
+        # 応答の形（JSONのスキーマ）を指定するのは分析官だけです
+        kind = "analyzer" if generation_config is not None or not stream else "writer"
+        with self._lock:
+            self.calls[kind] += 1
+            self.prompts.append(prompt)
+            self.system_instructions.append(system_instruction)
+        if stream and kind == "analyzer":
+            return self._analyzer_stream()
+        if stream:
+            return self._stream()
+        self._admit(kind)
+        time.sleep(self._latency(self.analyzer_latency))
+        self._maybe_fail(kind)
+        return _FakeResponse(self._analyzer_text())
+
+    def _writer_text(self) -> str:
+        if not self.vary_suggestions or "[SUGGESTIONS]" not in self.writer_response:
+            return self.writer_response
+        with self._lock:
+            picks = self._rng.sample(FAKE_SUGGESTION_POOL, 3)
+            brand = self._rng.choice(FAKE_SUGGESTION_BRANDS)
+        lines = "\n".join(f"{i}. {pick.format(brand=brand)}" for i, pick in enumerate(picks, 1))
+        return self.writer_response[:self.writer_response.index("[SUGGESTIONS]")] + f"[SUGGESTIONS]\n{lines}\n[/SUGGESTIONS]"
+
+    def _analyzer_text(self) -> str:
+        with self._lock:
+            invalid = self.invalid_rate > 0 and self._rng.random() < self.invalid_rate
+            if invalid:
+                self.invalid += 1
+        # 不正な応答は、要約の途中で切れたJSONにします（項目の前半は正しく届きます）
+        return self.analyzer_response[:len(self.analyzer_response) * 3 // 4] if invalid else self.analyzer_response
+
+    def _analyzer_stream(self):
+        self._admit("analyzer")
+        first_token_latency = self._latency(self.analyzer_first_token_latency)
+        time.sleep(first_token_latency)
+        self._maybe_fail("analyzer")
+        text = self._analyzer_text()
+        chunks = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)]
+        interval = max(0.0, self.analyzer_latency - first_token_latency) / max(1, len(chunks) - 1)
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(interval)
+            yield _FakeResponse(chunk)
+
+    def _stream(self):
+        self._admit("writer")
+        time.sleep(self._latency(self.first_token_latency))
+        self._maybe_fail("writer")
+        text = self._writer_text()
+        for i in range(0, len(text), self.chunk_chars):
+            if i:
+                time.sleep(self.token_interval)
+            yield _FakeResponse(text[i:i + self.chunk_chars])
+
+
+class _FakeModelWithInstruction:
+    """FakeGeminiModel.with_system_instruction() が返す、システム指示付きのモデル（呼び出しは元のモデルに記録されます）。"""
+
+    def __init__(self, model: FakeGeminiModel, system_instruction: str):
+        self.model = model
+        self.system_instruction = system_instruction
+
+    def generate_content(self, prompt: str, stream: bool = False, generation_config: Optional[Dict[str, Any]] = None):
+        return self.model._generate(prompt, stream, generation_config, self.system_instruction)
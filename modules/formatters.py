@@ -1,17 +1,18 @@
 # modules/formatters.py
 
+import numpy as np
 import pandas as pd
 
+from modules import chat_history
+
 def format_chat_history(messages: list) -> str:
     """
     Streamlitのチャット履歴(辞書のリスト)を、
     AIが読みやすいシンプルなテキスト形式に変換する関数。
+    会話が長くなってもプロンプトが際限なく伸びないよう、古い発言は要約し、
+    全体をトークン予算内に収めます（詳細は chat_history.build_history_text）。
     """
-    history_text = ""
-    for message in messages:
-        role = "あなた" if message["role"] == "user" else "AIコンシェルジュ"
-        history_text += f"{role}: {message['content']}\n\n"
-    return history_text.strip()
+    return chat_history.build_history_text(messages)
 
 def format_persona(persona_data: dict) -> str:
     """
@@ -39,7 +40,7 @@ def format_baseline_for_ai(product_series: pd.Series, key_metric_name: str, key_
     if key_metric_col and key_metric_col in product_series:
         metric_value = product_series.get(key_metric_col)
         # 数値の場合はフォーマットする
-        if isinstance(metric_value, (int, float)):
+        if isinstance(metric_value, (int, float, np.number)):
             return f"ブランド名: {brand_name}, 代表商品名: {product_name}, {key_metric_name}: {metric_value:,.0f}"
         else:
             return f"ブランド名: {brand_name}, 代表商品名: {product_name}, {key_metric_name}: {metric_value}"
@@ -1,17 +1,175 @@
 import streamlit as st
 import google.generativeai as genai
+import hashlib
 import sys
 import os
+import threading
+import time
 
-# ▼▼▼【ここからが修正箇所です】▼▼▼
-# ローカルのconfig.jsonを読むロジックを完全に削除し、
-# Streamlit CloudのSecretsからのみキーを読み込むように簡潔化します。
+from modules import chat_history
+from modules import gemini_scheduler
+from modules import intent_stream
+from modules import prompt_templates
 
-def _initialize_gemini():
+# 安定性と性能のバランスが良い、最新のモデル名を指定します。
+MODEL_NAME = 'gemini-2.0-flash-lite'
+PROMPTS_DIR = os.path.join(os.path.dirname(__file__), '..', 'prompts')
+# 分析官AIの応答がJSONとして読めない・スキーマに合わない場合に、すぐにやり直す回数
+ANALYZER_INVALID_RETRIES = 1
+
+# 各AIのプロンプト。システム指示（毎回同じ固定の部分）と、ターンごとの内容（[placeholder] に値を差し込むテンプレート）に
+# 分けて送ります。システム指示のバイト列がターン間で変わらないので、プロバイダー側のコンテキストキャッシュが効きます。
+ANALYZER_SYSTEM_PROMPT = 'system_prompt_analyzer.txt'
+ANALYZER_TURN_TEMPLATE = 'analyzer_turn_context.txt'
+WRITER_SYSTEM_PROMPT = 'system_prompt_writer.txt'
+WRITER_TURN_TEMPLATE = 'writer_turn_context.txt'
+
+# --- プロセス全体で共有するキャッシュ ---
+# (APIキー, モデル名, システム指示) -> GenerativeModel。genai.configure とモデルの生成は、組み合わせごとに1度だけ行います。
+_model_registry = {}
+# プロンプトのファイルパス -> (mtime, 本文)。ファイルが更新された時だけ読み直します。
+_prompt_cache = {}
+# テンプレートのファイルパス -> (mtime, PromptTemplate)。差し込み口の解析も、ファイルが更新された時だけ行います。
+_template_cache = {}
+# システム指示のファイル名 -> (mtime, 前回送ったバイト列の SHA-256)。ターン間で変わっていないかを確かめます。
+_prefix_digests = {}
+_cache_lock = threading.Lock()
+# テストや負荷試験で、本物のモデルの代わりに使うモデル（fake_backends.FakeGeminiModel など）
+_model_override = None
+
+# キャッシュの効果を確認するための計測値（get_setup_stats() で参照できます）
+_setup_stats = {
+    "model_builds": 0, "model_hits": 0, "model_build_ms": 0.0,
+    "prompt_loads": 0, "prompt_hits": 0, "prompt_load_ms": 0.0, "prompt_check_ms": 0.0,
+    "template_compiles": 0, "prefix_reuses": 0, "prefix_changes": 0, "unexpected_prefix_changes": 0,
+}
+
+def _get_model(api_key: str, model_name: str = MODEL_NAME, system_instruction: str = None):
+    """(APIキー, モデル名, システム指示) ごとに1度だけモデルを生成し、以降はそれを使い回す関数。"""
+    key = (api_key, model_name, system_instruction)
+    with _cache_lock:
+        model = _model_registry.get(key)
+        if model is not None:
+            _setup_stats["model_hits"] += 1
+            return model
+
+        start = time.perf_counter()
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+        _model_registry[key] = model
+        _setup_stats["model_builds"] += 1
+        _setup_stats["model_build_ms"] += (time.perf_counter() - start) * 1000
+    print(f"--- [SUCCESS] Authenticated with Streamlit Secrets for Gemini ({model_name}). ---", file=sys.stderr)
+    return model
+
+def load_prompt(filename: str) -> str:
+    """
+    prompts/ 以下のプロンプトを返す関数。
+    ファイルの更新日時(mtime)が変わった時だけ読み直すので、プロンプトを編集すれば再起動なしで反映されます。
+    """
+    path = os.path.join(PROMPTS_DIR, filename)
+    start = time.perf_counter()
+    mtime = os.path.getmtime(path)
+    with _cache_lock:
+        cached = _prompt_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            _setup_stats["prompt_hits"] += 1
+            _setup_stats["prompt_check_ms"] += (time.perf_counter() - start) * 1000
+            return cached[1]
+
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    with _cache_lock:
+        _prompt_cache[path] = (mtime, text)
+        _setup_stats["prompt_loads"] += 1
+        _setup_stats["prompt_load_ms"] += (time.perf_counter() - start) * 1000
+    return text
+
+def load_template(filename: str) -> prompt_templates.PromptTemplate:
+    """
+    prompts/ 以下のテンプレートを、差し込み口を解析済みの PromptTemplate として返す関数。
+    load_prompt と同じく、ファイルが更新された時だけ読み直して解析し直します。
+    """
+    path = os.path.join(PROMPTS_DIR, filename)
+    mtime = os.path.getmtime(path)
+    with _cache_lock:
+        cached = _template_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    template = prompt_templates.PromptTemplate(load_prompt(filename), name=filename)
+    with _cache_lock:
+        _template_cache[path] = (mtime, template)
+        _setup_stats["template_compiles"] += 1
+    return template
+
+def get_prompt_version(filename: str) -> float:
+    """プロンプトファイルの mtime を返す関数（プロンプトに依存するキャッシュの無効化に使います）。"""
+    return os.path.getmtime(os.path.join(PROMPTS_DIR, filename))
+
+def check_prompt_prefix(filename: str, system_instruction: str) -> bool:
+    """
+    送ろうとしているシステム指示のバイト列が、前回のリクエストと同じかを確かめる関数（同じなら True）。
+    プロンプトのファイルを編集していないのに変わった場合は、プロバイダー側のキャッシュが効かなくなるので警告します。
     """
-    StreamlitのSecretsからGemini APIキーを取得し、モデルを初期化する関数。
+    digest = hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()
+    version = get_prompt_version(filename)
+    with _cache_lock:
+        previous = _prefix_digests.get(filename)
+        _prefix_digests[filename] = (version, digest)
+        if previous is None:
+            return True
+        if previous[1] == digest:
+            _setup_stats["prefix_reuses"] += 1
+            return True
+        _setup_stats["prefix_changes"] += 1
+        unexpected = previous[0] == version
+        if unexpected:
+            _setup_stats["unexpected_prefix_changes"] += 1
+    if unexpected:
+        print(f"--- [WARNING] System instruction {filename} changed between requests without a prompt edit; prefix caching will miss. ---", file=sys.stderr)
+    return False
+
+def get_setup_stats() -> dict:
+    """
+    モデル生成とプロンプト読み込みのキャッシュ状況を返す関数。
+    estimated_saved_ms は「キャッシュがなければ毎回かかっていた時間」の推定値です。
+    """
+    with _cache_lock:
+        stats = dict(_setup_stats)
+    avg_build_ms = stats["model_build_ms"] / stats["model_builds"] if stats["model_builds"] else 0.0
+    avg_load_ms = stats["prompt_load_ms"] / stats["prompt_loads"] if stats["prompt_loads"] else 0.0
+    stats["estimated_saved_ms"] = (
+        stats["model_hits"] * avg_build_ms
+        + stats["prompt_hits"] * avg_load_ms
+        - stats["prompt_check_ms"]
+    )
+    return stats
+
+def set_model_override(model) -> None:
+    """
+    本物のGeminiの代わりに使うモデルを差し込む関数（None を渡すと元に戻ります）。
+    generate_content(prompt, stream=...) を持つオブジェクトであれば何でも構いません。
+    with_system_instruction(text) があれば、システム指示を付けたモデルをそれで作ります。
+    """
+    global _model_override
+    _model_override = model
+
+def _initialize_gemini(system_prompt_file: str = None):
+    """
+    StreamlitのSecretsからGemini APIキーを取得し、キャッシュ済みのモデルを返す関数。
+    system_prompt_file を渡すと、そのプロンプトをシステム指示に設定したモデルを返します。
     """
     try:
+        system_instruction = None
+        if system_prompt_file:
+            system_instruction = load_prompt(system_prompt_file)
+            check_prompt_prefix(system_prompt_file, system_instruction)
+        if _model_override is not None:
+            if system_instruction is not None and hasattr(_model_override, "with_system_instruction"):
+                return _model_override.with_system_instruction(system_instruction)
+            return _model_override
+
         # より確実な「辞書アクセス」方式で、Secretsから直接キーを取得します。
         api_key = st.secrets["gemini_api_key"]
         
@@ -19,11 +177,7 @@ def _initialize_gemini():
             st.error("設定エラー: Gemini APIキーが空です。StreamlitのSecretsを確認してください。")
             return None
 
-        genai.configure(api_key=api_key)
-        # 安定性と性能のバランスが良い、最新のモデル名を指定します。
-        model = genai.GenerativeModel('gemini-2.0-flash-lite') 
-        print("--- [SUCCESS] Authenticated with Streamlit Secrets for Gemini. ---", file=sys.stderr)
-        return model
+        return _get_model(api_key, system_instruction=system_instruction)
 
     except KeyError:
         # st.secrets["gemini_api_key"] が存在しない場合のエラー
@@ -36,73 +190,152 @@ def _initialize_gemini():
         print(f"--- [CRITICAL ERROR] An unexpected error occurred during Gemini initialization: {e} ---", file=sys.stderr)
         return None
 
-# ▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲
+def _record_usage(usage, prompt: str, response_text: str, response=None) -> None:
+    """
+    usage（呼び出し元が渡した辞書）に、プロンプトと応答のトークン数を書き込む関数。
+    APIの usage_metadata があればその値を、なければ chat_history.estimate_tokens の推定値を使います。
+    """
+    if usage is None:
+        return
+    metadata = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(metadata, "prompt_token_count", None)
+    response_tokens = getattr(metadata, "candidates_token_count", None)
+    usage["prompt_tokens"] = prompt_tokens if prompt_tokens else chat_history.estimate_tokens(prompt)
+    usage["response_tokens"] = response_tokens if response_tokens else chat_history.estimate_tokens(response_text)
+    usage["token_count_source"] = "api" if prompt_tokens else "estimate"
+    # プロバイダー側のキャッシュから読まれたトークン数（APIが返した場合だけ）
+    cached_tokens = getattr(metadata, "cached_content_token_count", None)
+    if cached_tokens:
+        usage["cached_tokens"] = cached_tokens
 
-# --- ここから下のコードは、上記の修正により、変更の必要がありません ---
-# 呼び出し元の _initialize_gemini() がシンプルになっただけで、
-# これらの関数のロジックはそのまま正しく動作します。
+# --- 各AIの呼び出し ---
 
-def get_intent_from_ai(user_prompt: str) -> str:
-    """ユーザーのプロンプトを分析し、意図をJSON形式で返す。"""
+def get_intent_from_ai(
+    user_prompt: str, usage: dict = None, hedge: bool = False, priority: int = gemini_scheduler.PRIORITY_ANALYZER,
+    on_selection_fields=None
+) -> dict:
+    """
+    ユーザーのプロンプトを分析し、意図（intent の辞書）を返す。usage を渡すと、トークン数を書き込みます。
+    リクエストは共有の gemini_scheduler を通して送られ、割り当て超過やタイムアウトは再試行されます。
+    hedge=True（最初のターンなど）の場合、応答が遅ければ同じリクエストをもう1件送り、早い方を使います。
+    提案ボタンの先読み（prefetch）は priority=PRIORITY_BACKGROUND で呼び出し、画面で待っているリクエストを優先させます。
+
+    応答は、スキーマ（intent_stream.ANALYZER_RESPONSE_SCHEMA）で形を指定したJSONをストリームで受け取り、届いた順に解析します。
+    on_selection_fields を渡すと、key_metric と relevant_tags が届いた時点で呼び出します（商品選定を先に始めるため）。
+    JSONとして読めない・スキーマに合わない応答は、すぐに1度だけ再試行し、それでも不正なら InvalidIntentError を送出します。
+    通信エラーの場合は、空の辞書を返します。
+    """
     print("\n--- get_intent_from_ai function called ---", file=sys.stderr)
-    model = _initialize_gemini()
+    setup_start = time.perf_counter()
+    model = _initialize_gemini(ANALYZER_SYSTEM_PROMPT)
     if not model:
-        return "{}"
+        return {}
 
     try:
-        prompt_path = os.path.join(os.path.dirname(__file__), '..', 'prompts', 'system_prompt_analyzer.txt')
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            system_prompt = f.read()
-        full_prompt = f"{system_prompt}\n\n# ユーザーの要望:\n{user_prompt}"
-        response = model.generate_content(full_prompt)
-        cleaned_json = response.text.strip().lstrip("```json").rstrip("```")
-        print(f"  - AI Analyzer response (JSON) received.", file=sys.stderr)
-        return cleaned_json
+        turn_content = load_template(ANALYZER_TURN_TEMPLATE).render({"user_prompt": user_prompt})
+        print(f"  - Analyzer setup took {(time.perf_counter() - setup_start) * 1000:.2f} ms.", file=sys.stderr)
+        # トークン数の推定に使う、送信する全文（システム指示 + ターンごとの内容）
+        full_prompt = f"{load_prompt(ANALYZER_SYSTEM_PROMPT)}\n\n{turn_content}"
+        attempt = 0
+        while True:
+            response_stream = gemini_scheduler.get_scheduler().stream(
+                lambda: model.generate_content(turn_content, stream=True, generation_config=intent_stream.ANALYZER_GENERATION_CONFIG),
+                priority=priority,
+                retries=gemini_scheduler.ANALYZER_MAX_RETRIES,
+                hedge_after=gemini_scheduler.HEDGE_AFTER_SECONDS if hedge else None,
+                label="analyzer",
+            )
+            response_parts = []
+            last_chunk = None
+
+            def texts():
+                nonlocal last_chunk
+                for chunk in response_stream:
+                    last_chunk = chunk
+                    if chunk.text:
+                        response_parts.append(chunk.text)
+                        yield chunk.text
+            try:
+                intent = intent_stream.parse_intent_stream(texts(), on_selection_fields)
+            except intent_stream.InvalidIntentError as e:
+                if attempt >= ANALYZER_INVALID_RETRIES:
+                    raise
+                attempt += 1
+                print(f"  - AI Analyzer returned invalid JSON ({e}); retrying once.", file=sys.stderr)
+                continue
+            finally:
+                # 途中で読むのをやめた場合も、ここでストリームを閉じて枠を返します
+                response_stream.close()
+                if usage is not None:
+                    # やり直した場合は、不正だった応答の分もトークン数に含めます
+                    attempt_usage = {}
+                    _record_usage(attempt_usage, full_prompt, "".join(response_parts), last_chunk)
+                    for key in ("prompt_tokens", "response_tokens"):
+                        usage[key] = usage.get(key, 0) + attempt_usage[key]
+                    usage["token_count_source"] = attempt_usage["token_count_source"]
+            if usage is not None:
+                usage["invalid_retries"] = attempt
+            print(f"  - AI Analyzer response (JSON) received.", file=sys.stderr)
+            return intent
+    except intent_stream.InvalidIntentError:
+        print(f"!!!!!! ERROR !!!!!!: Gemini API (Analyzer) returned invalid JSON twice.", file=sys.stderr)
+        raise
     except Exception as e:
         error_message = f"Gemini API (Analyzer) communication error: {e}"
         print(f"!!!!!! ERROR !!!!!!: {error_message}", file=sys.stderr)
         st.error(error_message)
-        return "{}"
+        return {}
 
 def get_ai_response_writer(
     full_user_prompt: str, user_desire_summary: str, key_metric_name: str,
     selection_reason: str, baseline_product_data: str, selected_products_data: str,
-    chat_history: str, nutrition_tip: str
+    chat_history: str, nutrition_tip: str, usage: dict = None
 ):
-    """整形済みデータを受け取り、AI(コピーライター)から応答をストリームとして生成する"""
+    """
+    整形済みデータを受け取り、AI(コピーライター)から応答をストリームとして生成する。
+    usage を渡すと、ストリームの終了時にトークン数を書き込みます。
+    """
     print("\n--- get_ai_response_writer function called (streaming) ---", file=sys.stderr)
-    model = _initialize_gemini()
+    setup_start = time.perf_counter()
+    model = _initialize_gemini(WRITER_SYSTEM_PROMPT)
     if not model:
         yield "申し訳ありません、AIの初期化に失敗しました。"
         return
 
     try:
-        prompt_path = os.path.join(os.path.dirname(__file__), '..', 'prompts', 'system_prompt_writer.txt')
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            prompt_template = f.read()
-
-        system_prompt = prompt_template.replace(
-            "[full_user_prompt]", full_user_prompt
-        ).replace(
-            "[user_desire_summary]", user_desire_summary
-        ).replace(
-            "[key_metric_name]", key_metric_name
-        ).replace(
-            "[selection_reason]", selection_reason
-        ).replace(
-            "[baseline_product_data]", baseline_product_data
-        ).replace(
-            "[selected_products_data]", selected_products_data
-        ).replace(
-            "[chat_history]", chat_history
-        ).replace(
-            "[nutrition_tip]", nutrition_tip
+        turn_content = load_template(WRITER_TURN_TEMPLATE).render({
+            "full_user_prompt": full_user_prompt,
+            "user_desire_summary": user_desire_summary,
+            "key_metric_name": key_metric_name,
+            "selection_reason": selection_reason,
+            "baseline_product_data": baseline_product_data,
+            "selected_products_data": selected_products_data,
+            "chat_history": chat_history,
+            "nutrition_tip": nutrition_tip,
+        })
+        print(
+            f"  - Writer setup took {(time.perf_counter() - setup_start) * 1000:.2f} ms "
+            f"(client/prompt caches have saved ~{get_setup_stats()['estimated_saved_ms']:.1f} ms in this process).",
+            file=sys.stderr
         )
-        
-        response_stream = model.generate_content(system_prompt, stream=True)
+        # トークン数の推定に使う、送信する全文（システム指示 + ターンごとの内容）
+        full_prompt = f"{load_prompt(WRITER_SYSTEM_PROMPT)}\n\n{turn_content}"
+
+        # 画面で待っているストリームなので、先読みなどの裏方のリクエストより先に送り出します
+        response_stream = gemini_scheduler.get_scheduler().stream(
+            lambda: model.generate_content(turn_content, stream=True),
+            priority=gemini_scheduler.PRIORITY_WRITER,
+            label="writer",
+        )
+        response_parts = []
+        last_chunk = None
         for chunk in response_stream:
+            last_chunk = chunk
             if chunk.text:
+                response_parts.append(chunk.text)
                 yield chunk.text
+        # usage_metadata は最後のチャンクに、応答全体の値が入っています
+        _record_usage(usage, full_prompt, "".join(response_parts), last_chunk)
     except Exception as e:
         error_message = f"Gemini API (Writer) communication error: {e}"
         print(f"!!!!!! ERROR !!!!!!: {error_message}", file=sys.stderr)
@@ -0,0 +1,321 @@
+# modules/gemini_scheduler.py
+
+import heapq
+import itertools
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+# --- 割り当て（クォータ）と同時実行数 ---
+# プロジェクトの Gemini API の割り当てに合わせて設定します（1分あたりのリクエスト数と、瞬間的に許す件数）
+REQUESTS_PER_MINUTE = 240
+BURST = 10
+# プロセス全体で同時に送るリクエストの上限（ストリーミング中のコピーライターも1件と数えます）
+MAX_CONCURRENT = 16
+# 裏方のリクエスト（PRIORITY_BACKGROUND）は、この件数の枠を空けたままにできる場合だけ送ります（空いている枠だけを使う）
+BACKGROUND_RESERVED_SLOTS = 8
+
+# --- 再試行 ---
+# 分析官AIは応答が短いので、割り当て超過・タイムアウトの際は何度か再試行します
+ANALYZER_MAX_RETRIES = 3
+# コピーライターは、最初のチャンクが届く前に失敗した場合だけ再試行します（届いた後では文章が重複するため）
+WRITER_MAX_RETRIES = 1
+# 指数バックオフ（フルジッター）: 待ち時間は 0〜min(上限, 基準 × 2^試行回数) の一様乱数
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 8.0
+# この HTTP ステータス・例外名の失敗は、一時的なものとして再試行します
+RETRYABLE_CODES = {429, 500, 503, 504}
+RETRYABLE_ERROR_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded", "InternalServerError"}
+
+# --- ヘッジ ---
+# 最初のターンの分析官AIが、この秒数たっても応答しない場合は、同じリクエストをもう1件送って早い方を使います
+HEDGE_AFTER_SECONDS = 2.0
+
+# 優先度（小さいほど先に送ります）。画面で待っているコピーライターを、先読みなどの裏方の処理より優先します。
+PRIORITY_WRITER = 0
+PRIORITY_ANALYZER = 1
+PRIORITY_BACKGROUND = 2
+
+_END = object()
+
+
+def is_retryable(error: BaseException) -> bool:
+    """割り当て超過（429）・タイムアウト・一時的なサーバーエラーなど、再試行してよい失敗かどうか。"""
+    if isinstance(error, TimeoutError):
+        return True
+    code = getattr(error, "code", None)
+    try:
+        if code is not None and int(code) in RETRYABLE_CODES:
+            return True
+    except (TypeError, ValueError):
+        pass
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+def is_throttled(error: BaseException) -> bool:
+    code = getattr(error, "code", None)
+    try:
+        return int(code) == 429
+    except (TypeError, ValueError):
+        return type(error).__name__ in {"ResourceExhausted", "TooManyRequests"}
+
+
+def backoff_seconds(attempt: int, rng: random.Random = random) -> float:
+    return rng.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+class TokenBucket:
+    """1秒あたり rate 件まで、瞬間的には capacity 件まで許すトークンバケット（呼び出し側でロックを取ってください）。"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self) -> float:
+        """トークンを1つ取れたら 0 を、取れなければ次のトークンまでの秒数を返す。"""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def drain(self) -> None:
+        """割り当て超過が返ってきた時に、溜まっているトークンを捨てる（全員でしばらく待つため）。"""
+        self._refill()
+        self._tokens = min(self._tokens, 0.0)
+
+
+class GeminiScheduler:
+    """
+    Gemini へのリクエストを、プロセス全体でまとめて送り出すクラス（全セッションで1つ）。
+
+    - トークンバケットで、1分あたりのリクエスト数を割り当て以内に抑えます。
+    - 同時に送るリクエストの数を max_concurrent 件までに制限します。
+    - 空きを待つリクエストは、優先度の高い順（同じ優先度なら到着順）に送り出します。
+    - 裏方のリクエストは、画面で待っているリクエスト用の枠（background_reserved_slots 件）を残して送ります。
+    - 一時的な失敗（429・タイムアウトなど）は、ジッター付きの指数バックオフで再試行します。
+    """
+
+    def __init__(self, requests_per_minute: float = REQUESTS_PER_MINUTE, burst: float = BURST, max_concurrent: int = MAX_CONCURRENT, seed: Optional[int] = None,
+                 background_reserved_slots: int = BACKGROUND_RESERVED_SLOTS):
+        self.max_concurrent = max_concurrent
+        # 裏方のリクエストが使える同時実行数（少なくとも1件は送れるようにします）
+        self.background_limit = max(1, max_concurrent - background_reserved_slots)
+        self._bucket = TokenBucket(requests_per_minute / 60.0, burst)
+        self._cond = threading.Condition()
+        self._waiting: list = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._rng = random.Random(seed)
+        self._hedge_pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="gemini-hedge")
+        self.stats: Dict[str, float] = {
+            "requests": 0, "retries": 0, "throttled": 0, "failures": 0,
+            "hedges": 0, "hedge_wins": 0, "queue_wait_ms": 0.0, "max_queue_wait_ms": 0.0,
+        }
+
+    def _count(self, key: str, value: float = 1) -> None:
+        with self._cond:
+            self.stats[key] += value
+
+    @contextmanager
+    def slot(self, priority: int = PRIORITY_ANALYZER):
+        """リクエスト1件分の枠（同時実行数とトークン）を、優先度の順に確保する。"""
+        ticket = (priority, next(self._seq))
+        limit = self.background_limit if priority >= PRIORITY_BACKGROUND else self.max_concurrent
+        start = time.perf_counter()
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                if self._waiting[0] == ticket and self._in_flight < limit:
+                    wait = self._bucket.try_take()
+                    if wait == 0:
+                        break
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            waited_ms = (time.perf_counter() - start) * 1000
+            self.stats["requests"] += 1
+            self.stats["queue_wait_ms"] += waited_ms
+            self.stats["max_queue_wait_ms"] = max(self.stats["max_queue_wait_ms"], waited_ms)
+            # 次に並んでいるリクエストが、先頭になったかどうかを確認できるようにします
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _on_failure(self, error: BaseException, attempt: int, retries: int, label: str) -> None:
+        """失敗を記録し、再試行しない場合は例外を送出する。"""
+        if is_throttled(error):
+            self._count("throttled")
+            with self._cond:
+                self._bucket.drain()
+        if attempt >= retries or not is_retryable(error):
+            self._count("failures")
+            raise error
+        self._count("retries")
+        print(f"  - Gemini {label} failed ({error}); retrying ({attempt + 1}/{retries}).", file=sys.stderr)
+
+    def call(self, fn: Callable[[], Any], priority: int = PRIORITY_ANALYZER, retries: int = ANALYZER_MAX_RETRIES, hedge_after: Optional[float] = None, label: str = "request") -> Any:
+        """
+        fn()（generate_content の呼び出し）を、枠を確保してから実行する。一時的な失敗は retries 回まで再試行します。
+        hedge_after を指定すると、その秒数で応答がなく枠に空きがある場合に、同じリクエストをもう1件送ります。
+        """
+        if hedge_after is None:
+            return self._call_with_retries(fn, priority, retries, label)
+        return self._hedged_call(fn, priority, retries, hedge_after, label)
+
+    def _call_with_retries(self, fn, priority, retries, label):
+        attempt = 0
+        while True:
+            with self.slot(priority):
+                try:
+                    return fn()
+                except Exception as e:
+                    self._on_failure(e, attempt, retries, label)
+            time.sleep(backoff_seconds(attempt, self._rng))
+            attempt += 1
+
+    def _has_spare_capacity(self) -> bool:
+        with self._cond:
+            return not self._waiting and self._in_flight < self.max_concurrent
+
+    def _hedged_call(self, fn, priority, retries, hedge_after, label):
+        results: "queue.Queue" = queue.Queue()
+
+        def attempt(kind):
+            try:
+                results.put((kind, True, self._call_with_retries(fn, priority, retries, label)))
+            except Exception as e:
+                results.put((kind, False, e))
+
+        self._hedge_pool.submit(attempt, "primary")
+        outstanding = 1
+        try:
+            kind, ok, value = results.get(timeout=hedge_after)
+        except queue.Empty:
+            # 混み合っている時はヘッジを送りません（他のセッションの枠を奪わないため）
+            if self._has_spare_capacity():
+                self._count("hedges")
+                self._hedge_pool.submit(attempt, "hedge")
+                outstanding = 2
+            kind, ok, value = results.get()
+        outstanding -= 1
+        if not ok and outstanding:
+            kind, ok, value = results.get()
+        if not ok:
+            raise value
+        if kind == "hedge":
+            self._count("hedge_wins")
+        return value
+
+    def stream(self, open_stream: Callable[[], Iterable[Any]], priority: int = PRIORITY_WRITER, retries: int = WRITER_MAX_RETRIES, hedge_after: Optional[float] = None, label: str = "stream") -> Iterator[Any]:
+        """
+        open_stream()（stream=True の generate_content）のチャンクを返すジェネレーター。
+        枠はストリームを読み終える（または読むのをやめる）まで確保したままにします。
+        最初のチャンクが届く前の一時的な失敗だけを、retries 回まで再試行します。
+        hedge_after を指定すると、その秒数で最初のチャンクが届かず枠に空きがある場合に、同じリクエストをもう1件送り、
+        先に最初のチャンクが届いた方を使います（遅れた方は、最初のチャンクが届いた時点で読むのをやめます）。
+        """
+        if hedge_after is None:
+            return self._stream_with_retries(open_stream, priority, retries, label)
+        return self._hedged_stream(open_stream, priority, retries, hedge_after, label)
+
+    def _stream_with_retries(self, open_stream, priority, retries, label):
+        attempt = 0
+        while True:
+            with self.slot(priority):
+                try:
+                    iterator = iter(open_stream())
+                    first = next(iterator, _END)
+                except Exception as e:
+                    self._on_failure(e, attempt, retries, label)
+                else:
+                    if first is not _END:
+                        yield first
+                        yield from iterator
+                    return
+            time.sleep(backoff_seconds(attempt, self._rng))
+            attempt += 1
+
+    def _hedged_stream(self, open_stream, priority, retries, hedge_after, label):
+        results: "queue.Queue" = queue.Queue()
+
+        def attempt(kind):
+            chunks = self._stream_with_retries(open_stream, priority, retries, label)
+            try:
+                results.put((kind, chunks, next(chunks, _END), None))
+            except Exception as e:
+                results.put((kind, chunks, None, e))
+
+        self._hedge_pool.submit(attempt, "primary")
+        outstanding = 1
+        try:
+            result = results.get(timeout=hedge_after)
+        except queue.Empty:
+            if self._has_spare_capacity():
+                self._count("hedges")
+                self._hedge_pool.submit(attempt, "hedge")
+                outstanding = 2
+            result = results.get()
+        outstanding -= 1
+        if result[3] is not None and outstanding:
+            result = results.get()
+            outstanding -= 1
+        if outstanding:
+            # 遅れた方は、最初のチャンクが届いた（または失敗した）時点で閉じて、枠を返します
+            self._hedge_pool.submit(lambda: results.get()[1].close())
+        kind, chunks, first, error = result
+        if error is not None:
+            raise error
+        if kind == "hedge":
+            self._count("hedge_wins")
+        try:
+            if first is not _END:
+                yield first
+                yield from chunks
+        finally:
+            chunks.close()
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._cond:
+            stats = dict(self.stats)
+            stats.update(in_flight=self._in_flight, waiting=len(self._waiting))
+        stats["avg_queue_wait_ms"] = stats["queue_wait_ms"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> GeminiScheduler:
+    """プロセス全体で共有する GeminiScheduler を返す。"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = GeminiScheduler()
+        return _scheduler
+
+
+def set_scheduler(scheduler: Optional[GeminiScheduler]) -> None:
+    """共有の GeminiScheduler を差し替える（負荷試験で割り当てを変える場合など。None で既定に戻ります）。"""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
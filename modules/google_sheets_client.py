@@ -66,4 +66,34 @@ def get_all_records():
         return pd.DataFrame()
     except Exception as e:
         st.error(f"Google Sheetsからのデータ読み込み中に予期せぬエラーが発生しました: {e}")
-        return pd.DataFrame()
\ No newline at end of file
+        return pd.DataFrame()
+
+class GoogleSheetsSource:
+    """
+    catalog_store.CatalogStore から使う、Googleスプレッドシートのデータソース。
+    バックグラウンドのスレッドから呼ばれるため、st.error は使わず、失敗は例外として呼び出し元に伝えます。
+    """
+
+    def __init__(self, spreadsheet_name: str = "Synapse_ProteinDB_v1", worksheet_name: str = "シート1"):
+        self.spreadsheet_name = spreadsheet_name
+        self.worksheet_name = worksheet_name
+        self._spreadsheet = None
+
+    def _open(self):
+        if self._spreadsheet is None:
+            gc = _get_gspread_client()
+            if not gc:
+                raise RuntimeError("Google Sheetsへの接続認証に失敗しました。")
+            self._spreadsheet = gc.open(self.spreadsheet_name)
+        return self._spreadsheet
+
+    def get_revision(self):
+        """シートの最終更新日時を返す。行データは取得しないので軽量です。"""
+        return self._open().get_lastUpdateTime()
+
+    def get_records(self):
+        """ワークシートの全レコードを辞書のリストで返す。"""
+        worksheet = self._open().worksheet(self.worksheet_name)
+        records = worksheet.get_all_records()
+        print(f"--- [SUCCESS] Successfully fetched records from '{self.spreadsheet_name}'. ---", file=sys.stderr)
+        return records
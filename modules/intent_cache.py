@@ -0,0 +1,190 @@
+# modules/intent_cache.py
+
+import copy
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+# MinHash の設定。署名長 = BANDS * ROWS_PER_BAND。
+SHINGLE_SIZE = 2
+BANDS = 16
+ROWS_PER_BAND = 4
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.default_rng(20240601)
+_HASH_A = _rng.integers(1, (1 << 61) - 1, size=BANDS * ROWS_PER_BAND, dtype=np.uint64)
+_HASH_B = _rng.integers(0, (1 << 61) - 1, size=BANDS * ROWS_PER_BAND, dtype=np.uint64)
+
+_IGNORED_CHARS = re.compile(r'[\s\W_]+', re.UNICODE)
+
+
+def normalize_text(text: str) -> str:
+    """全角・半角、大文字・小文字、空白や記号の違いを吸収した比較用の文字列を返す関数。"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return _IGNORED_CHARS.sub('', text)
+
+
+def _shingles(normalized: str) -> frozenset:
+    if len(normalized) <= SHINGLE_SIZE:
+        return frozenset([normalized])
+    return frozenset(normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1))
+
+
+def _minhash_signature(shingles: frozenset) -> np.ndarray:
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little') >> 3 for s in shingles],
+        dtype=np.uint64,
+    )
+    # (a * h + b) mod p を全ての署名要素について一度に計算します（uint64 の桁あふれは許容）
+    permuted = (np.outer(_HASH_A, hashes) + _HASH_B[:, None]) % _MERSENNE_PRIME
+    return permuted.min(axis=1)
+
+
+def _band_keys(context_key: str, signature: np.ndarray):
+    for band in range(BANDS):
+        values = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        yield (context_key, band, values.tobytes())
+
+
+class IntentCache:
+    """
+    分析官AIの結果（intent の辞書）をキャッシュする2段構えのキャッシュ。
+
+    - 第1段: 正規化した文字列の完全一致。
+    - 第2段: 文字n-gramの MinHash 署名（LSH）による、ほぼ同じ文章の検索。
+      「安い」と「高い」のような1語違いを取り違えないよう、Jaccard係数に加えて、
+      異なるn-gramの数にも上限を設けています。
+
+    context（初回のペルソナ文など）が異なる要望は、別のものとして扱います。
+    version_fn が返す値（分析官プロンプトの mtime など）が変わると、キャッシュ全体を破棄します。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: float = 3600,
+        min_jaccard: float = 0.85,
+        max_shingle_diff: int = 4,
+        version_fn: Optional[Callable[[], Any]] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.min_jaccard = min_jaccard
+        self.max_shingle_diff = max_shingle_diff
+        self._version_fn = version_fn
+        self._version = None
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Any, Dict[str, Any]]" = OrderedDict()
+        self._buckets: Dict[Any, set] = {}
+        self.stats = {"exact_hits": 0, "near_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, text: str, context: str = "") -> Optional[Dict[str, Any]]:
+        """キャッシュ済みの intent を返す。見つからなければ None。"""
+        normalized = normalize_text(text)
+        context_key = hashlib.sha1(context.encode('utf-8')).hexdigest()
+        key = (context_key, normalized)
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry):
+                self._entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return copy.deepcopy(entry["intent"])
+
+            shingles = _shingles(normalized)
+            signature = _minhash_signature(shingles)
+            best_key, best_score = None, 0.0
+            for band_key in _band_keys(context_key, signature):
+                for candidate_key in self._buckets.get(band_key, ()):
+                    candidate = self._entries[candidate_key]
+                    if self._expired(candidate):
+                        continue
+                    other = candidate["shingles"]
+                    union = len(shingles | other)
+                    score = len(shingles & other) / union if union else 0.0
+                    if score > best_score and union - len(shingles & other) <= self.max_shingle_diff:
+                        best_key, best_score = candidate_key, score
+
+            if best_key is not None and best_score >= self.min_jaccard:
+                self._entries.move_to_end(best_key)
+                self.stats["near_hits"] += 1
+                return copy.deepcopy(self._entries[best_key]["intent"])
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, text: str, intent: Dict[str, Any], context: str = "") -> None:
+        """分析官の結果を保存する（空の結果は保存しません）。"""
+        if not intent:
+            return
+        normalized = normalize_text(text)
+        context_key = hashlib.sha1(context.encode('utf-8')).hexdigest()
+        key = (context_key, normalized)
+        shingles = _shingles(normalized)
+        signature = _minhash_signature(shingles)
+        with self._lock:
+            self._check_version()
+            if key in self._entries:
+                self._remove(key)
+            band_keys = list(_band_keys(context_key, signature))
+            self._entries[key] = {
+                "intent": copy.deepcopy(intent),
+                "shingles": shingles,
+                "band_keys": band_keys,
+                "created_at": time.monotonic(),
+            }
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expired(self, entry) -> bool:
+        return time.monotonic() - entry["created_at"] > self.ttl_seconds
+
+    def _remove(self, key) -> None:
+        entry = self._entries.pop(key)
+        for band_key in entry["band_keys"]:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def _check_version(self) -> None:
+        if self._version_fn is None:
+            return
+        version = self._version_fn()
+        if version != self._version:
+            if self._entries:
+                self.stats["invalidations"] += 1
+            self._entries.clear()
+            self._buckets.clear()
+            self._version = version
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_cache() -> IntentCache:
+    """プロセス全体で共有する IntentCache を返す（分析官プロンプトが更新されると自動で無効化されます）。"""
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            from modules import gemini_client
+            _shared_cache = IntentCache(version_fn=lambda: gemini_client.get_prompt_version('system_prompt_analyzer.txt'))
+        return _shared_cache
@@ -0,0 +1,120 @@
+# modules/intent_classifier.py
+
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from modules.intent_cache import normalize_text
+
+# この確信度以上で、かつ曖昧さがない場合だけ、分析官AIを呼ばずにこの分類結果を使います
+FAST_PATH_CONFIDENCE = 0.8
+
+# 分析官AIの出力を記録するファイル（環境変数で指定した場合のみ）。evaluate_intent_classifier.py の入力になります。
+INTENT_LOG_PATH = os.environ.get("SYNAPSE_INTENT_LOG")
+
+# key_metric ごとのキーワードと重み（正規化後の文字列に対する部分一致）
+METRIC_LEXICON = {
+    "PricePerKg(JPY)": [("安い", 1.0), ("安く", 1.0), ("安め", 1.0), ("コスパ", 1.0), ("コストパフォーマンス", 1.0), ("節約", 0.8), ("お得", 0.8), ("値段", 0.6), ("価格", 0.6), ("格安", 1.0)],
+    "ProteinPerServing(g)": [("タンパク質が多", 1.0), ("たんぱく質が多", 1.0), ("タンパク質多", 1.0), ("高タンパク", 1.0), ("含有率", 1.0), ("タンパク質量", 0.9), ("純度", 0.8), ("wpi", 0.7)],
+    "Taste": [("美味しい", 1.0), ("おいしい", 1.0), ("美味しく", 1.0), ("おいしく", 1.0), ("うまい", 0.9), ("味", 0.8), ("フレーバー", 0.9), ("飲みやすい味", 1.0)],
+    "FatPerServing(g)": [("脂質", 1.0), ("脂肪", 0.9), ("低脂肪", 1.0)],
+    "CarbPerServing(g)": [("炭水化物", 1.0), ("糖質", 1.0), ("低糖", 1.0)],
+    "Solubility": [("溶けやすい", 1.0), ("溶けやす", 1.0), ("ダマ", 0.9), ("混ざりやす", 0.9)],
+    "Reputation": [("有名", 0.9), ("人気", 0.9), ("評判", 1.0), ("口コミ", 1.0), ("レビュー", 0.9)],
+}
+
+# relevant_tags 用のキーワード -> ペルソナ・タグ
+TAG_LEXICON = [
+    ("フルーツ", "#フルーティー"), ("フルーティ", "#フルーティー"), ("さっぱり", "#さっぱり"),
+    ("国産", "#国内製造"), ("国内", "#国内製造"), ("無添加", "#無添加"), ("人工甘味料", "#人工甘味料不使用"),
+    ("初心者", "#初心者"), ("はじめて", "#初心者"), ("初めて", "#初心者"),
+    ("増量", "#増量"), ("バルク", "#バルクアップ"), ("ダイエット", "#ダイエット"), ("減量", "#減量"), ("引き締め", "#引き締め"),
+    ("ソイ", "#ソイ"), ("大豆", "#ソイ"), ("チョコ", "#チョコ"), ("抹茶", "#抹茶"), ("バニラ", "#バニラ"),
+]
+
+# 分析官の出力例に合わせた要約文
+SUMMARY_TEMPLATES = {
+    "PricePerKg(JPY)": "価格が安いこと（コストパフォーマンス）",
+    "ProteinPerServing(g)": "タンパク質の含有量が多いこと",
+    "Taste": "味が美味しいこと",
+    "FatPerServing(g)": "脂質が少ないこと",
+    "CarbPerServing(g)": "炭水化物（糖質）が少ないこと",
+    "Solubility": "溶けやすく飲みやすいこと",
+    "Reputation": "評判が良く安心できるブランドであること",
+}
+
+# 否定や、前の会話を参照する表現。これらを含む要望は文脈の解釈が必要なので、確信度を下げます。
+HEDGE_WORDS = ["ない", "なく", "じゃな", "以外", "より高くても", "てもいい", "でもいい", "さっき", "それ", "あれ", "他の", "ほかの", "前の", "?", "？"]
+
+# これより長い要望は、複数の条件や微妙なニュアンスを含みやすいため、確信度を下げます
+LONG_TEXT_CHARS = 40
+
+
+def classify_intent(text: str) -> Tuple[Dict[str, Any], float]:
+    """
+    ルールと語彙だけで要望を分類し、(分析官と同じ形式の intent, 確信度 0.0〜1.0) を返す関数。
+    ネットワークを使わないので、1ミリ秒もかかりません。
+    """
+    normalized = normalize_text(text)
+    scores = {}
+    for metric, keywords in METRIC_LEXICON.items():
+        score = max((weight for keyword, weight in keywords if keyword in normalized), default=0.0)
+        if score > 0:
+            scores[metric] = score
+
+    tags: List[str] = []
+    for keyword, tag in TAG_LEXICON:
+        if keyword in normalized and tag not in tags:
+            tags.append(tag)
+
+    if not scores:
+        intent = {
+            "key_metric": "Other",
+            "user_desire_summary": "漠然と、より良いものを探している",
+            "relevant_tags": tags,
+            "handle_ambiguity": True,
+        }
+        return intent, 0.0
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    key_metric, best = ranked[0]
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+
+    confidence = best - 0.5 * runner_up
+    hedge_target = (text or "").replace("少ない", "").replace("少なく", "")
+    if any(word in hedge_target for word in HEDGE_WORDS):
+        confidence -= 0.4
+    if len(normalized) > LONG_TEXT_CHARS:
+        confidence -= 0.3
+    confidence = max(0.0, min(1.0, confidence))
+
+    intent = {
+        "key_metric": key_metric,
+        "user_desire_summary": SUMMARY_TEMPLATES[key_metric],
+        "relevant_tags": tags,
+        "handle_ambiguity": confidence < FAST_PATH_CONFIDENCE and runner_up > 0,
+    }
+    return intent, confidence
+
+
+def is_confident(intent: Dict[str, Any], confidence: float) -> bool:
+    """分析官AIの呼び出しを省略してよいかを判定する関数。"""
+    return confidence >= FAST_PATH_CONFIDENCE and not intent.get("handle_ambiguity", False)
+
+
+_log_lock = threading.Lock()
+
+
+def record_analyzer_output(prompt: str, context: str, intent: Dict[str, Any], latency_ms: float) -> None:
+    """
+    分析官AIの出力を JSONL に追記する関数（SYNAPSE_INTENT_LOG が設定されている場合のみ）。
+    オフライン評価で、このルール分類器との一致率と、省略できた時間を測るために使います。
+    """
+    if not INTENT_LOG_PATH:
+        return
+    record = {"ts": time.time(), "prompt": prompt, "context": context, "intent": intent, "latency_ms": round(latency_ms, 1)}
+    with _log_lock:
+        with open(INTENT_LOG_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -0,0 +1,169 @@
+# modules/intent_stream.py
+
+import json
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# 分析官AIが返しうる key_metric（prompts/system_prompt_analyzer.txt の選択肢リストと同じです）
+ANALYZER_KEY_METRICS = [
+    "ProteinPerServing(g)", "PricePerKg(JPY)", "FatPerServing(g)", "CarbPerServing(g)",
+    "Taste", "Solubility", "Reputation", "Other",
+]
+
+# 分析官AIの応答のスキーマ（generation_config の response_schema に渡し、この形のJSONだけを出力させます）。
+# Gemini は、スキーマのプロパティをアルファベット順に出力します。そのため、商品選定に必要な key_metric と
+# relevant_tags は、生成に時間のかかる user_desire_summary より先に届きます。
+ANALYZER_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "handle_ambiguity": {"type": "BOOLEAN"},
+        "key_metric": {"type": "STRING", "format": "enum", "enum": ANALYZER_KEY_METRICS},
+        "relevant_tags": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "user_desire_summary": {"type": "STRING"},
+    },
+    "required": ["handle_ambiguity", "key_metric", "relevant_tags", "user_desire_summary"],
+}
+ANALYZER_GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": ANALYZER_RESPONSE_SCHEMA}
+
+# 商品選定（select_products）・豆知識・商品データの整形が使う項目。
+# この2つが揃えば、要約（user_desire_summary）の生成を待たずに選定を始められます。
+SELECTION_FIELDS = ("key_metric", "relevant_tags")
+
+
+class InvalidIntentError(ValueError):
+    """分析官AIの応答が、JSONとして読めないか、スキーマに合わない場合の例外。"""
+
+
+def validate_intent(intent: Any, fields: Optional[Iterable[str]] = None) -> List[str]:
+    """
+    intent が ANALYZER_RESPONSE_SCHEMA に合っているかを確かめ、問題点のリストを返す（空なら正しい形です）。
+    fields を渡すと、その項目だけを確かめます（ストリームの途中で、届いた項目だけを確かめる場合）。
+    """
+    if not isinstance(intent, dict):
+        return [f"intent is {type(intent).__name__}, not an object"]
+    errors = []
+    for field in (fields if fields is not None else ANALYZER_RESPONSE_SCHEMA["required"]):
+        if field not in intent:
+            errors.append(f"missing {field}")
+            continue
+        value = intent[field]
+        if field == "key_metric" and value not in ANALYZER_KEY_METRICS:
+            errors.append(f"unknown key_metric {value!r}")
+        elif field == "relevant_tags" and not (isinstance(value, list) and all(isinstance(tag, str) for tag in value)):
+            errors.append("relevant_tags is not a list of strings")
+        elif field == "user_desire_summary" and not (isinstance(value, str) and value.strip()):
+            errors.append("user_desire_summary is empty")
+        elif field == "handle_ambiguity" and not isinstance(value, bool):
+            errors.append("handle_ambiguity is not a boolean")
+    return errors
+
+
+class IncrementalObjectParser:
+    """
+    ストリームで少しずつ届くJSONオブジェクトを読み、トップレベルの項目が1つ完成するたびに返すパーサー。
+    最初の "{" より前の文字（```json など）と、オブジェクトが閉じた後の文字は読み飛ばします。
+    値の中身（文字列・配列・入れ子のオブジェクト）は、完成した時点で json.loads で読みます。
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self.complete = False
+        self._state = "start"  # start -> key -> colon -> value -> key ... -> (complete)
+        self._token: List[str] = []
+        self._key: Optional[str] = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        """text を読み進め、この呼び出しで完成した (項目名, 値) のリストを返す。不正なJSONなら InvalidIntentError を送出します。"""
+        completed = []
+        for ch in text:
+            if self.complete:
+                break
+            if self._state == "start":
+                if ch == "{":
+                    self._state = "key"
+                continue
+            if self._in_string:
+                self._token.append(ch)
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._state == "key":
+                        self._key = json.loads("".join(self._token))
+                        self._token = []
+                        self._state = "colon"
+                continue
+
+            if self._state == "key":
+                if ch == '"':
+                    self._in_string = True
+                    self._token = [ch]
+                elif ch == "}":
+                    self.complete = True
+                elif not (ch.isspace() or ch == ","):
+                    raise InvalidIntentError(f"unexpected {ch!r} before a key")
+            elif self._state == "colon":
+                if ch == ":":
+                    self._state = "value"
+                    self._token = []
+                    self._depth = 0
+                elif not ch.isspace():
+                    raise InvalidIntentError(f"expected ':' after {self._key!r}, got {ch!r}")
+            elif self._depth == 0 and ch in ",}":
+                completed.append(self._finish_value())
+                if ch == "}":
+                    self.complete = True
+                else:
+                    self._state = "key"
+            else:
+                self._token.append(ch)
+                if ch == '"':
+                    self._in_string = True
+                elif ch in "[{":
+                    self._depth += 1
+                elif ch in "]}":
+                    self._depth -= 1
+                    if self._depth < 0:
+                        raise InvalidIntentError(f"unbalanced {ch!r} in {self._key!r}")
+        return completed
+
+    def _finish_value(self) -> Tuple[str, Any]:
+        raw = "".join(self._token).strip()
+        try:
+            value = json.loads(raw)
+        except ValueError as e:
+            raise InvalidIntentError(f"invalid value for {self._key!r}: {e}") from e
+        self.fields[self._key] = value
+        self._token = []
+        return self._key, value
+
+    def close(self) -> Dict[str, Any]:
+        """ストリームの終わりに呼び、完成したオブジェクトを返す（途中で切れていれば InvalidIntentError）。"""
+        if not self.complete:
+            raise InvalidIntentError("response ended before the JSON object was closed")
+        return dict(self.fields)
+
+
+def parse_intent_stream(chunks: Iterable[str], on_selection_fields: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    分析官AIの応答（テキストのチャンク）を読み、スキーマを確かめた intent を返す。
+    on_selection_fields を渡すと、SELECTION_FIELDS が揃って正しい形だった時点で（ストリームの途中で）、
+    その項目だけの辞書で1度だけ呼び出します。応答が不正な場合は InvalidIntentError を送出します。
+    """
+    parser = IncrementalObjectParser()
+    notified = on_selection_fields is None
+    for chunk in chunks:
+        if not parser.feed(chunk) or notified:
+            continue
+        if all(field in parser.fields for field in SELECTION_FIELDS) and not validate_intent(parser.fields, SELECTION_FIELDS):
+            notified = True
+            on_selection_fields({field: parser.fields[field] for field in SELECTION_FIELDS})
+    intent = parser.close()
+    errors = validate_intent(intent)
+    if errors:
+        raise InvalidIntentError("; ".join(errors))
+    return intent
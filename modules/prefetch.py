@@ -0,0 +1,188 @@
+# modules/prefetch.py
+
+import os
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from modules import catalog_store
+from modules import gemini_scheduler
+from modules import protein_selector
+from modules import turn_pipeline
+
+# 提案ボタンの先読みを使うかどうか（環境変数で "0" を指定すると無効になります）
+PREFETCH_ENABLED = os.environ.get("SYNAPSE_PREFETCH", "1") != "0"
+# 先読みを実行するスレッドの数（プロセス全体で共有します）と、1つの応答あたりに先読みする提案の数
+MAX_WORKERS = 4
+MAX_SUGGESTIONS = 4
+# 提案ボタンが押された時に、実行中の先読みの完了を待つ上限（秒）。
+# 先読みの分析官AIは後回しにされるので、混み合っている時は待たずにその場で処理し直します。
+MAX_WAIT_SECONDS = 1.0
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="suggestion-prefetch")
+
+# プロセス全体の計測値（stats() で参照できます）
+#   started: 先読みを始めた件数 / hits: 先読みの結果を使えたターン / misses: 先読みがあったのに使えなかったターン
+#   waited: hits のうち、先読みの完了を待ったターン / failed: 先読みが失敗した件数 / stale: カタログの差し替えなどで使えなかった件数
+#   cancelled: 実行前に取り消せた件数
+#   wasted: 実行したのに使わなかった件数 / wasted_analyzer_calls: そのうち分析官AIを呼んだ件数（APIの無駄な支出）
+_stats = {
+    "started": 0, "hits": 0, "misses": 0, "waited": 0, "failed": 0, "stale": 0,
+    "cancelled": 0, "wasted": 0, "analyzer_calls": 0, "wasted_analyzer_calls": 0, "saved_ms": 0.0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str, value: float = 1) -> None:
+    with _stats_lock:
+        _stats[key] += value
+
+
+def stats() -> Dict[str, float]:
+    """先読みの計測値と、ヒット率（先読みがあったターンのうち使えた割合）・無駄になった割合を返す。"""
+    with _stats_lock:
+        result = dict(_stats)
+    resolved = result["hits"] + result["misses"]
+    result["hit_rate"] = result["hits"] / resolved if resolved else None
+    result["waste_rate"] = result["wasted"] / result["started"] if result["started"] else None
+    return result
+
+
+class PrefetchedSelection:
+    """先読みの結果（意図と select_products の戻り値）。turn_pipeline.prepare_turn にそのまま渡せます。"""
+
+    def __init__(self, prompt: str, intent: Dict[str, Any], selection: Tuple, attributes: Dict[str, Any], snapshot_version: str, persona_key: Tuple, elapsed_ms: float):
+        self.prompt = prompt
+        self.intent = intent
+        self.selection = selection
+        self.attributes = attributes
+        self.snapshot_version = snapshot_version
+        self.persona_key = persona_key
+        self.elapsed_ms = elapsed_ms
+
+
+def _persona_key(persona: Dict[str, Any]) -> Tuple:
+    """商品選定の結果を左右するペルソナの項目（先読みした時と変わっていれば、結果は使いません）。"""
+    priorities = persona.get('priorities') or {}
+    return (persona.get('baseline_product_id'), persona.get('current_brand'), tuple(sorted(k for k, v in priorities.items() if v)))
+
+
+def _prefetch_one(prompt: str, protein_df: pd.DataFrame, persona: Dict[str, Any]) -> PrefetchedSelection:
+    """
+    提案1件について、次のターンの意図の判定と商品選定を行う（prepare_turn の2ターン目以降と同じ入力です）。
+    分析官AIへのリクエストは、画面で待っているリクエストより後回しにします。
+    """
+    start = time.perf_counter()
+    attributes: Dict[str, Any] = {}
+    intent = turn_pipeline.resolve_intent(prompt, "", prompt, attributes, priority=gemini_scheduler.PRIORITY_BACKGROUND)
+    if attributes.get("intent_source") == "analyzer":
+        _count("analyzer_calls")
+    if not intent or attributes.get("intent_source") == "classifier_fallback":
+        # 分析官AIとの通信に失敗した場合（空の intent）や、不正な応答が続いた場合は、実際のターンでもう一度試します
+        raise RuntimeError("analyzer returned no valid intent")
+    selection = protein_selector.select_products(protein_df, intent, persona)
+    return PrefetchedSelection(
+        prompt, intent, selection, attributes, catalog_store.snapshot_version(protein_df), _persona_key(persona),
+        (time.perf_counter() - start) * 1000,
+    )
+
+
+def _discard(future: Future) -> None:
+    """使わなかった先読みを取り消す。実行中のものは止められないので、完了した時に無駄として数えます。"""
+    if future.cancel():
+        _count("cancelled")
+        return
+
+    def on_done(done: Future) -> None:
+        if done.cancelled() or done.exception() is not None:
+            return
+        _count("wasted")
+        if done.result().attributes.get("intent_source") == "analyzer":
+            _count("wasted_analyzer_calls")
+    future.add_done_callback(on_done)
+
+
+class SuggestionPrefetcher:
+    """
+    1セッション分の、提案ボタンの先読み（st.session_state に置きます）。
+
+    - 応答の [SUGGESTIONS] が解析された時点で start() を呼ぶと、提案ごとに分析官AIと select_products を
+      共有のスレッドプールで先に実行しておきます。
+    - 次のターンで take() を呼ぶと、その要望の先読みがあれば結果を返し（実行中なら完了を待ちます）、
+      残りの先読み（ユーザーが自由入力した場合は全て）は取り消すか、無駄として数えます。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures: Dict[str, Future] = {}
+
+    def start(self, suggestions: List[str], protein_df: pd.DataFrame, persona: Dict[str, Any]) -> None:
+        if not PREFETCH_ENABLED or not suggestions:
+            return
+        # 先読みの間にペルソナが書き換えられても影響しないよう、コピーを渡します
+        persona = dict(persona, priorities=dict(persona.get('priorities') or {}))
+        futures = {}
+        for suggestion in dict.fromkeys(suggestions[:MAX_SUGGESTIONS]):
+            futures[suggestion] = _executor.submit(_prefetch_one, suggestion, protein_df, persona)
+        _count("started", len(futures))
+        with self._lock:
+            previous, self._futures = self._futures, futures
+        for future in previous.values():
+            _discard(future)
+
+    def take(self, prompt: str, protein_df: pd.DataFrame, persona: Dict[str, Any]) -> Optional[PrefetchedSelection]:
+        """prompt の先読み結果を返す（なければ None）。呼び出した時点で、このセッションの他の先読みは全て破棄します。"""
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        if not futures:
+            return None
+        future = futures.pop(prompt, None)
+        for other in futures.values():
+            _discard(other)
+        if future is None:
+            _count("misses")
+            return None
+        if future.cancel():
+            # まだ実行されていなければ、実際のターンで処理した方が早いので取り消します
+            _count("cancelled")
+            _count("misses")
+            return None
+
+        waited = not future.done()
+        wait_start = time.perf_counter()
+        try:
+            result = future.result(timeout=MAX_WAIT_SECONDS)
+        except FutureTimeoutError:
+            print(f"  - Suggestion prefetch still running after {MAX_WAIT_SECONDS:.1f} s, resolving live.", file=sys.stderr)
+            _discard(future)
+            _count("misses")
+            return None
+        except (CancelledError, Exception) as e:
+            print(f"  - Suggestion prefetch failed, resolving live: {e}", file=sys.stderr)
+            _count("failed")
+            _count("misses")
+            return None
+        if result.snapshot_version != catalog_store.snapshot_version(protein_df) or result.persona_key != _persona_key(persona):
+            # 先読みの後にカタログが差し替えられた（またはペルソナが変わった）場合は使いません
+            _count("stale")
+            _count("misses")
+            _count("wasted")
+            return None
+        saved_ms = max(0.0, result.elapsed_ms - (time.perf_counter() - wait_start) * 1000)
+        _count("hits")
+        _count("waited", int(waited))
+        _count("saved_ms", saved_ms)
+        print(f"  - Turn served from suggestion prefetch ({saved_ms:.0f} ms saved{', waited for it' if waited else ''}).", file=sys.stderr)
+        return result
+
+    def cancel(self) -> None:
+        """このセッションの先読みを全て破棄する。"""
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            _discard(future)
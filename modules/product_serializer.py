@@ -0,0 +1,115 @@
+# modules/product_serializer.py
+
+import math
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from modules import catalog_store
+
+# コピーライターに必ず渡す列（見出しの「ブランド名」「ID」と、マップ上の位置の説明に使う2軸）
+BASE_FIELDS = ['ProductID', 'Brand', 'ProductName', 'ProteinPurity(%)', 'PricePerKg(JPY)']
+
+# key_metric ごとに追加で渡す列（提案文の「客観的な事実」の裏付けに使うもの）
+METRIC_FIELDS = {
+    'PricePerKg(JPY)': ['Price(JPY)', 'WeightInKg', 'PricePerProteinGram(JPY)'],
+    'ProteinPerServing(g)': ['ProteinPerServing(g)', 'ServingSize(g)'],
+    'FatPerServing(g)': ['FatPerServing(g)', 'ServingSize(g)'],
+    'CarbPerServing(g)': ['CarbPerServing(g)', 'ServingSize(g)'],
+    'Solubility': ['Solubility'],
+    'Taste': ['Flavor', 'PersonaTags'],
+}
+DEFAULT_EXTRA_FIELDS = ['Price(JPY)', 'WeightInKg', 'PersonaTags']
+
+# 列名 -> (AIに見せるラベル, 値の書式)
+FIELD_FORMATS = {
+    'ProductID': ('ID', '{}'),
+    'Brand': ('ブランド', '{}'),
+    'ProductName': ('商品名', '{}'),
+    'Flavor': ('フレーバー', '{}'),
+    'PersonaTags': ('特徴', '{}'),
+    'ProteinPurity(%)': ('タンパク質含有率', '{:.1f}%'),
+    'PricePerKg(JPY)': ('1kgあたり価格', '{:,.0f}円'),
+    'Price(JPY)': ('価格', '{:,.0f}円'),
+    'PricePerProteinGram(JPY)': ('タンパク質1gあたり価格', '{:.2f}円'),
+    'WeightInKg': ('内容量', '{:g}kg'),
+    'ProteinPerServing(g)': ('1食のタンパク質', '{:g}g'),
+    'ServingSize(g)': ('1食', '{:g}g'),
+    'FatPerServing(g)': ('1食の脂質', '{:g}g'),
+    'CarbPerServing(g)': ('1食の炭水化物', '{:g}g'),
+    'Solubility': ('溶けやすさ(5段階)', '{:g}'),
+}
+
+
+def fields_for_metric(key_metric: Optional[str]) -> Tuple[str, ...]:
+    """key_metric に応じて、コピーライターに渡す列の並びを返す関数。"""
+    fields = list(BASE_FIELDS)
+    for field in METRIC_FIELDS.get(key_metric, DEFAULT_EXTRA_FIELDS):
+        if field not in fields:
+            fields.append(field)
+    return tuple(fields)
+
+
+def _format_value(field: str, value) -> Optional[str]:
+    # カタログの数値は float32（np.float32 は float のサブクラスではありません）
+    if value is None or (isinstance(value, (float, np.floating)) and math.isnan(value)) or value == '':
+        return None
+    label, fmt = FIELD_FORMATS.get(field, (field, '{}'))
+    try:
+        return f"{label}: {fmt.format(value)}"
+    except (ValueError, TypeError):
+        return f"{label}: {value}"
+
+
+class ProductSerializer:
+    """
+    商品1件をコピーライター向けの1行（「ラベル: 値」を「 / 」で区切ったもの）に変換するクラス。
+    カタログのスナップショットごとに1つ作られ、(ProductID, 列の並び) ごとの結果を保持します。
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.columns = set(df.columns)
+        self._lines: Dict[Tuple[str, Tuple[str, ...]], str] = {}
+        self._lock = threading.Lock()
+
+    def cached_line(self, product_id, fields: Tuple[str, ...]) -> Optional[str]:
+        with self._lock:
+            return self._lines.get((product_id, fields))
+
+    def serialize_row(self, row: pd.Series, fields: Tuple[str, ...]) -> str:
+        key = (row.get('ProductID'), fields)
+        with self._lock:
+            line = self._lines.get(key)
+        if line is not None:
+            return line
+        parts = [_format_value(field, row.get(field)) for field in fields if field in self.columns]
+        line = " / ".join(part for part in parts if part)
+        with self._lock:
+            self._lines[key] = line
+        return line
+
+
+def get_serializer(protein_df: pd.DataFrame) -> ProductSerializer:
+    """カタログのスナップショットに対応する ProductSerializer を返す（スナップショットごとに1度だけ作成）。"""
+    return catalog_store.get_per_snapshot('product_serializer', protein_df, ProductSerializer)
+
+
+def serialize_products(protein_df: pd.DataFrame, products: pd.DataFrame, key_metric: Optional[str]) -> str:
+    """
+    提案商品を、コピーライターのプロンプト用のコンパクトなテキストに変換する関数。
+    以前の to_markdown と違い、URLなどプロンプトで使わない列は含めません。
+    """
+    if products is None or products.empty:
+        return "N/A"
+    serializer = get_serializer(protein_df)
+    fields = fields_for_metric(key_metric)
+    lines: List[str] = []
+    for position, product_id in enumerate(products['ProductID'].tolist()):
+        # キャッシュにあれば、行(Series)を取り出すことすらしません
+        line = serializer.cached_line(product_id, fields)
+        if line is None:
+            line = serializer.serialize_row(products.iloc[position], fields)
+        lines.append(f"- {line}")
+    return "\n".join(lines)
@@ -0,0 +1,41 @@
+# modules/prompt_templates.py
+
+import re
+from typing import Dict, List, Tuple
+
+# 差し込み口の書式: [chat_history] のように、英小文字・数字・_ だけの名前を角括弧で囲んだもの
+# （[SUGGESTIONS] や [ブランド名] のような、プロンプト中の他の角括弧は差し込み口として扱いません）
+SLOT_PATTERN = re.compile(r"\[([a-z][a-z0-9_]*)\]")
+
+
+class PromptTemplate:
+    """
+    差し込み口（[placeholder]）の位置を1度だけ解析したプロンプトのテンプレート。
+    render() は、固定の部分と差し込む値を1度の join で繋ぐだけなので、str.replace を繰り返す場合と違い、
+    差し込み口の数に関わらず全体を1度しかコピーしません。
+    """
+
+    def __init__(self, text: str, name: str = ""):
+        self.name = name
+        self.text = text
+        self._literals: List[str] = []
+        slots: List[str] = []
+        position = 0
+        for match in SLOT_PATTERN.finditer(text):
+            self._literals.append(text[position:match.start()])
+            slots.append(match.group(1))
+            position = match.end()
+        self._literals.append(text[position:])
+        # 差し込み口の並び（同じ名前が複数回現れる場合は、その回数だけ並びます）
+        self._slot_sequence = tuple(slots)
+        self.slots: Tuple[str, ...] = tuple(dict.fromkeys(slots))
+
+    def render(self, values: Dict[str, str]) -> str:
+        """差し込み口に values の値を入れた文字列を返す。値が足りなければ KeyError を送出します。"""
+        missing = [slot for slot in self.slots if slot not in values]
+        if missing:
+            raise KeyError(f"{self.name or 'template'}: no value for {', '.join(missing)}")
+        parts = [""] * (len(self._literals) + len(self._slot_sequence))
+        parts[0::2] = self._literals
+        parts[1::2] = [values[slot] for slot in self._slot_sequence]
+        return "".join(parts)
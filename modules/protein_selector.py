@@ -3,9 +3,43 @@
 import pandas as pd
 from typing import Tuple, Dict, Any
 
-def select_products(protein_df: pd.DataFrame, intent: Dict[str, Any], persona: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.Series, str, str, str]:
+from modules import catalog_index
+from modules import tag_index
+from modules import scoring_engine
+from modules import selection_table
+
+# ProteinPerServing(g) / PricePerKg(JPY) / Taste 以外に、分析官が key_metric として返しうる数値指標
+# { 列名: (AIに伝える比較指標の日本語名, AIに伝える選定理由) }
+SECONDARY_METRICS = {
+    "FatPerServing(g)": ("1食あたりの脂質 (g)", "脂質の少なさ"),
+    "CarbPerServing(g)": ("1食あたりの炭水化物 (g)", "炭水化物（糖質）の少なさ"),
+    "Solubility": ("溶けやすさ", "溶けやすさと飲みやすさ"),
+}
+
+# 味の要望でタグにヒットしなかった場合に使う、フォールバックのタグ
+TASTE_FALLBACK_TAGS = ["#フレーバー豊富", "#美味しい"]
+
+def _top_k_preferring_tags(index, tags, engine, scores, k, exclude_ids, relevant_tags):
+    """
+    スコアの上位 k 件を選ぶ。relevant_tags がある場合は、
+    「全てのタグを持つ商品(AND)」→「いずれかのタグを持つ商品(OR)」→「タグ条件なし」の順に枠を埋めます。
+    """
+    exclude_positions = [index.position_of(pid) for pid in exclude_ids if index.position_of(pid) is not None]
+    if not relevant_tags:
+        return engine.top_k(scores, k, exclude_positions=exclude_positions)
+
+    positions = []
+    for mask in (tags.match_all(relevant_tags), tags.match_any(relevant_tags), None):
+        positions += engine.top_k(scores, k - len(positions), exclude_positions=exclude_positions + positions, mask=mask)
+        if len(positions) >= k:
+            break
+    return positions
+
+def select_products(protein_df: pd.DataFrame, intent: Dict[str, Any], persona: Dict[str, Any], use_table: bool = True) -> Tuple[pd.DataFrame, pd.Series, str, str, str]:
     """
     ユーザーの意図とペルソナに基づき、最適な商品をデータベースから選定する関数。
+    現在のスナップショット用の事前計算表（selection_table）があれば、表を引くだけで済ませます
+    （use_table=False で、常にその場で計算します。表を作るバッチ処理はこちらを使います）。
     
     戻り値:
     - selected_products (DataFrame): 提案する商品（2つ）
@@ -14,7 +48,10 @@ def select_products(protein_df: pd.DataFrame, intent: Dict[str, Any], persona: D
     - key_metric_name_jp (str): AIに伝える比較指標の日本語名
     - key_metric_col_name (str): AIに伝える比較指標の列名
     """
-    df = protein_df.copy()
+    # カタログのコピーや毎回の sort_values は行わず、スナップショットごとの並べ替え済みインデックスを使います
+    index = catalog_index.get_catalog_index(protein_df)
+    tags = tag_index.get_tag_index(protein_df)
+    engine = scoring_engine.get_scoring_engine(protein_df)
     
     # --- 1. ベースライン商品の特定 ---
     baseline_product = None
@@ -22,74 +59,89 @@ def select_products(protein_df: pd.DataFrame, intent: Dict[str, Any], persona: D
     current_brand = persona.get('current_brand')
 
     if product_id:
-        baseline_product_df = df[df["ProductID"] == product_id]
-        if not baseline_product_df.empty:
-            baseline_product = baseline_product_df.iloc[0]
-    elif current_brand and current_brand in df["Brand"].values:
-        baseline_product = df[df["Brand"] == current_brand].iloc[0]
+        baseline_product = index.product_row(product_id)
+    elif current_brand:
+        baseline_product = index.first_row_of_brand(current_brand)
+
+    # もしベースライン商品があれば、それ自身は提案リストから除外する
+    exclude_ids = [baseline_product['ProductID']] if baseline_product is not None else []
+
+    # 診断フォームの回答と key_metric の組み合わせは有限なので、事前計算表があればそれを使います
+    table = selection_table.get_selection_table(protein_df) if use_table else None
+    if table is not None:
+        cached = table.lookup(index, intent, persona, baseline_product)
+        if cached is not None:
+            positions, selection_reason, key_metric_name_jp, key_metric_col_name = cached
+            return index.take(positions), baseline_product, selection_reason, key_metric_name_jp, key_metric_col_name
 
     # --- 2. 意図に基づく商品選定 ---
     key_metric = intent.get("key_metric", "Other")
+    relevant_tags = intent.get("relevant_tags", [])
     
     selected_products = pd.DataFrame()
     key_metric_name_jp = "総合評価"
     key_metric_col_name = "ProteinPurity(%)"
     selection_reason = "総合的な観点"
+    # ランキングに使う列（Noneの場合は、既に selected_products が決まっている）
+    ranking_col = "ProteinPurity(%)"
 
     if key_metric == "ProteinPerServing(g)":
         # タンパク質含有率でソート
-        recommend_df = df.sort_values(by="ProteinPurity(%)", ascending=False)
+        ranking_col = "ProteinPurity(%)"
         key_metric_name_jp = "タンパク質含有率 (%)"
         key_metric_col_name = "ProteinPurity(%)"
         selection_reason = "タンパク質の品質（含有率）の高さ"
         
     elif key_metric == "PricePerKg(JPY)":
         # 価格でソート
-        recommend_df = df.sort_values(by="PricePerKg(JPY)", ascending=True)
+        ranking_col = "PricePerKg(JPY)"
         key_metric_name_jp = "1kgあたりの価格"
         key_metric_col_name = "PricePerKg(JPY)"
         selection_reason = "優れたコストパフォーマンス"
+
+    elif key_metric in SECONDARY_METRICS and index.has_metric(key_metric):
+        # 脂質・炭水化物・溶けやすさ（シートに列がある場合のみ）
+        ranking_col = key_metric
+        key_metric_name_jp, selection_reason = SECONDARY_METRICS[key_metric]
+        key_metric_col_name = key_metric
         
     elif key_metric == "Taste":
-        # 味に関するロジック
-        relevant_tags = intent.get("relevant_tags", [])
+        # 味に関するロジック（タグの転置インデックスで、ヒットしたタグ数の多い順に選びます）
+        exclude_positions = [index.position_of(pid) for pid in exclude_ids if index.position_of(pid) is not None]
         if relevant_tags:
-            search_pattern = '|'.join(relevant_tags)
-            tagged_products = df[df["PersonaTags"].str.contains(search_pattern, na=False)]
-            if len(tagged_products) >= 2:
-                selected_products = tagged_products.head(2)
-            elif len(tagged_products) == 1:
+            tagged_positions = tags.ranked_positions(relevant_tags, exclude_positions=exclude_positions)
+            if len(tagged_positions) >= 2:
+                selected_products = index.take(tagged_positions[:2])
+            elif len(tagged_positions) == 1:
                 # 1つしか見つからなかった場合、残りはコスパで補う
-                remaining_df = df.drop(tagged_products.index)
-                best_of_rest = remaining_df.sort_values(by="PricePerKg(JPY)", ascending=True).head(1)
-                selected_products = pd.concat([tagged_products, best_of_rest])
+                tagged_products = index.take(tagged_positions)
+                selected_products = tagged_products
+                if index.has_metric("PricePerKg(JPY)"):
+                    best_of_rest = index.take(index.top_k("PricePerKg(JPY)", 1, exclude_ids=exclude_ids + tagged_products["ProductID"].tolist()))
+                    selected_products = pd.concat([tagged_products, best_of_rest])
         
         if selected_products.empty:
             # タグにヒットしない場合、フォールバック
-            fallback_tags = "#フレーバー豊富|#美味しい"
-            fallback_products = df[df["PersonaTags"].str.contains(fallback_tags, na=False)]
-            if len(fallback_products) >= 2:
-                selected_products = fallback_products.head(2)
+            fallback_positions = tags.ranked_positions(TASTE_FALLBACK_TAGS, exclude_positions=exclude_positions)
+            if len(fallback_positions) >= 2:
+                selected_products = index.take(fallback_positions[:2])
         
-        # それでも見つからなければ、最終手段としてタンパク質含有率で選ぶ
-        if selected_products.empty:
-            recommend_df = df.sort_values(by="ProteinPurity(%)", ascending=False)
-        else:
-            recommend_df = pd.DataFrame() # selected_productsが既にある場合は、後のロジックをスキップ
+        # それでも見つからなければ、最終手段としてタンパク質含有率で選ぶ（この場合はタグでの絞り込みも行いません）
+        if not selected_products.empty:
+            ranking_col = None # selected_productsが既にある場合は、後のロジックをスキップ
+        relevant_tags = []
 
         key_metric_name_jp = "味のバリエーションや評判"
         key_metric_col_name = None # 味には明確な数値指標がない
         selection_reason = "味の良さやフレーバーの豊富さ"
-    else:
-        # その他（総合評価）
-        recommend_df = df.sort_values(by="ProteinPurity(%)", ascending=False)
 
     # --- 3. 最終的な商品リストの作成 ---
-    # recommend_dfが設定されている場合（Taste以外、またはTasteのフォールバック）
-    if not recommend_df.empty:
-        # もしベースライン商品があれば、それ自身は提案リストから除外する
-        if baseline_product is not None:
-            recommend_df = recommend_df[recommend_df['ProductID'] != baseline_product['ProductID']]
-        selected_products = recommend_df.head(2)
+    # ranking_colが設定されている場合（Taste以外、またはTasteのフォールバック）
+    # 分析官の指標を主軸に、ペルソナの「重視する点」と relevant_tags を加味したスコアで、カタログ全体を一度に評価します
+    if ranking_col is not None and engine.has_column(ranking_col):
+        weights = scoring_engine.build_weights(ranking_col, persona)
+        scores = engine.scores(weights, scoring_engine.build_tag_boost(tags, persona, relevant_tags))
+        positions = _top_k_preferring_tags(index, tags, engine, scores, 2, exclude_ids, relevant_tags)
+        selected_products = index.take(positions)
 
     return selected_products, baseline_product, selection_reason, key_metric_name_jp, key_metric_col_name
\ No newline at end of file
@@ -0,0 +1,93 @@
+# modules/render_cache.py
+
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from modules import catalog_store
+from modules import session_store
+from modules import stream_parser
+
+# 比較表に表示する列と、その表示名・書式
+TABLE_COLUMNS = ['ProductName', 'ProteinPurity(%)', 'Price(JPY)', 'WeightInKg']
+TABLE_LABELS = {
+    'ProductName': '商品名', 'ProteinPurity(%)': 'タンパク質含有率 (%)',
+    'Price(JPY)': '価格 (円)', 'WeightInKg': '内容量 (kg)',
+    'PricePerKg(JPY)': '価格 (円/kg)',
+}
+TABLE_FORMATS = {
+    'タンパク質含有率 (%)': '{:.1f}%', '価格 (円)': '{:,.0f}',
+    '内容量 (kg)': '{:.2f}', '価格 (円/kg)': '{:,.0f}',
+}
+
+# 整形済みの比較表を保持する件数（セッションをまたいでプロセス全体で共有します）
+MAX_TABLES = 512
+
+
+def new_message_id() -> str:
+    return uuid.uuid4().hex
+
+
+def parse_product_ids(content: str) -> List[str]:
+    """応答文に埋め込まれた <!-- ID: XX000 --> を、出現順・重複なしで返す関数。"""
+    return list(dict.fromkeys(stream_parser.PRODUCT_MARKER_PATTERN.findall(content or "")))
+
+
+def make_assistant_message(content: str, suggestions: List[str], **extra: Any) -> Dict[str, Any]:
+    """
+    AIの応答メッセージを作る関数。描画のたびに必要になる情報（メッセージIDと商品ID）を、作成時に1度だけ計算して持たせます。
+    """
+    message = {"role": "assistant", "content": content, "suggestions": suggestions, "id": new_message_id(), "product_ids": parse_product_ids(content)}
+    message.update(extra)
+    return message
+
+
+def message_product_ids(message: Dict[str, Any]) -> List[str]:
+    """メッセージの商品IDを返す（作成時に計算済みでない古いメッセージは、ここで1度だけ計算して保存します）。"""
+    product_ids = message.get("product_ids")
+    if product_ids is None:
+        product_ids = message["product_ids"] = parse_product_ids(message.get("content", ""))
+    return product_ids
+
+
+def _format_table(table_df: pd.DataFrame, key_metric: Optional[str]) -> pd.DataFrame:
+    display_columns = [col for col in TABLE_COLUMNS if col in table_df.columns]
+    if key_metric == 'PricePerKg(JPY)' and 'PricePerKg(JPY)' in table_df.columns:
+        display_columns.append('PricePerKg(JPY)')
+    final_table = table_df[display_columns].rename(columns=TABLE_LABELS).set_index('商品名')
+    # Styler.format の代わりに、文字列へ変換した表を保持します（描画のたびにスタイルを計算し直さないため）
+    for col, fmt in TABLE_FORMATS.items():
+        if col in final_table.columns:
+            final_table[col] = [fmt.format(v) if pd.notna(v) else '' for v in pd.to_numeric(final_table[col], errors='coerce')]
+    return final_table
+
+
+_tables: "OrderedDict[Any, pd.DataFrame]" = OrderedDict()
+_tables_lock = threading.Lock()
+stats = {"table_hits": 0, "table_builds": 0}
+
+
+def comparison_table(table_info: Dict[str, Any], protein_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    整形済みの比較表を返す関数。(表ID, スナップショットのバージョン) ごとに1度だけ、
+    table_info の商品IDから共有のカタログの行を取り出して作り、以降は使い回します。
+    """
+    key_metric = table_info.get("metric")
+    key = (table_info["id"], catalog_store.snapshot_version(protein_df), key_metric)
+    with _tables_lock:
+        table = _tables.get(key)
+        if table is not None:
+            _tables.move_to_end(key)
+            stats["table_hits"] += 1
+            return table
+
+    table = _format_table(session_store.table_rows(protein_df, table_info), key_metric)
+    with _tables_lock:
+        _tables[key] = table
+        stats["table_builds"] += 1
+        while len(_tables) > MAX_TABLES:
+            _tables.popitem(last=False)
+    return table
@@ -0,0 +1,171 @@
+# modules/scoring_engine.py
+
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from modules import catalog_store
+from modules.catalog_index import METRIC_SORT_ASCENDING
+
+# ブランドの「有名さ」の代わりに使う指標の名前（カタログ内でのそのブランドの商品数。シートに評判の列がないため）
+BRAND_PRESENCE = 'BrandPresence'
+
+# 分析官が選んだ指標（key_metric に対応する並べ替えの列）の重み
+PRIMARY_WEIGHT = 1.0
+
+# 診断フォームの Q4（重視する点）ごとに加える重み { 優先事項: { 列名: 重み } }
+PRIORITY_WEIGHTS = {
+    '価格の安さ': {'PricePerKg(JPY)': 0.25},
+    '成分の品質': {'ProteinPurity(%)': 0.25},
+    '有名ブランド': {BRAND_PRESENCE: 0.25},
+}
+# 「味のおいしさ」は数値の列がないので、味に関するタグを持つ商品に加点します
+PRIORITY_TAG_BOOSTS = {
+    '味のおいしさ': (["#美味しい", "#フレーバー豊富"], 0.25),
+}
+# 分析官の relevant_tags にヒットした割合に対する加点
+RELEVANT_TAG_WEIGHT = 0.5
+
+
+class ScoringEngine:
+    """
+    カタログのスナップショットごとに1度だけ作る、多目的スコアリングのための行列。
+
+    数値指標を「良いほど1、悪いほど0」に正規化した (行数 × 指標数) の float32 行列を持ち、
+    リクエストごとのスコアは「行列 × 重みベクトル + タグの加点」の1回の計算で求めます。
+    価格(安い)とタンパク質含有率(高い)のパレート最適な商品も、作成時に求めておきます。
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.size = len(df)
+        self.columns: List[str] = []
+        normalized = []
+        for col, ascending in METRIC_SORT_ASCENDING.items():
+            if col not in df.columns:
+                continue
+            values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype='float64')
+            normalized.append(self._normalize(values, ascending))
+            self.columns.append(col)
+
+        if 'Brand' in df.columns and self.size:
+            brand_counts = df['Brand'].map(df['Brand'].value_counts()).to_numpy(dtype='float64')
+            normalized.append(self._normalize(brand_counts, ascending=False))
+            self.columns.append(BRAND_PRESENCE)
+
+        self.matrix = np.column_stack(normalized).astype(np.float32) if normalized else np.zeros((self.size, 0), dtype=np.float32)
+        self._column_index = {col: i for i, col in enumerate(self.columns)}
+        self._pareto = self._compute_pareto_front(df)
+
+    @staticmethod
+    def _normalize(values: np.ndarray, ascending: bool) -> np.ndarray:
+        """最小-最大で 0〜1 に揃え、小さいほど良い指標は反転する。欠損値は0（最も悪い）にします。"""
+        if not np.isfinite(values).any():
+            return np.zeros(len(values))
+        low, high = np.nanmin(values), np.nanmax(values)
+        span = high - low
+        scaled = (values - low) / span if span > 0 else np.ones(len(values))
+        if ascending:
+            scaled = 1.0 - scaled
+        return np.nan_to_num(scaled, nan=0.0)
+
+    def has_column(self, col: Optional[str]) -> bool:
+        return col in self._column_index
+
+    def weight_vector(self, weights: Dict[str, float]) -> np.ndarray:
+        vector = np.zeros(len(self.columns), dtype=np.float32)
+        for col, weight in weights.items():
+            if col in self._column_index:
+                vector[self._column_index[col]] += weight
+        return vector
+
+    def scores(self, weights: Dict[str, float], tag_boost: Optional[np.ndarray] = None) -> np.ndarray:
+        """カタログ全体のスコアを一度に計算する。tag_boost は行ごとの加点（float32 の配列）です。"""
+        scores = self.matrix @ self.weight_vector(weights)
+        if tag_boost is not None:
+            scores += tag_boost
+        return scores
+
+    def top_k(self, scores: np.ndarray, k: int, exclude_positions: Iterable[int] = (), mask: Optional[np.ndarray] = None) -> List[int]:
+        """
+        スコアの高い順に k 件の行位置を返す（同点ならシート上の順）。
+        全体の並べ替えはせず、argpartition で候補を絞ってから、その候補だけを並べ替えます。
+        """
+        candidates = scores.astype(np.float64, copy=True)
+        if mask is not None:
+            candidates[~mask] = -np.inf
+        for position in exclude_positions:
+            candidates[position] = -np.inf
+        available = int(np.isfinite(candidates).sum())
+        k = min(k, available)
+        if k <= 0:
+            return []
+        if k < len(candidates):
+            threshold = np.partition(candidates, len(candidates) - k)[len(candidates) - k]
+            # 境界と同点の行も候補に残し、シート上の順で決めます（以前の安定ソートと同じ結果になります）
+            top = np.flatnonzero(candidates >= threshold)
+        else:
+            top = np.flatnonzero(np.isfinite(candidates))
+        order = np.lexsort((top, -candidates[top]))
+        return top[order][:k].tolist()
+
+    def _compute_pareto_front(self, df: pd.DataFrame) -> np.ndarray:
+        if 'PricePerKg(JPY)' not in df.columns or 'ProteinPurity(%)' not in df.columns:
+            return np.array([], dtype=np.int64)
+        price = pd.to_numeric(df['PricePerKg(JPY)'], errors='coerce').to_numpy(dtype='float64')
+        purity = pd.to_numeric(df['ProteinPurity(%)'], errors='coerce').to_numpy(dtype='float64')
+        return pareto_front(price, purity)
+
+    def pareto_front(self) -> List[int]:
+        """価格(安い)とタンパク質含有率(高い)について、他の商品に両方で劣ることのない商品の行位置（安い順）。"""
+        return self._pareto.tolist()
+
+
+def pareto_front(cost: np.ndarray, benefit: np.ndarray) -> np.ndarray:
+    """
+    cost が小さく benefit が大きいほど良い2目的について、パレート最適な行位置を cost の昇順で返す関数。
+    cost で並べ、benefit の累積最大値を更新する行だけを残します（O(n log n)）。
+    """
+    valid = np.flatnonzero(np.isfinite(cost) & np.isfinite(benefit))
+    if len(valid) == 0:
+        return np.array([], dtype=np.int64)
+    order = valid[np.lexsort((-benefit[valid], cost[valid]))]
+    sorted_benefit = benefit[order]
+    best_before = np.concatenate(([-np.inf], np.maximum.accumulate(sorted_benefit)[:-1]))
+    return order[sorted_benefit > best_before]
+
+
+def build_weights(ranking_col: Optional[str], persona: Dict[str, Any]) -> Dict[str, float]:
+    """key_metric に対応する列と、ペルソナの優先事項から、列ごとの重みを作る関数。"""
+    weights: Dict[str, float] = {}
+    if ranking_col:
+        weights[ranking_col] = PRIMARY_WEIGHT
+    for priority, enabled in (persona.get('priorities') or {}).items():
+        if not enabled:
+            continue
+        for col, weight in PRIORITY_WEIGHTS.get(priority, {}).items():
+            weights[col] = weights.get(col, 0.0) + weight
+    return weights
+
+
+def build_tag_boost(tags, persona: Dict[str, Any], relevant_tags: Iterable[str]) -> Optional[np.ndarray]:
+    """
+    タグの転置インデックス（tag_index.TagIndex）から、行ごとの加点を作る関数。
+    relevant_tags はヒットした割合に応じて、味を重視するペルソナは味のタグに対して加点します。
+    """
+    boost = None
+    relevant_tags = list(relevant_tags or [])
+    if relevant_tags:
+        boost = tags.match_counts(relevant_tags).astype(np.float32) * (RELEVANT_TAG_WEIGHT / len(relevant_tags))
+    for priority, enabled in (persona.get('priorities') or {}).items():
+        if not enabled or priority not in PRIORITY_TAG_BOOSTS:
+            continue
+        boost_tags, weight = PRIORITY_TAG_BOOSTS[priority]
+        priority_boost = tags.match_any(boost_tags).astype(np.float32) * weight
+        boost = priority_boost if boost is None else boost + priority_boost
+    return boost
+
+
+def get_scoring_engine(protein_df: pd.DataFrame) -> ScoringEngine:
+    """カタログのスナップショットに対応する ScoringEngine を返す（スナップショットごとに1度だけ作成）。"""
+    return catalog_store.get_per_snapshot('scoring_engine', protein_df, ScoringEngine)
@@ -0,0 +1,135 @@
+# modules/selection_table.py
+
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from modules.intent_classifier import TAG_LEXICON
+
+# precompute_selections.py が書き出す、商品選定の事前計算表
+TABLE_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'selection_table.json')
+TABLE_FORMAT_VERSION = 1
+
+# 分析官・ルール分類器が返しうる key_metric（これ以外は select_products と同じく "Other" と同じ扱いです）
+KEY_METRICS = ["ProteinPerServing(g)", "PricePerKg(JPY)", "Taste", "FatPerServing(g)", "CarbPerServing(g)", "Solubility", "Other"]
+# 診断フォームの Q4（重視する点）。ビットの並び順です。
+PRIORITY_NAMES = ['価格の安さ', '味のおいしさ', '成分の品質', '有名ブランド']
+
+
+def priority_mask(persona: Dict[str, Any]) -> int:
+    priorities = persona.get('priorities') or {}
+    return sum(1 << bit for bit, name in enumerate(PRIORITY_NAMES) if priorities.get(name))
+
+
+def priorities_from_mask(mask: int) -> Dict[str, bool]:
+    return {name: bool(mask & (1 << bit)) for bit, name in enumerate(PRIORITY_NAMES)}
+
+
+def canonical_metric(key_metric: Optional[str]) -> str:
+    return key_metric if key_metric in KEY_METRICS else "Other"
+
+
+def tag_signature(relevant_tags) -> Optional[str]:
+    """relevant_tags を表のキーに変換する（タグなしは ""、1種類なら そのタグ、2種類以上は表の対象外なので None）。"""
+    tags = sorted(set(relevant_tags or []))
+    if len(tags) > 1:
+        return None
+    return tags[0] if tags else ""
+
+
+def entry_key(mask: int, metric: str, tag: str) -> str:
+    return f"{mask}|{metric}|{tag}"
+
+
+def tag_vocabulary(tags) -> List[str]:
+    """事前計算するタグ: カタログに現れるタグと、ルール分類器が返しうるタグ。"""
+    return sorted(set(tags.vocabulary) | {tag for _, tag in TAG_LEXICON})
+
+
+class SelectionTable:
+    """
+    (重視する点, key_metric, relevant_tags) ごとの select_products の結果を、カタログの行位置で持つ表。
+
+    ベースライン商品は提案から1件除外するだけなので、表には「除外なしの上位2件」と、
+    「その2件のどちらかがベースラインだった場合の上位2件」だけを持ちます
+    （それ以外の商品がベースラインの場合、除外しても結果は変わりません）。
+    """
+
+    def __init__(self, data: Dict[str, Any]):
+        self.snapshot_version = data.get("snapshot_version")
+        self.rows = data.get("rows")
+        self.entries: Dict[str, Any] = data.get("entries", {})
+        self.labels: Dict[str, List[Any]] = data.get("labels", {})
+        self.stats = {"hits": 0, "misses": 0}
+
+    def lookup(self, index, intent: Dict[str, Any], persona: Dict[str, Any], baseline_product: Optional[pd.Series]) -> Optional[Tuple[List[int], str, str, Optional[str]]]:
+        """表にあれば (行位置のリスト, 選定理由, 指標の日本語名, 指標の列名) を、なければ None を返す。"""
+        metric = canonical_metric(intent.get("key_metric", "Other"))
+        tag = tag_signature(intent.get("relevant_tags", []))
+        entry = self.entries.get(entry_key(priority_mask(persona), metric, tag)) if tag is not None else None
+        if entry is None or metric not in self.labels:
+            self.stats["misses"] += 1
+            return None
+        positions = entry["d"]
+        if baseline_product is not None:
+            baseline_position = index.position_of(baseline_product['ProductID'])
+            positions = entry["x"].get(str(baseline_position), positions)
+        self.stats["hits"] += 1
+        selection_reason, key_metric_name_jp, key_metric_col_name = self.labels[metric]
+        return positions, selection_reason, key_metric_name_jp, key_metric_col_name
+
+
+def write_table(path: str, snapshot_version: str, rows: int, entries: Dict[str, Any], labels: Dict[str, List[Any]]) -> int:
+    """表を JSON で書き出し（一時ファイルからの置き換え）、ファイルのバイト数を返す。"""
+    data = {"format": TABLE_FORMAT_VERSION, "snapshot_version": snapshot_version, "rows": rows, "labels": labels, "entries": entries}
+    tmp_path = f"{path}.tmp"
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def read_table(path: str) -> Optional[SelectionTable]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("format") != TABLE_FORMAT_VERSION:
+        return None
+    return SelectionTable(data)
+
+
+_loaded: Dict[str, Any] = {"key": None, "table": None}
+_loaded_lock = threading.Lock()
+
+
+def get_selection_table(protein_df: pd.DataFrame, path: str = TABLE_PATH) -> Optional[SelectionTable]:
+    """
+    現在のスナップショット用の事前計算表を返す（ないか、別のスナップショット用の表であれば None）。
+    表のファイルが書き換えられると、次の呼び出しで読み直します。
+    """
+    # バージョンが付与されていないカタログ（スナップショット以外）には使いません（内容から計算すると重いため）
+    version = protein_df.attrs.get('snapshot_version')
+    if not version:
+        return None
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    key = (path, mtime, version, len(protein_df))
+    with _loaded_lock:
+        if _loaded["key"] == key:
+            return _loaded["table"]
+
+    table = read_table(path)
+    if table is not None and (table.snapshot_version != version or table.rows != len(protein_df)):
+        table = None
+    with _loaded_lock:
+        _loaded["key"] = key
+        _loaded["table"] = table
+    return table
@@ -0,0 +1,238 @@
+# modules/session_store.py
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+
+import pandas as pd
+
+from modules import catalog_index
+
+# 会話履歴を保存する SQLite ファイル
+SESSION_DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'sessions.sqlite3')
+
+# この秒数アクセスのないセッションは、メモリから外します（履歴はディスクに残ります）
+HOT_IDLE_SECONDS = 300
+# メモリに置いておくセッション数の上限
+MAX_HOT_SESSIONS = 200
+# この秒数アクセスのないセッションは、ディスクからも削除します
+RETENTION_SECONDS = 7 * 24 * 3600
+# ディスク上の古いセッションを掃除する間隔（秒）
+PURGE_INTERVAL_SECONDS = 600
+
+
+def estimate_size(obj: Any, _seen: Optional[set] = None) -> int:
+    """オブジェクトが使っているメモリの概算（バイト）を、中身までたどって返す関数。DataFrame は memory_usage を使います。"""
+    _seen = set() if _seen is None else _seen
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        usage = obj.memory_usage(index=True, deep=True)
+        return int(usage.sum() if isinstance(usage, pd.Series) else usage)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, _seen) for item in obj)
+    return size
+
+
+class SessionStore:
+    """
+    会話履歴をセッションごとに保存するクラス（プロセス全体で1つ）。
+
+    - 履歴は SQLite に1メッセージ1行で書き出します。
+    - 最近アクセスのあったセッションだけをメモリに置き（LRU）、しばらく使われないセッションはメモリから外します。
+      外したセッションに再びアクセスがあれば、ディスクから読み直します。
+    - 長期間使われていないセッションは、ディスクからも削除します。
+    """
+
+    def __init__(self, db_path: str = SESSION_DB_PATH, hot_idle_seconds: float = HOT_IDLE_SECONDS,
+                 max_hot_sessions: int = MAX_HOT_SESSIONS, retention_seconds: float = RETENTION_SECONDS):
+        self.db_path = db_path
+        self.hot_idle_seconds = hot_idle_seconds
+        self.max_hot_sessions = max_hot_sessions
+        self.retention_seconds = retention_seconds
+        self._lock = threading.RLock()
+        self._hot: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._last_purge = 0.0
+        self.stats = {"loads": 0, "evictions": 0, "purged_sessions": 0}
+
+        if db_path != ':memory:':
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL" if db_path != ':memory:' else "PRAGMA journal_mode=MEMORY")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " session_id TEXT NOT NULL, seq INTEGER NOT NULL, body TEXT NOT NULL,"
+                " PRIMARY KEY (session_id, seq))"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, last_access REAL NOT NULL)")
+
+    # --- 読み書き ---
+
+    def messages(self, session_id: str) -> List[Dict[str, Any]]:
+        """セッションの履歴（メッセージのリスト）を返す。返したリストを直接書き換えないでください。"""
+        with self._lock:
+            return self._touch(session_id)["messages"]
+
+    def append(self, session_id: str, message: Dict[str, Any]) -> None:
+        # メモリ使用量の概算は、ロックの外で、追加するメッセージの分だけ計算します
+        size = estimate_size(message)
+        with self._lock:
+            entry = self._touch(session_id)
+            seq = len(entry["messages"])
+            entry["messages"].append(message)
+            entry["bytes"] += size
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO messages (session_id, seq, body) VALUES (?, ?, ?)",
+                    (session_id, seq, json.dumps(message, ensure_ascii=False)),
+                )
+                self._conn.execute("INSERT OR REPLACE INTO sessions (session_id, last_access) VALUES (?, ?)", (session_id, time.time()))
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._hot.pop(session_id, None)
+            with self._conn:
+                self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    # --- メモリ管理 ---
+
+    def _touch(self, session_id: str) -> Dict[str, Any]:
+        now = time.monotonic()
+        entry = self._hot.get(session_id)
+        if entry is None:
+            rows = self._conn.execute("SELECT body FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+            messages = [json.loads(body) for (body,) in rows]
+            # 履歴のメモリ使用量の概算（メッセージごとの概算の合計。読み込んだ時点で1度だけ計算し、以降は append で足していきます）
+            entry = {"messages": messages, "bytes": sum(estimate_size(message) for message in messages)}
+            self._hot[session_id] = entry
+            if rows:
+                self.stats["loads"] += 1
+        entry["last_access"] = now
+        self._hot.move_to_end(session_id)
+        self._evict_idle(now)
+        return entry
+
+    def _evict_idle(self, now: float) -> None:
+        while self._hot:
+            oldest_id, oldest = next(iter(self._hot.items()))
+            if len(self._hot) <= self.max_hot_sessions and now - oldest["last_access"] <= self.hot_idle_seconds:
+                break
+            del self._hot[oldest_id]
+            self.stats["evictions"] += 1
+
+        if time.time() - self._last_purge > PURGE_INTERVAL_SECONDS:
+            self._last_purge = time.time()
+            self.purge_expired()
+
+    def purge_expired(self) -> int:
+        """保存期間を過ぎたセッションを、ディスクから削除する。削除したセッション数を返します。"""
+        cutoff = time.time() - self.retention_seconds
+        with self._lock, self._conn:
+            expired = [row[0] for row in self._conn.execute("SELECT session_id FROM sessions WHERE last_access < ?", (cutoff,))]
+            for session_id in expired:
+                self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._hot.pop(session_id, None)
+            self.stats["purged_sessions"] += len(expired)
+        return len(expired)
+
+    def memory_report(self) -> Dict[str, Any]:
+        """
+        メモリに置いているセッションの数と、セッションあたりの使用量の概算を返す。
+        概算は読み込み・追加の時点で計算済みなので、ここでは履歴をたどりません。
+        """
+        with self._lock:
+            sizes = [entry["bytes"] for entry in self._hot.values()]
+            stats = dict(self.stats)
+        stats.update({
+            "hot_sessions": len(sizes),
+            "hot_bytes_total": sum(sizes),
+            "hot_bytes_per_session": sum(sizes) / len(sizes) if sizes else 0.0,
+            "hot_bytes_max": max(sizes, default=0),
+        })
+        return stats
+
+
+class SessionMessages:
+    """
+    st.session_state.messages に置く、リストと同じように使える軽量な窓口。
+    中身は SessionStore にあり、セッション状態にはセッションIDしか残りません。
+    """
+
+    def __init__(self, session_id: Optional[str] = None, store: Optional[SessionStore] = None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self._store = store
+
+    @property
+    def store(self) -> SessionStore:
+        return self._store or get_shared_store()
+
+    def _list(self) -> List[Dict[str, Any]]:
+        return self.store.messages(self.session_id)
+
+    def append(self, message: Dict[str, Any]) -> None:
+        self.store.append(self.session_id, message)
+
+    def clear(self) -> None:
+        self.store.clear(self.session_id)
+
+    def __getitem__(self, key):
+        return self._list()[key]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(list(self._list()))
+
+    def __len__(self) -> int:
+        return len(self._list())
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+
+def make_table_info(selected_products: pd.DataFrame, baseline_product: Optional[pd.Series], key_metric: str, table_id: str) -> Dict[str, Any]:
+    """
+    比較表・ポジションマップ用の情報を作る関数。DataFrame は持たず、商品IDと指標名だけを保存します
+    （表は描画時に、共有のカタログから table_rows で組み立て直します）。
+    """
+    baseline_id = None
+    if baseline_product is not None and not baseline_product.empty:
+        baseline_id = baseline_product.get('ProductID')
+    return {
+        "id": table_id,
+        "baseline_id": baseline_id,
+        "product_ids": selected_products['ProductID'].tolist(),
+        "metric": key_metric,
+    }
+
+
+def table_rows(protein_df: pd.DataFrame, table_info: Dict[str, Any]) -> pd.DataFrame:
+    """table_info の商品ID（ベースライン → 提案商品の順）から、カタログの行を取り出す関数。"""
+    index = catalog_index.get_catalog_index(protein_df)
+    ids = ([table_info["baseline_id"]] if table_info.get("baseline_id") else []) + list(table_info.get("product_ids", []))
+    positions = [index.position_of(pid) for pid in ids]
+    return index.take([p for p in positions if p is not None])
+
+
+_shared_store = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_store() -> SessionStore:
+    """プロセス全体で共有する SessionStore を返す。"""
+    global _shared_store
+    with _shared_lock:
+        if _shared_store is None:
+            _shared_store = SessionStore()
+        return _shared_store
@@ -0,0 +1,162 @@
+# modules/stream_parser.py
+
+import re
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+SUGGESTIONS_OPEN = "[suggestions]"
+SUGGESTIONS_CLOSE = "[/suggestions]"
+MARKER_OPEN = "<!--"
+MARKER_CLOSE = "-->"
+# 商品の目印 <!-- ID: XX000 -->。ストリームの解析（stream_parser）・保存した応答の商品ID（render_cache）・
+# 会話履歴の要約（chat_history）は、全てこのパターンを使います（表示中と再描画時で、拾う商品が食い違わないように）
+PRODUCT_MARKER_PATTERN = re.compile(r'<!--\s*ID:\s*([A-Za-z0-9_-]+)\s*-->')
+# 閉じられないままのコメントは、この長さを超えたら普通の文章として表示します
+MAX_MARKER_CHARS = 200
+
+Event = Tuple[str, object]
+
+
+def parse_suggestion_lines(text: str) -> List[str]:
+    """[SUGGESTIONS] ブロックの中身を、提案ボタンの文言のリストに変換する関数。"""
+    suggestions = [line.strip() for line in text.strip().split('\n') if line.strip()]
+    # 数字やハイフン、アスタリスクなどを除去
+    return [re.sub(r'^\s*[\d\.\-\*]+\s*', '', s) for s in suggestions]
+
+
+def _held_back_length(text: str) -> int:
+    """末尾のうち、[SUGGESTIONS] や <!-- の書きかけかもしれない部分の長さを返す。"""
+    lower = text.lower()
+    for length in range(min(len(lower), len(SUGGESTIONS_OPEN) - 1), 0, -1):
+        tail = lower[-length:]
+        if SUGGESTIONS_OPEN.startswith(tail) or MARKER_OPEN.startswith(tail):
+            return length
+    return 0
+
+
+class WriterStreamParser:
+    """
+    コピーライターの応答をチャンクごとに受け取り、画面に出す本文と、構造化されたイベントに振り分けるクラス。
+
+    - ("text", 文字列): 画面に表示してよい本文
+    - ("product", ProductID): <!-- ID: XX000 --> の目印が閉じた時点で発生
+    - ("suggestions", [文言, ...]): [/SUGGESTIONS] が閉じた時点（または応答の終わり）で発生
+
+    [SUGGESTIONS] ブロックと目印は画面に出しません。ブロックを除いた本文（目印は含む）は body に残るので、
+    応答が終わった後に全文をもう一度走査する必要はありません。
+    parse_ms には、feed / close で解析に使った時間の合計（ミリ秒）が入ります。
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._in_suggestions = False
+        self._suggestion_parts: List[str] = []
+        self._body_parts: List[str] = []
+        self.product_ids: List[str] = []
+        self.suggestions: List[str] = []
+        self.parse_ms = 0.0
+
+    @property
+    def body(self) -> str:
+        return "".join(self._body_parts).strip()
+
+    def feed(self, chunk: str) -> List[Event]:
+        start = time.perf_counter()
+        self._pending += chunk or ""
+        events = self._drain(final=False)
+        self.parse_ms += (time.perf_counter() - start) * 1000
+        return events
+
+    def close(self) -> List[Event]:
+        start = time.perf_counter()
+        events = self._drain(final=True)
+        self.parse_ms += (time.perf_counter() - start) * 1000
+        return events
+
+    def _text(self, text: str, events: List[Event]) -> None:
+        if text:
+            self._body_parts.append(text)
+            events.append(("text", text))
+
+    def _finish_suggestions(self, events: List[Event]) -> None:
+        self._in_suggestions = False
+        self.suggestions = parse_suggestion_lines("".join(self._suggestion_parts))
+        self._suggestion_parts = []
+        events.append(("suggestions", self.suggestions))
+
+    def _drain(self, final: bool) -> List[Event]:
+        events: List[Event] = []
+        while self._pending:
+            if self._in_suggestions:
+                close_at = self._pending.lower().find(SUGGESTIONS_CLOSE)
+                if close_at < 0:
+                    if final:
+                        self._suggestion_parts.append(self._pending)
+                        self._pending = ""
+                        self._finish_suggestions(events)
+                    else:
+                        # 閉じタグの書きかけを残して、それ以前はブロックの中身として確定させます
+                        keep = len(SUGGESTIONS_CLOSE) - 1
+                        self._suggestion_parts.append(self._pending[:-keep] if len(self._pending) > keep else "")
+                        self._pending = self._pending[-keep:] if len(self._pending) > keep else self._pending
+                    break
+                self._suggestion_parts.append(self._pending[:close_at])
+                self._pending = self._pending[close_at + len(SUGGESTIONS_CLOSE):]
+                self._finish_suggestions(events)
+                continue
+
+            open_at = self._pending.lower().find(SUGGESTIONS_OPEN)
+            marker_at = self._pending.find(MARKER_OPEN)
+            starts = [i for i in (open_at, marker_at) if i >= 0]
+            if not starts:
+                safe = len(self._pending) if final else len(self._pending) - _held_back_length(self._pending)
+                self._text(self._pending[:safe], events)
+                self._pending = self._pending[safe:]
+                break
+
+            start = min(starts)
+            if start > 0:
+                self._text(self._pending[:start], events)
+                self._pending = self._pending[start:]
+                continue
+
+            if open_at == 0:
+                self._pending = self._pending[len(SUGGESTIONS_OPEN):]
+                self._in_suggestions = True
+                continue
+
+            end = self._pending.find(MARKER_CLOSE)
+            if end < 0:
+                if final or len(self._pending) > MAX_MARKER_CHARS:
+                    self._text(self._pending, events)
+                    self._pending = ""
+                break
+            marker = self._pending[:end + len(MARKER_CLOSE)]
+            self._pending = self._pending[end + len(MARKER_CLOSE):]
+            match = PRODUCT_MARKER_PATTERN.fullmatch(marker)
+            if match:
+                # 目印は本文（保存用）には残し、画面には出しません
+                self._body_parts.append(marker)
+                if match.group(1) not in self.product_ids:
+                    self.product_ids.append(match.group(1))
+                events.append(("product", match.group(1)))
+            else:
+                self._text(marker, events)
+        return events
+
+
+def display_stream(chunks: Iterable[str], parser: WriterStreamParser, on_event: Optional[Callable[[str, object], None]] = None) -> Iterator[str]:
+    """
+    チャンクのストリームを parser に通し、画面に出す本文だけを返すジェネレーター（st.write_stream に渡します）。
+    product / suggestions のイベントは、発生した時点で on_event(種類, 値) に渡されます。
+    """
+    def handle(events):
+        for kind, value in events:
+            if kind == "text":
+                yield value
+            elif on_event is not None:
+                on_event(kind, value)
+
+    for chunk in chunks:
+        yield from handle(parser.feed(chunk))
+    yield from handle(parser.close())
@@ -0,0 +1,102 @@
+# modules/tag_index.py
+
+import re
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from modules import catalog_store
+
+# PersonaTags の1セルから「#タグ」を取り出すためのパターン（空白・カンマ・読点で区切られている想定）
+TAG_PATTERN = re.compile(r'#[^\s#,、，]+')
+
+
+def tokenize_tags(text) -> List[str]:
+    """PersonaTags のセル文字列を、#タグのリストに分解する関数。"""
+    if not isinstance(text, str):
+        return []
+    return TAG_PATTERN.findall(text)
+
+
+class TagIndex:
+    """
+    PersonaTags の転置インデックス（タグ -> 行のビットマップ）。
+
+    カタログのスナップショットごとに1度だけタグを分解しておき、
+    リクエストごとのタグ検索は、ビットマップ同士の AND / OR と件数の足し算だけで行います。
+    """
+
+    def __init__(self, df: pd.DataFrame, column: str = 'PersonaTags'):
+        self.size = len(df)
+        self._bitmaps: Dict[str, np.ndarray] = {}
+        # タグ -> タグID。セルの文字列（タグの組み合わせ）ごとに1度だけ分解し、タグIDのリストにします。
+        self.tag_ids: Dict[str, int] = {}
+        if column in df.columns:
+            # カタログの PersonaTags はカテゴリ型なので、異なる組み合わせの数だけ分解すれば済みます
+            codes, texts = pd.factorize(df[column])
+            texts_by_tag: Dict[int, List[int]] = {}
+            for text_id, text in enumerate(texts):
+                for tag in tokenize_tags(text):
+                    tag_id = self.tag_ids.setdefault(tag, len(self.tag_ids))
+                    texts_by_tag.setdefault(tag_id, []).append(text_id)
+            for tag, tag_id in self.tag_ids.items():
+                # 末尾の要素は欠損値（code = -1）用で、常に False です
+                has_tag = np.zeros(len(texts) + 1, dtype=bool)
+                has_tag[texts_by_tag[tag_id]] = True
+                self._bitmaps[tag] = has_tag[codes]
+        self.vocabulary = sorted(self._bitmaps)
+
+    def resolve(self, tag: str) -> List[str]:
+        """
+        問い合わせのタグを、カタログ上のタグに対応付ける。
+        完全一致を優先し、なければ部分一致するタグを全て返します
+        （以前の str.contains と同じく「#フルーツ」で「#フルーツ系」にもヒットさせるため。走査するのは語彙だけです）。
+        """
+        if tag in self._bitmaps:
+            return [tag]
+        return [vocab_tag for vocab_tag in self.vocabulary if tag in vocab_tag]
+
+    def tag_mask(self, tag: str) -> np.ndarray:
+        """1つのタグ（部分一致を含む）を持つ行のビットマップ。"""
+        mask = np.zeros(self.size, dtype=bool)
+        for vocab_tag in self.resolve(tag):
+            mask |= self._bitmaps[vocab_tag]
+        return mask
+
+    def match_any(self, tags: Iterable[str]) -> np.ndarray:
+        """いずれかのタグを持つ行（OR）。"""
+        mask = np.zeros(self.size, dtype=bool)
+        for tag in tags:
+            mask |= self.tag_mask(tag)
+        return mask
+
+    def match_all(self, tags: Iterable[str]) -> np.ndarray:
+        """全てのタグを持つ行（AND）。"""
+        mask = np.ones(self.size, dtype=bool)
+        for tag in tags:
+            mask &= self.tag_mask(tag)
+        return mask
+
+    def match_counts(self, tags: Iterable[str]) -> np.ndarray:
+        """行ごとに、いくつのタグにヒットしたかを数える。"""
+        counts = np.zeros(self.size, dtype=np.int16)
+        for tag in tags:
+            counts += self.tag_mask(tag)
+        return counts
+
+    def ranked_positions(self, tags: Iterable[str], exclude_positions: Iterable[int] = ()) -> List[int]:
+        """
+        1つ以上のタグにヒットした行の位置を、ヒット数の多い順（同数ならシート上の順）に返す。
+        """
+        counts = self.match_counts(tags)
+        for position in exclude_positions:
+            counts[position] = 0
+        hit_positions = np.flatnonzero(counts)
+        order = np.argsort(-counts[hit_positions], kind='stable')
+        return hit_positions[order].tolist()
+
+
+def get_tag_index(protein_df: pd.DataFrame) -> TagIndex:
+    """カタログのスナップショットに対応する TagIndex を返す（スナップショットごとに1度だけ作成）。"""
+    return catalog_store.get_per_snapshot('tag_index', protein_df, TagIndex)
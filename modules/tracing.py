@@ -0,0 +1,189 @@
+# modules/tracing.py
+
+import json
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# トレースを書き出すファイル（環境変数で指定した場合のみ）と、その形式
+#   jsonl: 1ターン = 1行の {"trace_id", "ts", "spans": [...]}
+#   otlp:  1ターン = 1行の OTLP/JSON（OpenTelemetry Collector の file receiver などで読めます）
+TRACE_PATH = os.environ.get("SYNAPSE_TRACE_PATH")
+TRACE_FORMAT = os.environ.get("SYNAPSE_TRACE_FORMAT", "jsonl")
+# 管理者用の計測ページを開くためのトークン（?admin=<トークン>。未設定ならページは表示しません）
+ADMIN_TOKEN = os.environ.get("SYNAPSE_ADMIN_TOKEN")
+# 管理者用ページのパーセンタイルを計算する、直近のターン数
+ROLLING_WINDOW = 500
+
+SERVICE_NAME = "protein-concierge"
+
+# TurnTimings のステージを、そのまま span にします（「整形」は history と writer_inputs です）
+STAGE_SPANS = ["persona", "analyzer", "catalog_prep", "history", "selection", "writer_inputs"]
+# 時点（mark）の組から作る span: 名前 -> (開始の時点, 終了の時点, 属性を引き継ぐ時点)
+DERIVED_SPANS = {
+    "writer_ttft": ("writer_request", "writer_first_token", None),
+    "writer_total": ("writer_request", "writer_done", "writer_done"),
+}
+# 応答の解析（stream_parser）は受信と交互に進むので、解析に使った時間の合計を長さとする span にします
+PARSE_SPAN = "stream_parse"
+
+
+def _span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def turn_spans(timings, **turn_attributes: Any) -> List[Dict[str, Any]]:
+    """
+    turn_pipeline.TurnTimings を span のリストに変換する関数。
+    先頭はターン全体の span（"turn"）で、各ステージの span はその子になります。
+    時刻はターン開始からのミリ秒（start_ms / end_ms）と、UNIX 時刻のナノ秒の両方を持ちます。
+    """
+    data = timings.as_dict()
+    origin_ns = int(data["started_at"] * 1e9)
+    attributes = data["attributes"]
+    root_id = _span_id()
+
+    def make(name, start_ms, end_ms, attrs, span_id=None, parent_id=root_id):
+        return {
+            "trace_id": data["trace_id"], "span_id": span_id or _span_id(), "parent_id": parent_id,
+            "name": name, "start_ms": start_ms, "end_ms": end_ms, "ms": round(end_ms - start_ms, 1),
+            "start_ns": origin_ns + int(start_ms * 1e6), "end_ns": origin_ns + int(end_ms * 1e6),
+            "attributes": dict(attrs or {}),
+        }
+
+    children = []
+    for name in STAGE_SPANS:
+        stage = data["stages"].get(name)
+        if stage is not None:
+            children.append(make(name, stage["start_ms"], stage["end_ms"], attributes.get(name)))
+    for name, (start_mark, end_mark, attrs_from) in DERIVED_SPANS.items():
+        start, end = data["marks"].get(start_mark), data["marks"].get(end_mark)
+        if start is not None and end is not None:
+            children.append(make(name, start, end, attributes.get(attrs_from) if attrs_from else None))
+    parsed = data["marks"].get("stream_parsed")
+    if parsed is not None:
+        parse_attrs = attributes.get("stream_parsed", {})
+        children.append(make(PARSE_SPAN, round(parsed - parse_attrs.get("parse_cpu_ms", 0.0), 2), parsed, parse_attrs))
+
+    end_ms = max([span["end_ms"] for span in children] + list(data["marks"].values()) + [0.0])
+    root = make("turn", 0.0, end_ms, turn_attributes, span_id=root_id, parent_id=None)
+    return [root] + children
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """span のリストを、OTLP/JSON の ExportTraceServiceRequest の形に変換する関数。"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": "modules.tracing"},
+            "spans": [{
+                "traceId": span["trace_id"], "spanId": span["span_id"], "parentSpanId": span["parent_id"] or "",
+                "name": span["name"], "kind": 1,
+                "startTimeUnixNano": str(span["start_ns"]), "endTimeUnixNano": str(span["end_ns"]),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span["attributes"].items()],
+            } for span in spans],
+        }],
+    }]}
+
+
+class TraceRecorder:
+    """
+    ターンごとの span を集めるクラス（プロセス全体で1つ）。
+    直近 window ターン分をメモリに持ち、管理者用ページのパーセンタイルに使います。
+    path を指定した場合は、1ターン = 1行でファイルにも追記します。
+    """
+
+    def __init__(self, path: Optional[str] = TRACE_PATH, fmt: str = TRACE_FORMAT, window: int = ROLLING_WINDOW):
+        self.path = path
+        self.fmt = fmt
+        self._lock = threading.Lock()
+        self._recent: "deque[List[Dict[str, Any]]]" = deque(maxlen=window)
+        self.turns = 0
+
+    def record(self, timings, **turn_attributes: Any) -> List[Dict[str, Any]]:
+        spans = turn_spans(timings, **turn_attributes)
+        with self._lock:
+            self._recent.append(spans)
+            self.turns += 1
+            if self.path:
+                record = to_otlp(spans) if self.fmt == "otlp" else {"trace_id": spans[0]["trace_id"], "ts": time.time(), "spans": spans}
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return spans
+
+    def recent(self) -> List[List[Dict[str, Any]]]:
+        with self._lock:
+            return list(self._recent)
+
+    def stage_percentiles(self) -> pd.DataFrame:
+        """直近のターンについて、span ごとの件数と p50 / p95 / p99（ミリ秒）を返す。"""
+        durations: Dict[str, List[float]] = {}
+        for spans in self.recent():
+            for span in spans:
+                durations.setdefault(span["name"], []).append(span["ms"])
+        rows = []
+        for name in ["turn"] + STAGE_SPANS + list(DERIVED_SPANS) + [PARSE_SPAN]:
+            values = durations.get(name)
+            if not values:
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            rows.append({"span": name, "count": len(values), "p50 (ms)": round(p50, 1), "p95 (ms)": round(p95, 1), "p99 (ms)": round(p99, 1)})
+        return pd.DataFrame(rows, columns=["span", "count", "p50 (ms)", "p95 (ms)", "p99 (ms)"])
+
+    def attribute_summary(self) -> Dict[str, Any]:
+        """意図の解決経路（分類器・キャッシュ・分析官AI）の内訳と、トークン数の平均を返す。"""
+        sources: Dict[str, int] = {}
+        tokens: Dict[str, List[int]] = {}
+        for spans in self.recent():
+            for span in spans:
+                attrs = span["attributes"]
+                if span["name"] == "analyzer" and "intent_source" in attrs:
+                    sources[attrs["intent_source"]] = sources.get(attrs["intent_source"], 0) + 1
+                for key in ("prompt_tokens", "response_tokens"):
+                    if key in attrs:
+                        tokens.setdefault(f"{span['name']}.{key}", []).append(attrs[key])
+        total = sum(sources.values())
+        return {
+            "intent_sources": sources,
+            "analyzer_avoided_rate": round(1 - sources.get("analyzer", 0) / total, 3) if total else None,
+            "avg_tokens": {key: round(sum(values) / len(values), 1) for key, values in sorted(tokens.items())},
+        }
+
+
+def admin_enabled(token: Optional[str]) -> bool:
+    """管理者用ページを表示してよいか（SYNAPSE_ADMIN_TOKEN が設定され、一致した場合のみ）。"""
+    return bool(ADMIN_TOKEN) and token is not None and secrets.compare_digest(str(token), ADMIN_TOKEN)
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder() -> TraceRecorder:
+    """プロセス全体で共有する TraceRecorder を返す。"""
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = TraceRecorder()
+        return _recorder
+
+
+def record_turn(timings, **turn_attributes: Any) -> List[Dict[str, Any]]:
+    """1ターン分のトレースを、共有の TraceRecorder に記録する。"""
+    return get_recorder().record(timings, **turn_attributes)
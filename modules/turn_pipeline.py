@@ -0,0 +1,352 @@
+# modules/turn_pipeline.py
+
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, InvalidStateError, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import pandas as pd
+
+from modules import catalog_index
+from modules import chat_history
+from modules import formatters
+from modules import gemini_client
+from modules import gemini_scheduler
+from modules import intent_cache
+from modules import intent_classifier
+from modules import intent_stream
+from modules import nutrition_data
+from modules import product_serializer
+from modules import protein_selector
+from modules import tag_index
+from modules import writer_cache
+
+try:
+    # Streamlitから呼ばれた場合は、ワーカースレッドにも実行中のセッションを引き継ぎます（st.error などを表示するため）
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:  # pragma: no cover - Streamlit なしで使う場合（ベンチマークなど）
+    add_script_run_ctx = get_script_run_ctx = None
+
+# 分析官AIの呼び出しなど、1ターンの中で並行に走らせる処理のためのスレッドプール（プロセス全体で共有）
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="turn-pipeline")
+# 分析官AIの応答の途中で key_metric と relevant_tags が届いた時点で、商品選定を始めるかどうか
+# （環境変数で "0" を指定すると、これまでどおり応答の全体を待ちます）
+EARLY_SELECTION_ENABLED = os.environ.get("SYNAPSE_EARLY_SELECTION", "1") != "0"
+
+
+class TurnTimings:
+    """
+    1ターンの各処理（ステージ）の開始・終了時刻を、ターン開始からのミリ秒で記録するクラス。
+    ステージは複数のスレッドから並行に記録されます。
+    ステージや時点には、トークン数やキャッシュの当否などの属性を付けられます（tracing で span に変換されます）。
+    """
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self.started_at = time.time()
+        self.trace_id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self.stages: Dict[str, tuple] = {}
+        self.marks: Dict[str, float] = {}
+        self.attributes: Dict[str, Dict[str, Any]] = {}
+
+    def now_ms(self) -> float:
+        return (time.perf_counter() - self._origin) * 1000
+
+    @contextmanager
+    def stage(self, name: str):
+        """with timings.stage("名前") as attributes: の形で使い、attributes に書いた値がステージの属性になります。"""
+        start = self.now_ms()
+        attributes: Dict[str, Any] = {}
+        try:
+            yield attributes
+        finally:
+            with self._lock:
+                self.stages[name] = (start, self.now_ms())
+                if attributes:
+                    self.attributes.setdefault(name, {}).update(attributes)
+
+    def mark(self, name: str, **attributes: Any) -> None:
+        """ある時点（最初のトークンの到着など）を記録する。同じ名前は最初の1回だけ記録します。"""
+        with self._lock:
+            self.marks.setdefault(name, self.now_ms())
+            if attributes:
+                self.attributes.setdefault(name, {}).update(attributes)
+
+    def annotate(self, name: str, **attributes: Any) -> None:
+        """記録済み（またはこれから記録する）ステージ・時点に、属性を追加する。"""
+        with self._lock:
+            self.attributes.setdefault(name, {}).update(attributes)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "trace_id": self.trace_id,
+                "started_at": self.started_at,
+                "stages": {name: {"start_ms": round(s, 1), "end_ms": round(e, 1), "ms": round(e - s, 1)} for name, (s, e) in self.stages.items()},
+                "marks": {name: round(t, 1) for name, t in self.marks.items()},
+                "attributes": {name: dict(attrs) for name, attrs in self.attributes.items()},
+            }
+
+    def summary(self) -> str:
+        with self._lock:
+            parts = [f"{name} {e - s:.1f}ms [{s:.0f}→{e:.0f}]" for name, (s, e) in sorted(self.stages.items(), key=lambda item: item[1][0])]
+            parts += [f"{name} @{t:.0f}ms" for name, t in sorted(self.marks.items(), key=lambda item: item[1])]
+        return " | ".join(parts)
+
+
+class PreparedTurn:
+    """prepare_turn の結果。stream を消費すると、コピーライターの応答がチャンクごとに得られます。"""
+
+    def __init__(self, intent, selected_products, baseline_product, key_metric_name_jp, key_metric_col_name, stream, timings):
+        self.intent = intent
+        self.selected_products = selected_products
+        self.baseline_product = baseline_product
+        self.key_metric_name_jp = key_metric_name_jp
+        self.key_metric_col_name = key_metric_col_name
+        self.stream = stream
+        self.timings = timings
+
+
+def _with_script_run_ctx(fn):
+    """呼び出し元（Streamlitのスクリプトスレッド）のセッション情報を、ワーカースレッドに引き継ぐラッパーを返す。"""
+    ctx = get_script_run_ctx() if get_script_run_ctx is not None else None
+    if ctx is None:
+        return fn
+
+    def run(*args, **kwargs):
+        thread = threading.current_thread()
+        add_script_run_ctx(thread, ctx)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            # プールのスレッドは他のセッションにも使い回されるので、引き継いだ情報を外しておきます
+            add_script_run_ctx(thread, None)
+    return run
+
+
+def resolve_intent(
+    prompt: str, persona_text: str, full_user_prompt: str, attributes: Optional[Dict[str, Any]] = None, hedge: bool = False,
+    priority: int = gemini_scheduler.PRIORITY_ANALYZER, on_selection_fields: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> Dict[str, Any]:
+    """
+    要望の intent を決める関数。ルール分類器 → 分析結果キャッシュ → 分析官AI の順に試します。
+    attributes に辞書を渡すと、どこで解決したか（intent_source）と、分析官AIのトークン数を書き込みます。
+    hedge=True の場合、分析官AIの応答が遅ければヘッジのリクエストを送ります（gemini_scheduler）。
+    priority は分析官AIへのリクエストの優先度です（先読みは PRIORITY_BACKGROUND）。
+    on_selection_fields は、分析官AIの応答の途中で key_metric と relevant_tags が届いた時に呼ばれます（intent_stream）。
+    """
+    attributes = attributes if attributes is not None else {}
+    # 「安い」「美味しい」のように明確な要望は、ルール分類器だけで判定し、分析官AIを呼びません
+    classified, confidence = intent_classifier.classify_intent(prompt)
+    if intent_classifier.is_confident(classified, confidence):
+        print(f"  - Intent resolved by local classifier (confidence {confidence:.2f}).", file=sys.stderr)
+        attributes.update(intent_source="classifier", cache_hit=False)
+        return classified
+
+    # よくある要望（例示ボタンや提案ボタンの文言など）は、キャッシュ済みの分析結果を使います
+    cache = intent_cache.get_shared_cache()
+    intent = cache.get(prompt, context=persona_text)
+    if intent is not None:
+        print("  - Intent served from cache.", file=sys.stderr)
+        attributes.update(intent_source="cache", cache_hit=True)
+        return intent
+
+    analyzer_start = time.perf_counter()
+    usage: Dict[str, Any] = {}
+    try:
+        intent = gemini_client.get_intent_from_ai(full_user_prompt, usage=usage, hedge=hedge, priority=priority, on_selection_fields=on_selection_fields)
+    except intent_stream.InvalidIntentError as e:
+        # やり直しても不正な応答だった場合は、ルール分類器の（確信度の低い）判定を使います。キャッシュには入れません。
+        print(f"  - Falling back to the local classifier: {e}", file=sys.stderr)
+        attributes.update(intent_source="classifier_fallback", cache_hit=False, hedged=hedge, analyzer_error=str(e), **usage)
+        return classified
+    attributes.update(intent_source="analyzer", cache_hit=False, hedged=hedge, **usage)
+    if intent:
+        # 通信エラー（空の intent）は、キャッシュにも分類器の学習データにも残しません
+        cache.put(prompt, intent, context=persona_text)
+        intent_classifier.record_analyzer_output(prompt, persona_text, intent, (time.perf_counter() - analyzer_start) * 1000)
+    return intent
+
+
+_STREAM_DONE = object()
+
+
+def _start_writer_stream(timings: TurnTimings, writer_kwargs: Dict[str, Any], on_complete: Optional[Callable[[str], None]] = None):
+    """
+    コピーライターへのリクエストを今すぐ別スレッドで発行し、届いたチャンクを順に返すジェネレーターを返す関数。
+    画面側が st.write_stream で読み始めるまでの間も、通信は先に進みます。
+    on_complete を渡すと、応答が最後まで届いた時に、その全文で呼び出します。
+    """
+    chunks: "queue.Queue" = queue.Queue()
+
+    def pump():
+        timings.mark("writer_request")
+        usage: Dict[str, Any] = {}
+        parts: List[str] = []
+        try:
+            for chunk in gemini_client.get_ai_response_writer(**writer_kwargs, usage=usage):
+                timings.mark("writer_first_token")
+                parts.append(chunk)
+                chunks.put(chunk)
+            if on_complete is not None:
+                on_complete("".join(parts))
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            timings.mark("writer_done", **usage)
+            chunks.put(_STREAM_DONE)
+
+    threading.Thread(target=_with_script_run_ctx(pump), name="turn-pipeline-writer", daemon=True).start()
+
+    def stream():
+        while True:
+            item = chunks.get()
+            if item is _STREAM_DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    return stream()
+
+
+def _writer_stream(timings: TurnTimings, writer_kwargs: Dict[str, Any], protein_df: pd.DataFrame, first_turn: bool):
+    """
+    コピーライターのストリームを返す関数。応答キャッシュ（writer_cache）が有効で、最初のターンの場合は、
+    同じ入力（会話履歴を除く）に対する保存済みの応答があれば、それを本物のストリームと同じ速さで再生します。
+    """
+    if not (writer_cache.WRITER_CACHE_ENABLED and first_turn):
+        return _start_writer_stream(timings, writer_kwargs)
+
+    cache = writer_cache.get_shared_cache()
+    key = writer_cache.cache_key(writer_kwargs)
+    version = writer_cache.cache_version(protein_df)
+    entry = cache.get(key, version)
+    if entry is None:
+        timings.annotate("writer_done", writer_cache="miss")
+        return _start_writer_stream(timings, writer_kwargs, on_complete=lambda text: cache.put(key, version, text))
+
+    print("  - Writer response served from cache.", file=sys.stderr)
+    timings.mark("writer_request")
+    return writer_cache.replay(
+        entry["text"],
+        on_first=lambda: timings.mark("writer_first_token"),
+        on_done=lambda: timings.mark("writer_done", writer_cache="hit"),
+    )
+
+
+def prepare_turn(protein_df: pd.DataFrame, messages: List[Dict[str, Any]], persona: Dict[str, Any], prefetched=None) -> PreparedTurn:
+    """
+    1ターン分の処理を、依存関係に沿って並行に進める関数（st.session_state には触れません）。
+
+        ペルソナ整形 ─┬─> 意図の判定（分析官AI） ─┐
+                      ├─> カタログの索引準備 ──────┼─> 商品選定 ─> 豆知識・ベースライン整形 ─> コピーライター
+                      └─> 会話履歴の整形 ──────────┘
+
+    コピーライターへのリクエストは、入力が揃った時点で発行されます。
+    prefetched（prefetch.PrefetchedSelection）を渡すと、先読み済みの意図と商品選定を使い、
+    意図の判定と商品選定を省略します。
+    分析官AIの応答は、key_metric と relevant_tags が届いた時点で商品選定を始め、要約の生成と並行に進めます。
+    """
+    timings = TurnTimings()
+    prompt = messages[-1]["content"]
+
+    # 最初の質問か、2回目以降かでAIに渡すプロンプトを整形
+    with timings.stage("persona"):
+        if len(messages) == 1:
+            persona_text = formatters.format_persona(persona)
+            full_user_prompt = f"{persona_text}\n\n**ユーザーの『乗り換えの決め手』:**\n{prompt}"
+        else:
+            persona_text = ""
+            full_user_prompt = prompt
+
+    # 分析官AIの応答の途中で key_metric と relevant_tags が届いたら、ここに入ります（商品選定を先に始めるため）
+    selection_fields: Future = Future()
+
+    def on_selection_fields(fields):
+        timings.mark("selection_fields_ready")
+        try:
+            selection_fields.set_result(fields)
+        except InvalidStateError:
+            # やり直しのリクエストから2度目が届いた場合は、最初のものを使います（最後に intent と照合します）
+            pass
+
+    def timed_resolve_intent():
+        with timings.stage("analyzer") as attributes:
+            # 最初のターンは、ユーザーが最も長く待つターンなので、分析官AIへのリクエストをヘッジします
+            return resolve_intent(
+                prompt, persona_text, full_user_prompt, attributes, hedge=len(messages) == 1,
+                on_selection_fields=on_selection_fields if EARLY_SELECTION_ENABLED else None,
+            )
+    intent_future = None if prefetched is not None else _executor.submit(_with_script_run_ctx(timed_resolve_intent))
+
+    # 以下は意図に依存しないので、分析官AIの応答を待つ間に済ませます
+    with timings.stage("catalog_prep"):
+        # スナップショットが更新された直後の最初のターンでは、ここで索引が作られます
+        catalog_index.get_catalog_index(protein_df)
+        tag_index.get_tag_index(protein_df)
+    with timings.stage("history") as attributes:
+        chat_history_text = formatters.format_chat_history(messages)
+        attributes.update(messages=len(messages), history_tokens=chat_history.estimate_tokens(chat_history_text))
+
+    def select_and_format(selection_intent, early):
+        """商品選定と、コピーライターに渡すデータの整形（selection_intent の key_metric と relevant_tags だけを使います）。"""
+        with timings.stage("selection") as attributes:
+            if prefetched is not None:
+                selection = prefetched.selection
+            else:
+                selection = protein_selector.select_products(protein_df, selection_intent, persona)
+            attributes.update(
+                prefetched=prefetched is not None, early_start=early, key_metric=selection_intent.get("key_metric", "Other"),
+                products=len(selection[0]), catalog_rows=len(protein_df),
+            )
+        selected_products, baseline_product, _, key_metric_name_jp, key_metric_col_name = selection
+        with timings.stage("writer_inputs") as attributes:
+            baseline_text = formatters.format_baseline_for_ai(baseline_product, key_metric_name_jp, key_metric_col_name)
+            nutrition_tip_text = nutrition_data.get_formatted_nutrition_tip(selection_intent)
+            selected_products_data = product_serializer.serialize_products(protein_df, selected_products, selection_intent.get("key_metric"))
+            attributes.update(products_tokens=chat_history.estimate_tokens(selected_products_data))
+        return selection, baseline_text, nutrition_tip_text, selected_products_data
+
+    selected = None
+    if prefetched is not None:
+        # 先読みした時の解決経路と所要時間を、このターンの analyzer の属性として残します（所要時間はほぼ0です）
+        with timings.stage("analyzer") as attributes:
+            intent = prefetched.intent
+            attributes.update(intent_source="prefetch", cache_hit=True, prefetched_source=prefetched.attributes.get("intent_source"), prefetch_ms=round(prefetched.elapsed_ms, 1))
+    else:
+        wait([intent_future, selection_fields], return_when=FIRST_COMPLETED)
+        if not intent_future.done():
+            # 要約（user_desire_summary）の生成を待つ間に、商品選定と整形を済ませます
+            early_fields = selection_fields.result()
+            selected = (early_fields, select_and_format(early_fields, early=True))
+        intent = intent_future.result()
+    timings.mark("intent_ready")
+    user_desire = intent.get("user_desire_summary", "総合的なおすすめ")
+
+    if selected is not None and any(selected[0].get(field) != intent.get(field) for field in intent_stream.SELECTION_FIELDS):
+        # やり直しのリクエストや、分類器への切り替えで項目が変わった場合は、選定し直します
+        timings.annotate("selection", reselected=True)
+        selected = None
+    if selected is None:
+        selected = (intent, select_and_format(intent, early=False))
+    selection, baseline_text, nutrition_tip_text, selected_products_data = selected[1]
+    selected_products, baseline_product, selection_reason, key_metric_name_jp, key_metric_col_name = selection
+
+    writer_kwargs = dict(
+        full_user_prompt=full_user_prompt,
+        user_desire_summary=user_desire,
+        key_metric_name=key_metric_name_jp,
+        selection_reason=selection_reason,
+        baseline_product_data=baseline_text,
+        selected_products_data=selected_products_data,
+        chat_history=chat_history_text,
+        nutrition_tip=nutrition_tip_text,
+    )
+    stream = _writer_stream(timings, writer_kwargs, protein_df, first_turn=len(messages) == 1)
+    return PreparedTurn(intent, selected_products, baseline_product, key_metric_name_jp, key_metric_col_name, stream, timings)
@@ -3,135 +3,127 @@ import pandas as pd
 import re
 import streamlit.components.v1 as components
 import sys
-import altair as alt
 
-def render_protein_position_map(all_proteins_df: pd.DataFrame, comparison_df: pd.DataFrame):
+from modules import catalog_index
+from modules import chart_data
+from modules import prefetch
+from modules import render_cache
+from modules import tracing
+
+def render_protein_position_map(all_proteins_df: pd.DataFrame, baseline_id=None, recommend_ids=()):
     """
     価格とタンパク質含有率の2軸で、全プロテインのポジションマップを描画する関数。
-    比較対象の商品はハイライト表示する。
+    比較対象の商品（ベースラインと提案商品）はハイライト表示する。
+    全商品の背景レイヤーはスナップショットごとに1度だけ作られ（大きなカタログは間引かれます）、
+    再実行のたびに作り直すのは、比較対象の商品を描く小さなレイヤーだけです。
     """
     st.subheader("プロテイン・ポジションマップ")
+    map_data = chart_data.get_position_map_data(all_proteins_df)
+    if not map_data.available:
+        return
 
-    # グラフ描画用にデータをコピー
-    plot_df = all_proteins_df.copy()
-
-    # 比較対象がない場合は、全商品を「その他の商品」としてプロット
-    plot_df['Highlight'] = 'その他の商品'
+    overlay = map_data.overlay_values(all_proteins_df, baseline_id, recommend_ids)
 
-    # 比較対象がある場合は、それらを色分けするための列を追加
-    if not comparison_df.empty:
-        # 最初の行をベースライン（現在の商品）とする
-        baseline_id = comparison_df.iloc[0]['ProductID']
-        # 2行目以降をAIの提案とする
-        recommend_ids = comparison_df.iloc[1:]['ProductID'].tolist()
-        
-        plot_df.loc[plot_df['ProductID'] == baseline_id, 'Highlight'] = '現在の商品'
-        plot_df.loc[plot_df['ProductID'].isin(recommend_ids), 'Highlight'] = 'AIの提案'
-
-    # Altairを使って散布図を作成
-    chart = alt.Chart(plot_df).mark_circle(size=100).encode(
-        x=alt.X('PricePerKg(JPY):Q', title='価格 (円/kg) ←安い', scale=alt.Scale(zero=False), sort='descending'),
-        y=alt.Y('ProteinPurity(%):Q', title='タンパク質含有率 (%) ↑高い', scale=alt.Scale(zero=False)),
-        color=alt.Color('Highlight:N', title='凡例',
-            scale=alt.Scale(
-                domain=['現在の商品', 'AIの提案', 'その他の商品'],
-                range=['#1f77b4', '#2ca02c', 'lightgray'] # 青, 緑, グレー
-            )
-        ),
-        tooltip=['Brand', 'ProductName', 'PricePerKg(JPY)', 'ProteinPurity(%)']
-    ).properties(
-        title='市場全体におけるあなたのプロテインのポジション'
-    ).interactive()
-
-    st.altair_chart(chart, use_container_width=True)
+    st.vega_lite_chart(map_data.spec(overlay), use_container_width=True)
+    if map_data.base_points < map_data.total_points:
+        st.caption(f"全{map_data.total_points:,}商品のうち、分布を代表する{map_data.base_points:,}点を表示しています。")
     st.caption("グラフ上の点をクリック＆ドラッグで移動、マウスホイールで拡大・縮小ができます。")
 
+def render_product_card(product_data: pd.Series):
+    """提案商品1件分のカード（画像・ブランド・商品名・購入リンク）を描画する関数。"""
+    with st.container(border=True):
+        cols = st.columns([1, 2])
+        with cols[0]:
+            if 'ImageURL' in product_data and product_data['ImageURL']:
+                st.image(product_data['ImageURL'], use_container_width=True)
+        with cols[1]:
+            st.markdown(f"**{product_data['Brand']}**")
+            st.markdown(f"*{product_data['ProductName']}*")
+            st.link_button("Amazonで見る 🛍️", product_data['AmazonURL'], use_container_width=True)
 
-def render_protein_position_map(all_proteins_df: pd.DataFrame, comparison_df: pd.DataFrame):
-    # (この関数は変更ありません)
-    st.subheader("プロテイン・ポジションマップ")
-    # ... (以降のコードは省略しませんが、内容は同じです)
-    plot_df = all_proteins_df.copy()
-    plot_df['Highlight'] = 'その他の商品'
-    if not comparison_df.empty:
-        baseline_id = comparison_df.iloc[0]['ProductID']
-        recommend_ids = comparison_df.iloc[1:]['ProductID'].tolist()
-        plot_df.loc[plot_df['ProductID'] == baseline_id, 'Highlight'] = '現在の商品'
-        plot_df.loc[plot_df['ProductID'].isin(recommend_ids), 'Highlight'] = 'AIの提案'
-    chart = alt.Chart(plot_df).mark_circle(size=100).encode(
-        x=alt.X('PricePerKg(JPY):Q', title='価格 (円/kg) ←安い', scale=alt.Scale(zero=False)),
-        y=alt.Y('ProteinPurity(%):Q', title='タンパク質含有率 (%) ↑高い', scale=alt.Scale(zero=False)),
-        color=alt.Color('Highlight:N', title='凡例',
-            scale=alt.Scale(
-                domain=['現在の商品', 'AIの提案', 'その他の商品'],
-                range=['#1f77b4', '#2ca02c', 'lightgray']
-            )
-        ),
-        tooltip=['Brand', 'ProductName', 'PricePerKg(JPY)', 'ProteinPurity(%)']
-    ).properties(
-        title='市場全体におけるあなたのプロテインの位置'
-    ).interactive()
-    st.altair_chart(chart, use_container_width=True)
-    st.caption("グラフ上の点をクリック＆ドラッグで移動、マウスホイールで拡大・縮小ができます。")
+BRAND_PLACEHOLDER = "選択してください"
+OTHER_PRODUCT_OPTION = ("その他 / この中にない", "OTHER")
 
 def render_diagnosis_form(protein_df: pd.DataFrame):
-    # (この関数は変更ありません)
+    """
+    診断フォームを描画する関数。
+    各設問は st.fragment になっていて、ボタン・選択・トグルを操作しても、その設問の部分だけが再実行されます
+    （スクリプト全体が再実行されるのは、最後の「相談を始める」ボタンを押した時だけです）。
+    """
     st.info("あなたに最適な提案をするために、まずは簡単な自己紹介をお願いします。")
-    # ... (以降のコードは省略しませんが、内容は同じです)
     with st.container(border=True):
-        st.subheader("Q1. プロテインの利用経験は？")
-        exp_options = ["継続的に飲んでいる", "初めて or ほとんど飲んだことがない"]
-        def set_experience(exp):
-            st.session_state.persona['experience'] = exp
-        cols = st.columns(len(exp_options))
-        for i, option in enumerate(exp_options):
-            with cols[i]:
-                button_type = "primary" if st.session_state.persona.get('experience') == option else "secondary"
-                st.button(option, on_click=set_experience, args=[option], key=f"q1_{i}", use_container_width=True, type=button_type)
-        if st.session_state.persona.get('experience') == '継続的に飲んでいる':
-            st.subheader("Q2. 現在、主に飲んでいるブランドと製品は？")
-            all_brands = ["選択してください"] + sorted(protein_df["Brand"].unique())
-            try:
-                current_brand_index = all_brands.index(st.session_state.persona.get('current_brand'))
-            except (ValueError, TypeError):
-                current_brand_index = 0
-            selected_brand = st.selectbox("まずブランドを選択してください", options=all_brands, index=current_brand_index, key="brand_selector")
-            if selected_brand != "選択してください":
-                st.session_state.persona['current_brand'] = selected_brand
-            else:
-                st.session_state.persona['current_brand'] = None
-                st.session_state.persona['baseline_product_id'] = None
-            if st.session_state.persona.get('current_brand'):
-                brand_df = protein_df[protein_df["Brand"] == st.session_state.persona['current_brand']]
-                product_options = [("その他 / この中にない", "OTHER")] + list(zip(brand_df['ProductName'], brand_df['ProductID']))
-                current_product_id = st.session_state.persona.get('baseline_product_id')
-                current_product_index = 0
-                if current_product_id:
-                    try:
-                        current_product_index = [item[1] for item in product_options].index(current_product_id)
-                    except ValueError:
-                        current_product_index = 0
-                selected_product_tuple = st.selectbox(f"次に「{st.session_state.persona['current_brand']}」の具体的な製品を選択してください（任意）", options=product_options, index=current_product_index, format_func=lambda x: x[0], key="product_selector")
-                selected_product_id = selected_product_tuple[1]
-                if selected_product_id != "OTHER":
-                    st.session_state.persona['baseline_product_id'] = selected_product_id
-                else:
-                    st.session_state.persona['baseline_product_id'] = None
-        st.subheader("Q3. プロテインを飲む主な目的は何ですか？")
-        purpose_options = ["筋肉を大きくしたい", "ダイエット・減量", "健康・栄養補助"]
-        st.session_state.persona['purpose'] = st.selectbox("目的", purpose_options, index=purpose_options.index(st.session_state.persona.get('purpose', '筋肉を大きくしたい')), label_visibility="collapsed")
-        st.subheader("Q4. 新しいプロテインを探す上で、重視する点は何ですか？ (いくつでも)")
-        priorities_map = {'価格の安さ': '価格の安さ (コスパ)', '味のおいしさ': '味のおいしさ', '成分の品質': '成分の品質 (高タンパク, 無添加など)', '有名ブランド': '有名ブランドであることの安心感'}
-        cols = st.columns(2)
-        for i, (key, label) in enumerate(priorities_map.items()):
-            with cols[i % 2]:
-                with st.container(border=True):
-                    st.session_state.persona['priorities'][key] = st.toggle(label, value=st.session_state.persona['priorities'].get(key, False), key=f"q4_{key}")
+        _render_experience_section(protein_df)
+        _render_purpose_section()
+        _render_priorities_section()
     st.markdown("---")
     if st.button("✅ 上の内容で、AIに相談を始める", type="primary", use_container_width=True):
         st.session_state.diagnosis_complete = True
         st.rerun()
 
+@st.fragment
+def _render_experience_section(protein_df: pd.DataFrame):
+    """Q1（利用経験）と、その回答によって表示する Q2（ブランドと製品）。"""
+    st.subheader("Q1. プロテインの利用経験は？")
+    exp_options = ["継続的に飲んでいる", "初めて or ほとんど飲んだことがない"]
+    def set_experience(exp):
+        st.session_state.persona['experience'] = exp
+    cols = st.columns(len(exp_options))
+    for i, option in enumerate(exp_options):
+        with cols[i]:
+            button_type = "primary" if st.session_state.persona.get('experience') == option else "secondary"
+            st.button(option, on_click=set_experience, args=[option], key=f"q1_{i}", use_container_width=True, type=button_type)
+    if st.session_state.persona.get('experience') == '継続的に飲んでいる':
+        _render_brand_question(protein_df)
+
+def _render_brand_question(protein_df: pd.DataFrame):
+    st.subheader("Q2. 現在、主に飲んでいるブランドと製品は？")
+    # ブランドの一覧と、ブランドごとの商品の一覧は、スナップショットごとに1度だけ作られます
+    options = catalog_index.get_brand_options(protein_df)
+    all_brands = [BRAND_PLACEHOLDER] + options.brands
+    try:
+        current_brand_index = all_brands.index(st.session_state.persona.get('current_brand'))
+    except (ValueError, TypeError):
+        current_brand_index = 0
+    selected_brand = st.selectbox("まずブランドを選択してください", options=all_brands, index=current_brand_index, key="brand_selector")
+    if selected_brand != BRAND_PLACEHOLDER:
+        st.session_state.persona['current_brand'] = selected_brand
+    else:
+        st.session_state.persona['current_brand'] = None
+        st.session_state.persona['baseline_product_id'] = None
+    if not st.session_state.persona.get('current_brand'):
+        return
+    brand_products = options.products(st.session_state.persona['current_brand'])
+    product_options = [OTHER_PRODUCT_OPTION] + brand_products
+    current_product_id = st.session_state.persona.get('baseline_product_id')
+    current_product_index = 0
+    if current_product_id:
+        position = options.position_in_brand(current_product_id)
+        # 別のブランドの商品が選ばれたままの場合は「その他」に戻します
+        if position is not None and position < len(brand_products) and brand_products[position][1] == current_product_id:
+            current_product_index = position + 1
+    selected_product_tuple = st.selectbox(f"次に「{st.session_state.persona['current_brand']}」の具体的な製品を選択してください（任意）", options=product_options, index=current_product_index, format_func=lambda x: x[0], key="product_selector")
+    selected_product_id = selected_product_tuple[1]
+    if selected_product_id != "OTHER":
+        st.session_state.persona['baseline_product_id'] = selected_product_id
+    else:
+        st.session_state.persona['baseline_product_id'] = None
+
+@st.fragment
+def _render_purpose_section():
+    st.subheader("Q3. プロテインを飲む主な目的は何ですか？")
+    purpose_options = ["筋肉を大きくしたい", "ダイエット・減量", "健康・栄養補助"]
+    st.session_state.persona['purpose'] = st.selectbox("目的", purpose_options, index=purpose_options.index(st.session_state.persona.get('purpose', '筋肉を大きくしたい')), label_visibility="collapsed", key="q3_purpose")
+
+@st.fragment
+def _render_priorities_section():
+    st.subheader("Q4. 新しいプロテインを探す上で、重視する点は何ですか？ (いくつでも)")
+    priorities_map = {'価格の安さ': '価格の安さ (コスパ)', '味のおいしさ': '味のおいしさ', '成分の品質': '成分の品質 (高タンパク, 無添加など)', '有名ブランド': '有名ブランドであることの安心感'}
+    cols = st.columns(2)
+    for i, (key, label) in enumerate(priorities_map.items()):
+        with cols[i % 2]:
+            with st.container(border=True):
+                st.session_state.persona['priorities'][key] = st.toggle(label, value=st.session_state.persona['priorities'].get(key, False), key=f"q4_{key}")
+
 def render_chat_interface(protein_df: pd.DataFrame):
     """チャット画面のUIを描画し、メインの脳(app.py)にユーザーの入力を報告する関数"""
     st.subheader("あなただけの『理想のプロテイン』を見つけましょう")
@@ -147,43 +139,26 @@ def render_chat_interface(protein_df: pd.DataFrame):
     
     last_message = st.session_state.messages[-1] if st.session_state.messages else {}
     if last_message and last_message.get("role") == "assistant":
-        product_ids_found = re.findall(r'<!-- ID: ([A-Z]{2}\d{3}) -->', last_message["content"])
+        # 商品IDはメッセージの作成時に解析済み、ProductIDの検索はスナップショットごとの CatalogIndex を使います
+        product_ids_found = render_cache.message_product_ids(last_message)
         if product_ids_found:
             st.markdown("---")
             st.subheader("提案商品の詳細")
-            protein_df_indexed = protein_df.set_index('ProductID')
-            for product_id in set(product_ids_found):
-                if product_id in protein_df_indexed.index:
-                    product_data = protein_df_indexed.loc[product_id]
-                    with st.container(border=True):
-                        cols = st.columns([1, 2])
-                        with cols[0]:
-                            if 'ImageURL' in product_data and product_data['ImageURL']:
-                                st.image(product_data['ImageURL'], use_container_width=True)
-                        with cols[1]:
-                            st.markdown(f"**{product_data['Brand']}**")
-                            st.markdown(f"*{product_data['ProductName']}*")
-                            st.link_button("Amazonで見る 🛍️", product_data['AmazonURL'], use_container_width=True)
+            index = catalog_index.get_catalog_index(protein_df)
+            for product_id in product_ids_found:
+                product_data = index.product_row(product_id)
+                if product_data is not None:
+                    render_product_card(product_data)
 
     # --- ステップ2: 比較表の表示 ---
     if st.session_state.get("table_info") is not None:
         st.markdown("---")
         st.subheader("性能比較表")
         table_info = st.session_state.table_info
-        table_df = table_info["data"]
-        key_metric = table_info["metric"]
-        display_columns = ['ProductName', 'ProteinPurity(%)', 'Price(JPY)', 'WeightInKg']
-        if key_metric == 'PricePerKg(JPY)':
-            display_columns.append('PricePerKg(JPY)')
-        final_table = table_df[display_columns].rename(columns={
-            'ProductName': '商品名', 'ProteinPurity(%)': 'タンパク質含有率 (%)',
-            'Price(JPY)': '価格 (円)', 'WeightInKg': '内容量 (kg)',
-            'PricePerKg(JPY)': '価格 (円/kg)'
-        })
-        st.table(final_table.set_index('商品名').style.format({
-            'タンパク質含有率 (%)': '{:.1f}%', '価格 (円)': '{:,.0f}',
-            '内容量 (kg)': '{:.2f}', '価格 (円/kg)': '{:,.0f}'
-        }))
+        # セッションには商品IDしか保存していないので、表は共有のカタログから組み立てます
+        # (整形済みの表は (表ID, スナップショット) ごとに1度だけ作られます)
+        st.table(render_cache.comparison_table(table_info, protein_df))
+        render_protein_position_map(protein_df, table_info.get("baseline_id"), table_info.get("product_ids", []))
 
     # --- ステップ3: 提案ボタンの表示と、メインの脳への報告 ---
     if last_message and last_message.get("role") == "assistant":
@@ -220,4 +195,46 @@ def render_chat_interface(protein_df: pd.DataFrame):
     if chat_input:
         prompt = chat_input
         
-    return prompt
\ No newline at end of file
+    return prompt
+
+def render_trace_dashboard():
+    """
+    管理者用の計測ページ。直近のターンについて、ステージごとの所要時間のパーセンタイルと、
+    意図の解決経路・トークン数の内訳を表示する（?admin=<SYNAPSE_ADMIN_TOKEN> で開きます）。
+    """
+    recorder = tracing.get_recorder()
+    st.subheader("パイプラインの計測（管理者用）")
+    st.caption(f"このプロセスで記録したターン: {recorder.turns:,}件（パーセンタイルは直近{tracing.ROLLING_WINDOW}件から計算）")
+    if recorder.path:
+        st.caption(f"トレースの書き出し先: {recorder.path}（{recorder.fmt}）")
+
+    percentiles = recorder.stage_percentiles()
+    if percentiles.empty:
+        st.info("まだ記録されたターンがありません。")
+        return
+    st.dataframe(percentiles.set_index("span"), use_container_width=True)
+
+    summary = recorder.attribute_summary()
+    cols = st.columns(2)
+    with cols[0]:
+        st.markdown("**意図の解決経路**")
+        st.table(pd.Series(summary["intent_sources"], name="ターン数"))
+        if summary["analyzer_avoided_rate"] is not None:
+            st.caption(f"分析官AIを呼ばずに済んだ割合: {summary['analyzer_avoided_rate']:.0%}")
+    with cols[1]:
+        st.markdown("**平均トークン数**")
+        st.table(pd.Series(summary["avg_tokens"], name="トークン", dtype="float64"))
+
+    prefetch_stats = prefetch.stats()
+    if prefetch_stats["started"]:
+        st.markdown("**提案ボタンの先読み**")
+        hit_rate = f"{prefetch_stats['hit_rate']:.0%}" if prefetch_stats["hit_rate"] is not None else "-"
+        waste_rate = f"{prefetch_stats['waste_rate']:.0%}" if prefetch_stats["waste_rate"] is not None else "-"
+        st.caption(
+            f"ヒット率 {hit_rate}（{prefetch_stats['hits']:,} / {prefetch_stats['hits'] + prefetch_stats['misses']:,}ターン）、"
+            f"無駄になった先読み {waste_rate}（うち分析官AIの呼び出し {prefetch_stats['wasted_analyzer_calls']:,}件）、"
+            f"短縮した時間の合計 {prefetch_stats['saved_ms'] / 1000:.1f}秒"
+        )
+
+    with st.expander("直近のトレース（JSON）"):
+        st.json(recorder.recent()[-1])
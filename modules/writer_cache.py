@@ -0,0 +1,136 @@
+# modules/writer_cache.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from modules import catalog_store
+from modules import stream_parser
+
+# コピーライターの応答キャッシュを使うかどうか（環境変数で "1" を指定した場合のみ）
+WRITER_CACHE_ENABLED = os.environ.get("SYNAPSE_WRITER_CACHE") == "1"
+# 保存する応答の数と、保存期間（秒）
+MAX_ENTRIES = 256
+TTL_SECONDS = 6 * 3600
+# キャッシュした応答を再生する速さ（1チャンクの文字数と、チャンクの間隔）。本物のストリームに近い見え方にします。
+REPLAY_CHUNK_CHARS = 12
+REPLAY_INTERVAL_SECONDS = 0.015
+
+# キーに含めない入力（会話履歴はターンごとに違うため。キャッシュは最初のターンだけに使います）
+EXCLUDED_INPUTS = ("chat_history",)
+
+
+def cache_key(writer_inputs: Dict[str, Any]) -> str:
+    """コピーライターへの入力（会話履歴を除く）を、キーの順序によらない形で SHA-256 にした文字列を返す。"""
+    canonical = {k: v for k, v in writer_inputs.items() if k not in EXCLUDED_INPUTS}
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class WriterCache:
+    """
+    コピーライターの完成した応答を保存するキャッシュ（例示ボタンからの最初のターンなど、入力が同じ応答の使い回し用）。
+
+    - 応答の全文（[SUGGESTIONS] ブロックと商品の目印を含む）と、解析済みの提案・商品IDを保存します。
+      商品IDと提案がそろった、正常な応答だけを保存します（エラーの文言などは保存しません）。
+    - 件数の上限（LRU）と保存期間があります。
+    - version（カタログのスナップショットと、コピーライターのプロンプトの版）が変わると、全体を破棄します。
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, ttl_seconds: float = TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._version = None
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "rejected": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key: str, version: Any) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry["created_at"] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key: str, version: Any, text: str) -> bool:
+        """応答の全文を解析し、正常な応答で、version が現在の版と同じであれば保存する。保存したかどうかを返します。"""
+        parser = stream_parser.WriterStreamParser()
+        parser.feed(text)
+        parser.close()
+        with self._lock:
+            # ストリームの途中でカタログやプロンプトが更新された場合、古い版で作った応答は保存しません
+            # （版を進めるのは get だけです。ここで戻すと、新しい版で保存した応答を破棄してしまいます）
+            if not parser.product_ids or not parser.suggestions or version != self._version:
+                self.stats["rejected"] += 1
+                return False
+            self._entries[key] = {
+                "text": text, "body": parser.body, "suggestions": parser.suggestions,
+                "product_ids": parser.product_ids, "created_at": time.monotonic(),
+            }
+            self._entries.move_to_end(key)
+            self.stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _check_version(self, version: Any) -> None:
+        if version != self._version:
+            if self._entries:
+                self.stats["invalidations"] += 1
+            self._entries.clear()
+            self._version = version
+
+
+def replay(text: str, chunk_chars: int = REPLAY_CHUNK_CHARS, interval: float = REPLAY_INTERVAL_SECONDS,
+           on_first: Optional[Callable[[], None]] = None, on_done: Optional[Callable[[], None]] = None) -> Iterator[str]:
+    """キャッシュした応答を、本物のストリームと同じようにチャンクに分けて一定の間隔で返すジェネレーター。"""
+    try:
+        for i in range(0, len(text), chunk_chars):
+            if i:
+                time.sleep(interval)
+            elif on_first is not None:
+                on_first()
+            yield text[i:i + chunk_chars]
+    finally:
+        if on_done is not None:
+            on_done()
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_cache() -> WriterCache:
+    """プロセス全体で共有する WriterCache を返す。"""
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = WriterCache()
+        return _shared_cache
+
+
+def cache_version(protein_df) -> tuple:
+    """キャッシュの版（カタログのスナップショットと、コピーライターのプロンプト・テンプレートの mtime）。"""
+    from modules import gemini_client
+    return (
+        catalog_store.snapshot_version(protein_df),
+        gemini_client.get_prompt_version(gemini_client.WRITER_SYSTEM_PROMPT),
+        gemini_client.get_prompt_version(gemini_client.WRITER_TURN_TEMPLATE),
+    )
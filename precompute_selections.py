@@ -0,0 +1,182 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from modules import catalog_index
+from modules import catalog_store
+from modules import protein_selector
+from modules import selection_table
+from modules import tag_index
+from modules.fake_backends import make_synthetic_catalog
+
+# --------------------------------------------------------------------------
+# 商品選定（protein_selector.select_products）の事前計算バッチ。
+# 診断フォームの「重視する点」(2^4通り) × key_metric × relevant_tags（なし / 1種類）の全ての組み合わせについて、
+# プロセスプールで選定結果を計算し、selection_table の表（JSON）に書き出します。
+# 実行時の select_products は、表があればそれを引くだけになります（表にない組み合わせは、その場で計算します）。
+#
+#   python precompute_selections.py                       # data/catalog_snapshot.arrow から表を作成
+#   python precompute_selections.py --watch 60            # スナップショットが更新されるたびに作り直す
+#   python precompute_selections.py --synthetic 100000    # 合成カタログで、所要時間と表の大きさを確認
+# --------------------------------------------------------------------------
+
+VALIDATION_SAMPLES = 500
+
+_worker_df = None
+
+
+def _init_worker(snapshot_path):
+    """ワーカープロセスごとに1度だけ、スナップショットをメモリマップで読み込む。"""
+    global _worker_df
+    _worker_df = catalog_store.read_snapshot(snapshot_path)
+
+
+def _positions(index, selected):
+    return [index.position_of(pid) for pid in selected['ProductID']] if not selected.empty else []
+
+
+def compute_entries(task):
+    """1つの (重視する点, key_metric) について、全てのタグの表の行と、指標の表示名を計算する。"""
+    mask, metric, tags = task
+    df = _worker_df
+    index = catalog_index.get_catalog_index(df)
+    persona = {"priorities": selection_table.priorities_from_mask(mask), "baseline_product_id": None, "current_brand": None}
+    entries, labels = {}, None
+    for tag in tags:
+        intent = {"key_metric": metric, "relevant_tags": [tag] if tag else []}
+        selected, _, reason, name_jp, col = protein_selector.select_products(df, intent, persona, use_table=False)
+        default = _positions(index, selected)
+        without = {}
+        for position in default:
+            # 提案された商品がベースラインだった場合（その商品を除外した場合）の結果
+            excluded_persona = dict(persona, baseline_product_id=index.product_ids[position])
+            excluded, _, _, _, _ = protein_selector.select_products(df, intent, excluded_persona, use_table=False)
+            without[str(position)] = _positions(index, excluded)
+        entries[selection_table.entry_key(mask, metric, tag)] = {"d": default, "x": without}
+        labels = [reason, name_jp, col]
+    return metric, entries, labels
+
+
+def build_table(snapshot_path, table_path, workers):
+    """スナップショットから表を作って書き出し、所要時間などの報告を返す。"""
+    start = time.perf_counter()
+    df = catalog_store.read_snapshot(snapshot_path)
+    if df is None or df.empty:
+        raise RuntimeError(f"catalog snapshot not found: {snapshot_path}")
+    tags = [""] + selection_table.tag_vocabulary(tag_index.get_tag_index(df))
+    tasks = [(mask, metric, tags) for mask in range(1 << len(selection_table.PRIORITY_NAMES)) for metric in selection_table.KEY_METRICS]
+
+    entries, labels = {}, {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(snapshot_path,)) as pool:
+        for metric, task_entries, task_labels in pool.map(compute_entries, tasks):
+            entries.update(task_entries)
+            labels[metric] = task_labels
+    compute_seconds = time.perf_counter() - start
+
+    version = catalog_store.snapshot_version(df)
+    size = selection_table.write_table(table_path, version, len(df), entries, labels)
+    return df, {
+        "snapshot_version": version, "catalog_rows": len(df), "entries": len(entries),
+        "tags": len(tags) - 1, "workers": workers,
+        "compute_seconds": round(compute_seconds, 2), "table_bytes": size,
+    }
+
+
+def validate(df, table_path, samples, seed=0):
+    """
+    ランダムな診断結果（ベースラインの有無を含む）について、表を引いた結果とその場で計算した結果が一致するかを確かめる。
+    不一致の件数と、1回あたりの選定時間（表あり / なし）を返します。
+    """
+    rng = random.Random(seed)
+    table = selection_table.get_selection_table(df, table_path)
+    if table is None:
+        raise RuntimeError("selection table does not match the snapshot")
+    index = catalog_index.get_catalog_index(df)
+    vocabulary = selection_table.tag_vocabulary(tag_index.get_tag_index(df))
+    brands = sorted(df['Brand'].dropna().unique()) if 'Brand' in df.columns else []
+    mismatches, lookup_s, live_s = 0, 0.0, 0.0
+    for _ in range(samples):
+        persona = {"priorities": selection_table.priorities_from_mask(rng.randrange(16)), "baseline_product_id": None, "current_brand": None}
+        baseline_kind = rng.random()
+        if baseline_kind < 0.4:
+            persona["baseline_product_id"] = index.product_ids[rng.randrange(len(index))]
+        elif baseline_kind < 0.6 and brands:
+            persona["current_brand"] = rng.choice(brands)
+        intent = {"key_metric": rng.choice(selection_table.KEY_METRICS), "relevant_tags": [rng.choice(vocabulary)] if rng.random() < 0.5 else []}
+
+        start = time.perf_counter()
+        expected = protein_selector.select_products(df, intent, persona, use_table=False)
+        live_s += time.perf_counter() - start
+        start = time.perf_counter()
+        baseline = index.product_row(persona["baseline_product_id"]) if persona["baseline_product_id"] else (
+            index.first_row_of_brand(persona["current_brand"]) if persona["current_brand"] else None)
+        cached = table.lookup(index, intent, persona, baseline)
+        lookup_s += time.perf_counter() - start
+
+        if cached is None or cached[0] != _positions(index, expected[0]) or list(cached[1:]) != list(expected[2:]):
+            mismatches += 1
+    return {"samples": samples, "mismatches": mismatches,
+            "live_ms": round(live_s / samples * 1000, 3), "lookup_ms": round(lookup_s / samples * 1000, 3)}
+
+
+def print_report(report, validation):
+    print(f"snapshot {report['snapshot_version']}: {report['catalog_rows']:,} rows, {report['tags']} tags")
+    print(f"precomputed {report['entries']:,} selections in {report['compute_seconds']} s with {report['workers']} workers; "
+          f"table {report['table_bytes'] / 1024:.1f} KB")
+    if validation:
+        print(f"validation: {validation['mismatches']} mismatches in {validation['samples']} random personas; "
+              f"select_products {validation['live_ms']} ms live vs {validation['lookup_ms']} ms from table")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute select_products over the diagnosis persona space.")
+    parser.add_argument("--snapshot", default=catalog_store.SNAPSHOT_PATH, help="カタログのスナップショット（Arrow）")
+    parser.add_argument("--table", default=selection_table.TABLE_PATH, help="書き出す表のパス")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--synthetic", type=int, default=None, help="スナップショットの代わりに、この件数の合成カタログを使う")
+    parser.add_argument("--watch", type=float, default=None, help="この秒数ごとにスナップショットを確認し、更新されていれば作り直す")
+    parser.add_argument("--skip-validation", action="store_true")
+    args = parser.parse_args(argv)
+
+    tmp_dir = None
+    if args.synthetic:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="selection-table-")
+        df = make_synthetic_catalog(args.synthetic)
+        args.snapshot = os.path.join(tmp_dir.name, 'catalog.arrow')
+        args.table = os.path.join(tmp_dir.name, 'selection_table.json')
+        catalog_store.write_snapshot(df, args.snapshot, {'snapshot_version': catalog_store.snapshot_version(df), 'source_revision': ''})
+
+    built_version = None
+    while True:
+        current = catalog_store.read_snapshot(args.snapshot)
+        version = catalog_store.snapshot_version(current) if current is not None else None
+        if version is not None and version != built_version:
+            # 同じディレクトリの候補ファイルに書き出して検証し、通った場合だけ実行中のアプリが読む表と置き換えます
+            # （検証に失敗した場合は、前回の表をそのまま残します）
+            candidate = f"{args.table}.candidate"
+            try:
+                df, report = build_table(args.snapshot, candidate, args.workers)
+                validation = None if args.skip_validation else validate(df, candidate, VALIDATION_SAMPLES)
+                print_report(report, validation)
+                built_version = version
+                if validation and validation["mismatches"]:
+                    print("--- [WARNING] Precomputed selections differ from select_products; keeping the previous table. ---", file=sys.stderr)
+                else:
+                    os.replace(candidate, args.table)
+            finally:
+                if os.path.exists(candidate):
+                    os.remove(candidate)
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()